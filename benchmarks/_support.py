@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup for the benchmarks.
+
+The benchmarks run outside of zope.testrunner, so the test layers they
+use are set up by hand, once per (pyperf worker) process.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope.annotation.attribute import AttributeAnnotations
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.component import provideAdapter
+
+from zope.preference.interfaces import IPreferenceGroup
+
+import zope.security.management
+
+from nti.testing.layers import ZopeComponentLayer
+from nti.testing.layers import ConfiguringLayerMixin
+
+from nti.dataserver.tests.mock_dataserver import DSInjectorMixin
+
+_set_up_layers = []
+
+
+class BenchmarkLayer(ZopeComponentLayer,
+                     ConfiguringLayerMixin,
+                     DSInjectorMixin):
+    """
+    The package's own configuration, without the test preference groups.
+    """
+
+    set_up_packages = ('nti.dataserver',
+                       'nti.app.client_preferences',)
+
+    @classmethod
+    def setUp(cls):
+        cls.setUpPackages()
+
+    @classmethod
+    def tearDown(cls):
+        cls.tearDownPackages()
+
+    @classmethod
+    def testSetUp(cls):
+        pass
+
+    @classmethod
+    def testTearDown(cls):
+        pass
+
+
+def set_up_layer(layer):
+    """
+    Set up *layer* and its bases, in the order zope.testrunner would,
+    unless that has already happened in this process.
+    """
+    if layer in _set_up_layers:
+        return
+    for base in layer.__bases__:
+        if base is not object:
+            set_up_layer(base)
+    if 'setUp' in vars(layer):
+        layer.setUp()
+    if 'testSetUp' in vars(layer):
+        layer.testSetUp()
+    _set_up_layers.append(layer)
+
+
+class Principal(object):
+
+    def __init__(self, principal_id=u'benchmark.user'):
+        self.id = principal_id
+
+
+class Participation(object):
+    interaction = None
+
+    def __init__(self, principal):
+        self.principal = principal
+
+
+def _annotations(principal, unused_group):
+    return AttributeAnnotations(principal)
+
+
+def new_principal_interaction(principal_id=u'benchmark.user'):
+    """
+    Begin an interaction for a new, annotatable principal, and return
+    the principal.
+    """
+    provideAdapter(_annotations, (Principal, IPreferenceGroup), IAnnotations)
+    zope.security.management.endInteraction()
+    principal = Principal(principal_id)
+    zope.security.management.newInteraction(Participation(principal))
+    return principal
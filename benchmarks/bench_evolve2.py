@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the generation 2 preference migration over synthetic
+populations of users with legacy preferences.
+
+Each value needs a freshly populated database, which is not timed but
+takes much longer than the migration itself, so this runs a single
+process by default. The population sizes default to 1,000 and 10,000;
+pass ``--users 1000,10000,100000`` to add larger ones.
+
+Run with ``python benchmarks/bench_evolve2.py -o evolve2.json``.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import fudge
+
+import pyperf
+
+import transaction
+
+from nti.app.client_preferences.generations.evolve2 import evolve
+
+from nti.dataserver.tests.mock_dataserver import WithMockDS
+from nti.dataserver.tests.mock_dataserver import mock_db_trans
+
+from nti.dataserver.users.users import User
+
+from _support import BenchmarkLayer
+from _support import set_up_layer
+
+KEY = 'nti.dataserver.users.preferences.EntityPreferences'
+
+LEGACY_PREFERENCES = {
+    'webapp_kalturaPreferFlash': True,
+    'presence': {
+        'active': 'available',
+        'available': {'show': 'chat', 'status': 'Back from lunch'},
+        'away': {'show': 'away', 'status': 'Back from breakfast'},
+        'dnd': {'show': 'dnd', 'status': 'Back from dinner'},
+    },
+}
+
+#: Users created per transaction while populating.
+POPULATE_BATCH = 1000
+
+
+def _populate(count):
+    for start in range(0, count, POPULATE_BATCH):
+        with mock_db_trans():
+            for i in range(start, min(count, start + POPULATE_BATCH)):
+                user = User.create_user(username=u'bench%d@example.com' % i)
+                user.__annotations__[KEY] = dict(LEGACY_PREFERENCES)
+
+
+@WithMockDS
+def _time_evolve(count):
+    _populate(count)
+    with mock_db_trans() as conn:
+        context = fudge.Fake().has_attr(connection=conn)
+        t0 = pyperf.perf_counter()
+        evolve(context)
+        transaction.commit()
+        return pyperf.perf_counter() - t0
+
+
+def bench_evolve(loops, count):
+    set_up_layer(BenchmarkLayer)
+    return sum(_time_evolve(count) for _ in range(loops))
+
+
+def _add_cmdline_args(cmd, args):
+    cmd.extend(('--users', args.users))
+
+
+def main():
+    runner = pyperf.Runner(processes=1, values=3, warmups=0, loops=1,
+                           add_cmdline_args=_add_cmdline_args)
+    runner.argparser.add_argument('--users', default='1000,10000',
+                                  help="Comma-separated population sizes")
+    args = runner.parse_args()
+    runner.metadata['description'] = "Generation 2 preference migration"
+    for count in args.users.split(','):
+        count = int(count)
+        runner.bench_time_func('evolve2 %d users' % count, bench_evolve, count)
+
+
+if __name__ == '__main__':
+    main()
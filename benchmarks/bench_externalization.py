@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for externalizing and updating preference groups, without
+any views or database.
+
+Run with ``python benchmarks/bench_externalization.py -o externalization.json``.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pyperf
+
+from zope import component
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+
+from nti.externalization.internalization import update_from_external_object
+
+from _support import BenchmarkLayer
+from _support import set_up_layer
+from _support import new_principal_interaction
+
+
+def _group(group_id):
+    set_up_layer(BenchmarkLayer)
+    new_principal_interaction()
+    return component.getUtility(IPreferenceGroup, name=group_id)
+
+
+def bench_externalize(loops, group_id, stored):
+    group = _group(group_id)
+    if stored:
+        # Some non-default values throughout the tree
+        update_from_external_object(component.getUtility(IPreferenceGroup),
+                                    {'WebApp': {'useHighContrast': True},
+                                     'Sort': {'courses': {'sortOn': u'title'}},
+                                     'PushNotifications': {'Email': {'notify_on_mention': False}}})
+    t0 = pyperf.perf_counter()
+    for _ in range(loops):
+        PreferenceGroupObjectIO(group).toExternalObject()
+    return pyperf.perf_counter() - t0
+
+
+def _toggled_bodies(full):
+    group = _group('')
+    if full:
+        body = PreferenceGroupObjectIO(group).toExternalObject()
+    else:
+        body = {'WebApp': {}}
+    on = {'WebApp': dict(body['WebApp'], useHighContrast=True)}
+    off = {'WebApp': dict(body['WebApp'], useHighContrast=False)}
+    return group, dict(body, **on), dict(body, **off)
+
+
+def bench_update(loops, full):
+    # Alternate between two bodies so every update changes something.
+    group, on, off = _toggled_bodies(full)
+    t0 = pyperf.perf_counter()
+    for i in range(loops):
+        update_from_external_object(group, on if i % 2 else off)
+    return pyperf.perf_counter() - t0
+
+
+def bench_update_unchanged(loops):
+    group = _group('')
+    body = PreferenceGroupObjectIO(group).toExternalObject()
+    t0 = pyperf.perf_counter()
+    for _ in range(loops):
+        update_from_external_object(group, body)
+    return pyperf.perf_counter() - t0
+
+
+def main():
+    runner = pyperf.Runner()
+    runner.metadata['description'] = "Preference group externalization"
+    runner.bench_time_func('externalize root', bench_externalize, '', False)
+    runner.bench_time_func('externalize root, stored values', bench_externalize, '', True)
+    runner.bench_time_func('externalize leaf', bench_externalize,
+                           'PushNotifications.Email', False)
+    runner.bench_time_func('update full body', bench_update, True)
+    runner.bench_time_func('update partial body', bench_update, False)
+    runner.bench_time_func('update full body, unchanged', bench_update_unchanged)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the preference GET and PUT views, through webtest
+and the mock dataserver.
+
+Run with ``python benchmarks/bench_views.py -o views.json``.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pyperf
+
+from nti.app.testing.application_webtest import ApplicationTestLayer
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from _support import set_up_layer
+
+HREF = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++'
+
+
+class _ViewBenchmarks(ApplicationLayerTest):
+    # We borrow the test machinery to get a testapp
+    # backed by a mock dataserver with a user.
+    layer = ApplicationTestLayer
+
+    def runTest(self):
+        pass
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def time_requests(self, loops, method, path, stored, body):
+        testapp = self.testapp
+        if stored:
+            testapp.put_json(HREF, {'WebApp': {'useHighContrast': True}})
+        if method == 'GET':
+            def request(_):
+                testapp.get(path)
+        else:
+            def request(i):
+                # Alternate values so that every PUT changes something
+                value = dict(body, useHighContrast=bool(i % 2))
+                testapp.put_json(path, value)
+        t0 = pyperf.perf_counter()
+        for i in range(loops):
+            request(i)
+        return pyperf.perf_counter() - t0
+
+
+def bench_view(loops, method, path, stored=False, body=None):
+    set_up_layer(ApplicationTestLayer)
+    case = _ViewBenchmarks()
+    case.setUp()
+    try:
+        return case.time_requests(loops, method, path, stored, body)
+    finally:
+        case.tearDown()
+
+
+def main():
+    runner = pyperf.Runner()
+    runner.metadata['description'] = "Preference views"
+    runner.bench_time_func('GET root, defaults', bench_view, 'GET', HREF)
+    runner.bench_time_func('GET root, stored values', bench_view, 'GET', HREF,
+                           True)
+    runner.bench_time_func('GET leaf', bench_view, 'GET',
+                           HREF + '/PushNotifications/Email')
+    runner.bench_time_func('GET root, depth=1', bench_view, 'GET',
+                           HREF + '?depth=1')
+    runner.bench_time_func('PUT leaf', bench_view, 'PUT',
+                           HREF + '/WebApp', True, {'preferFlashVideo': False})
+
+
+if __name__ == '__main__':
+    main()
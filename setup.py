@@ -6,6 +6,9 @@ entry_points = {
     "z3c.autoinclude.plugin": [
         'target = nti.app',
     ],
+    "console_scripts": [
+        'nti_export_preferences = nti.app.client_preferences.export:main',
+    ],
 }
 
 TESTS_REQUIRE = [
@@ -51,11 +54,15 @@ setup(
     tests_require=TESTS_REQUIRE,
     install_requires=[
         'setuptools',
+        'BTrees',
         'nti.base',
         'nti.contentfragments',
         'nti.externalization',
         'nti.schema',
+        'persistent',
         'pyramid',
+        'transaction',
+        'ZODB',
         'zope.annotation',
         'zope.component',
         'zope.generations',
@@ -64,11 +71,19 @@ setup(
         'zope.interface',
         'zope.intid',
         'zope.preference',
+        'zope.processlifetime',
         'zope.schema',
         'zope.security',
     ],
     extras_require={
         'test': TESTS_REQUIRE,
+        'benchmark': TESTS_REQUIRE + [
+            'fudge',
+            'pyperf',
+        ],
+        'numpy': [
+            'numpy',
+        ],
         'docs': [
             'Sphinx',
             'repoze.sphinx.autointerface',
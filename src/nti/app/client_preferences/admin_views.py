@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Administrative and service views for working with the preferences
+of many users at once.
+
+These views never start an interaction for the users whose
+preferences they use; they read the preference storage of each user
+directly.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import gzip
+import tempfile
+
+import simplejson as json
+
+import transaction
+
+from pyramid import httpexceptions as hexc
+
+from pyramid.response import FileIter
+
+from pyramid.view import view_config
+
+from zope import component
+
+from zope.component.hooks import site
+
+from zope.intid.interfaces import IIntIds
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.schema.interfaces import ValidationError
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.base.abstract_views import AbstractAuthenticatedView
+
+from nti.app.client_preferences.bulk import CHUNK_SIZE
+from nti.app.client_preferences.bulk import set_preferences_for_users
+
+from nti.app.client_preferences.cache import get_document_cache
+
+from nti.app.client_preferences.export import write_preferences_jsonl
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import query_write_buffer
+from nti.app.client_preferences.storage import read_preference_values
+from nti.app.client_preferences.storage import buffered_preference_values
+from nti.app.client_preferences.storage import query_preference_storage
+
+from nti.app.client_preferences.users import BATCH_SIZE
+from nti.app.client_preferences.users import iter_users
+
+from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
+
+from nti.dataserver import authorization as nauth
+
+from nti.dataserver.interfaces import IUser
+from nti.dataserver.interfaces import IDataserverFolder
+
+from nti.dataserver.users.communities import Community
+
+from nti.dataserver.users.users import User
+
+from nti.externalization.externalization import to_external_object
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _iter_users(values, missing):
+    """
+    Iterate the users named by the ``usernames`` and ``intids`` of the
+    *values*, and the members of the ``community``, if any, adding
+    those that can't be found to *missing*.
+    """
+    for username in values.get('usernames') or ():
+        user = User.get_user(username)
+        if IUser.providedBy(user):
+            yield user
+        else:
+            missing.append(username)
+    intids = component.getUtility(IIntIds)
+    for intid in values.get('intids') or ():
+        try:
+            user = intids.queryObject(int(intid))
+        except (TypeError, ValueError):
+            user = None
+        if IUser.providedBy(user):
+            yield user
+        else:
+            missing.append(intid)
+    name = values.get('community')
+    if name:
+        community = Community.get_community(name)
+        if community is None:
+            missing.append(name)
+        else:
+            for user in community.iter_members():
+                if IUser.providedBy(user):
+                    yield user
+
+
+def _read_tree(plans, plan, principal, storage, buffer):
+    # Like PreferenceGroupObjectIO._read_values, for the whole tree
+    result = read_preference_values(plan, storage)
+    result.update(buffered_preference_values(plan, principal, buffer) or ())
+    for local_name, group in plan.readable_children:
+        result[local_name] = _read_tree(plans, plans[group.__id__],
+                                        principal, storage, buffer)
+    return result
+
+
+def _iter_user_preferences(db, ds_oid, usernames, group_id, missing):
+    """
+    Iterate the body of the ``@@UserPreferences`` response, one user
+    at a time. This runs after the transaction of the request is over,
+    so the users are read in a connection of their own, minimizing its
+    cache after every batch.
+    """
+    tm = transaction.TransactionManager()
+    connection = db.open(transaction_manager=tm)
+    try:
+        ds_folder = connection.get(ds_oid)
+        with site(ds_folder):
+            plans = get_preference_group_plans()
+            plan = plans[group_id]
+            group = component.getUtility(IPreferenceGroup, name=group_id)
+            buffer = query_write_buffer()
+            users = iter_users(ds_folder, BATCH_SIZE, usernames)
+        yield b'{"Items": {'
+        separator = b''
+        while True:
+            with site(ds_folder):
+                user = next(users, None)
+                if user is None:
+                    break
+                principal = IPrincipal(user)
+                storage = query_preference_storage(group, principal)
+                data = _read_tree(plans, plan, principal, storage, buffer)
+                chunk = b''.join((separator,
+                                  json.dumps(user.username).encode('utf-8'),
+                                  b': ',
+                                  json.dumps(to_external_object(data)).encode('utf-8')))
+            yield chunk
+            separator = b', '
+        yield b'}, "Missing": ' + json.dumps(missing).encode('utf-8') + b'}'
+    finally:
+        tm.abort()
+        connection.close()
+
+
+@view_config(route_name='objects.generic.traversal',
+             request_method='POST',
+             context=IDataserverFolder,
+             name='UserPreferences',
+             permission=nauth.ACT_NTI_ADMIN)
+class UserPreferencesView(AbstractAuthenticatedView,
+                          ModeledContentUploadRequestUtilsMixin):
+    """
+    Return the effective preference values of many users at once.
+
+    The body is a JSON object with a ``path`` (the dotted id of a
+    preference group, e.g., ``PushNotifications.Email``; the root if
+    not given) and the users, given as ``usernames`` and/or ``intids``
+    lists and/or the name of a ``community``. The response
+    is a JSON object with ``Items`` mapping each username to the
+    values of the group (and its readable children, nested by name),
+    and ``Missing``, listing the requested users that could not be
+    found.
+
+    The requested users are looked up first, and the body is then
+    streamed, encoded one user at a time as the users are read again
+    (see :func:`_iter_user_preferences`). Values of volatile groups
+    that are buffered but not yet written are included.
+    """
+
+    def __call__(self):
+        values = self.readInput()
+        group_id = values.get('path') or ''
+        plan = get_preference_group_plans().get(group_id)
+        if plan is None or not plan.readable:
+            raise hexc.HTTPUnprocessableEntity('Invalid preference group')
+
+        ds_folder = self.request.context
+        connection = ds_folder._p_jar
+        usernames = []
+        missing = []
+        for i, user in enumerate(_iter_users(values, missing), 1):
+            usernames.append(user.username)
+            if i % BATCH_SIZE == 0:
+                connection.cacheMinimize()
+
+        response = self.request.response
+        response.content_type = 'application/json'
+        response.app_iter = _iter_user_preferences(connection.db(),
+                                                   ds_folder._p_oid,
+                                                   usernames, group_id,
+                                                   missing)
+        return response
+
+
+@view_config(route_name='objects.generic.traversal',
+             request_method='POST',
+             renderer='rest',
+             context=IDataserverFolder,
+             name='BulkSetUserPreferences',
+             permission=nauth.ACT_NTI_ADMIN)
+class BulkSetUserPreferencesView(AbstractAuthenticatedView,
+                                 ModeledContentUploadRequestUtilsMixin):
+    """
+    Set the same values of one preference group for many users (see
+    :mod:`.bulk`).
+
+    The body is a JSON object with a ``path`` (the dotted id of a
+    writable group), the ``values`` of some of its fields, and the
+    users, given as ``usernames`` and/or ``intids`` lists and/or the
+    name of a ``community`` whose members to update. The response has
+    the number of users ``Updated`` and ``Skipped``, the ``Elapsed``
+    seconds, the ``UsersPerSecond`` and the ``Missing`` users.
+
+    Everything happens in the transaction of the request, with a
+    savepoint after every ``chunk_size`` users (optional). The
+    savepoints only keep the changes from piling up in memory; they
+    don't make the chunks durable. All the users are written in one
+    (possibly very large) commit at the end of the request, nothing
+    is written if the request fails, and a conflict retries the whole
+    request from the first user. To update very many users with a
+    commit after each chunk, call
+    :func:`~.bulk.set_preferences_for_users` with a
+    ``transaction_manager`` outside of a request instead.
+    """
+
+    def __call__(self):
+        values = self.readInput()
+        group_id = values.get('path') or ''
+        update = values.get('values')
+        if not isinstance(update, dict):
+            raise hexc.HTTPUnprocessableEntity('Invalid values')
+        chunk_size = values.get('chunk_size') or CHUNK_SIZE
+        missing = []
+        users = _iter_users(values, missing)
+        try:
+            result = set_preferences_for_users(users, group_id, update,
+                                               chunk_size=int(chunk_size))
+        except (ValueError, ValidationError) as e:
+            raise hexc.HTTPUnprocessableEntity(str(e))
+        result['Missing'] = missing
+        return result
+
+
+@view_config(route_name='objects.generic.traversal',
+             request_method='GET',
+             context=IDataserverFolder,
+             name='ExportUserPreferences',
+             permission=nauth.ACT_NTI_ADMIN)
+def ExportUserPreferencesView(request):
+    """
+    Return the preferences of all users as JSON Lines (see
+    :mod:`.export`), gzipped if the ``gzip`` query parameter is true.
+
+    The export is written to a temporary file as the users are read,
+    and the response is streamed from it, so memory use is flat.
+    """
+    compress = request.params.get('gzip', '').lower() in ('1', 'true', 'yes', 'on')
+    tmp = tempfile.TemporaryFile()
+    out = gzip.GzipFile(fileobj=tmp, mode='wb') if compress else tmp
+    try:
+        write_preferences_jsonl(request.context, out)
+        if compress:
+            out.close()
+    except BaseException:
+        tmp.close()
+        raise
+    tmp.seek(0)
+    response = request.response
+    filename = 'preferences.jsonl.gz' if compress else 'preferences.jsonl'
+    response.content_type = 'application/gzip' if compress else 'application/x-ndjson'
+    response.content_disposition = 'attachment; filename="%s"' % filename
+    response.app_iter = FileIter(tmp)
+    return response
+
+
+@view_config(route_name='objects.generic.traversal',
+             request_method='GET',
+             renderer='rest',
+             context=IDataserverFolder,
+             name='PreferenceDocumentCache',
+             permission=nauth.ACT_NTI_ADMIN)
+def PreferenceDocumentCacheView(unused_request):
+    """
+    Return the statistics of the preference document cache of the
+    process answering (see :mod:`.cache`).
+    """
+    return get_document_cache().stats()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Setting the same preference values for many users at once.
+
+:func:`set_preferences_for_users` applies a partial update of one
+group to each user through
+:meth:`.PreferenceGroupObjectIO.updateFromExternalObject` (for that
+user's principal), so values are validated and update events are
+sent just like for a ``PUT``; users whose values already match are
+skipped and nothing is written for them. The values are validated once,
+before any user is updated.
+
+Users are updated in chunks. After each chunk, the transaction is
+committed (if a transaction manager is given) or a savepoint is taken
+(so that a single large transaction doesn't keep every change in
+memory), and the cache of the connection is minimized.
+
+The ``@@BulkSetUserPreferences`` view of the dataserver folder (see
+:mod:`.admin_views`) does this for a list of users or the members of
+a community.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import transaction
+
+from zope import component
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+from nti.app.client_preferences.externalization import validate_preference_value
+
+from nti.app.client_preferences.metrics import clock
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+#: The number of users updated between savepoints (or commits).
+CHUNK_SIZE = 200
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _check_update(group_id, values):
+    plan = get_preference_group_plans().get(group_id)
+    if plan is None or not plan.writable:
+        raise ValueError('Invalid preference group %s' % group_id)
+    for name, value in values.items():
+        if name not in plan.fields:
+            raise ValueError('Invalid preference %s.%s' % (group_id, name))
+        validate_preference_value(plan, name, value)
+
+
+def set_preferences_for_users(users, group_id, values, chunk_size=CHUNK_SIZE,
+                              transaction_manager=None, progress=None):
+    """
+    Update the fields of the group *group_id* of each of the *users*
+    (an iterable) with *values*, a dictionary of external values.
+
+    Raises :exc:`ValueError` if the group isn't writable or a field
+    doesn't exist, or the field's validation error if a value is
+    invalid, before updating anyone.
+
+    *progress*, if given, is called after each chunk with the result
+    so far. Returns a dictionary with the number of users ``Updated``
+    and ``Skipped`` (they already had the values), the ``Elapsed``
+    seconds and the ``UsersPerSecond``.
+    """
+    _check_update(group_id, values)
+    group = component.getUtility(IPreferenceGroup, name=group_id)
+    result = {'Updated': 0, 'Skipped': 0, 'Elapsed': 0.0, 'UsersPerSecond': 0.0}
+    start = clock()
+    connection = None
+    pending = 0
+
+    def _chunk_done():
+        if transaction_manager is not None:
+            transaction_manager.commit()
+        else:
+            transaction.savepoint(optimistic=True)
+        if connection is not None:
+            connection.cacheMinimize()
+        elapsed = clock() - start
+        done = result['Updated'] + result['Skipped']
+        result['Elapsed'] = elapsed
+        result['UsersPerSecond'] = done / elapsed if elapsed else 0.0
+        logger.info("Set %s for %d users (%d unchanged), %.1f users/second",
+                    group_id, done, result['Skipped'], result['UsersPerSecond'])
+        if progress is not None:
+            progress(dict(result))
+
+    for user in users:
+        connection = getattr(user, '_p_jar', None) or connection
+        io = PreferenceGroupObjectIO(group.__bind__(user), IPrincipal(user))
+        if io.updateFromExternalObject(dict(values)):
+            result['Updated'] += 1
+        else:
+            result['Skipped'] += 1
+        pending += 1
+        if pending == chunk_size:
+            _chunk_done()
+            pending = 0
+    if pending or not (result['Updated'] + result['Skipped']):
+        _chunk_done()
+    return result
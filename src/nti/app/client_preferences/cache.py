@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A per-process cache of the serialized external form of the preference
+groups of users who have stored preferences.
+
+When a group is externalized for a request,
+:class:`~.PreferenceGroupObjectIO` keeps its external form, as JSON
+bytes, in a :class:`SerializedDocumentCache`, bounded by the total
+size of the bytes and evicting the least recently used documents.
+Documents are cached undecorated; what is returned from the cache is
+a new copy, decorated for the request, which the renderer decorates
+(with links and the like) and serializes just as it would a new
+external form.
+
+Documents are keyed by the principal, the group, the requested
+projection, the oid and serial of the principal's
+:class:`~nti.app.client_preferences.storage.PreferenceStorage`, which
+holds all of the principal's stored values, and the version of the
+site's default values. Committing a change to the storage (on any
+node) gives it a new serial, so a stale document is simply never
+found again; it ages out of the cache.
+
+Documents also remember the plans of the site they were built with
+(see :mod:`.plan`), and aren't used once those plans are compiled
+again.
+
+.. note:: Like :mod:`.defaults`, uncommitted changes to the default
+   preference provider, and changes to the values of a provider that
+   isn't persistent, are not noticed; call :func:`clear_document_cache`
+   after making them.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+
+from collections import OrderedDict
+
+from nti.app.client_preferences.storage import PreferenceStorage
+from nti.app.client_preferences.storage import query_write_buffer
+from nti.app.client_preferences.storage import default_values_version
+
+#: The default bound on the total size of the cached documents.
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class SerializedDocumentCache(object):
+    """
+    A thread-safe LRU mapping from key to serialized document, holding
+    at most *max_bytes* of documents.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (plans, body), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, plans):
+        """
+        Return the document cached for *key* and built with *plans*,
+        or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] is not plans:
+                if entry is not None:
+                    self._bytes -= len(entry[1])
+                self.misses += 1
+                return None
+            # Now the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, plans, body):
+        """
+        Cache the document *body*, built with *plans*, for *key*.
+        """
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (plans, body)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Return a dictionary of the counts of ``hits``, ``misses`` and
+        ``evictions``, the ``hit_rate``, and the number of ``entries``
+        and total ``bytes`` of the documents cached (out of ``max_bytes``).
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+_document_cache = SerializedDocumentCache()
+
+
+def get_document_cache():
+    """
+    Return the :class:`SerializedDocumentCache` of this process. Its
+    ``max_bytes`` may be changed at any time; the bound applies from
+    the next document cached.
+    """
+    return _document_cache
+
+
+def clear_document_cache():
+    """
+    Discard all cached documents.
+    """
+    _document_cache.clear()
+
+
+def document_cache_key(group, principal, storage, projection=None):
+    """
+    Return the key of the document of *group*, with the given
+    (hashable) *projection*, for the *principal*, whose preference
+    storage is *storage*; or None if the document can't be cached: the
+    storage is not a committed :class:`.PreferenceStorage`, or has
+    uncommitted (or buffered, see :mod:`.writebehind`) changes.
+    """
+    if not isinstance(storage, PreferenceStorage) or storage._p_oid is None:
+        return None
+    buffer = query_write_buffer()
+    if buffer is not None and buffer.has_pending(principal.id):
+        return None
+    # A ghost doesn't know its serial.
+    storage._p_activate()
+    if storage._p_changed:
+        return None
+    return (principal.id, group.__id__, projection,
+            storage._p_oid, storage._p_serial,
+            default_values_version(group.__id__))
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clear_document_cache)
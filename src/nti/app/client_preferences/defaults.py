@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A shared, precomputed external form of preference groups for
+principals who have never stored a preference.
+
+Most users never change a preference, and for all of them a
+preference group externalizes to the same document, built only from
+the schema and site defaults. That document is built once per group
+and site, by :class:`~.PreferenceGroupObjectIO` (for a principal
+without any storage, and without decorations, which depend on the
+request and are added for each one), both as the external dictionary
+and as serialized JSON bytes, and is discarded whenever the plans of the site are compiled
+again (see :mod:`.plan`): when the utility registrations of the site
+(or its bases) change, which includes the registration of preference
+groups and default preference providers, or when a group's access
+changes. It is also built again when a change to the (persistent)
+default preference provider of the site is committed, in any process.
+
+.. note:: Uncommitted changes to the provider, and changes to the
+   values of a provider that isn't persistent, are not noticed; call
+   :func:`clear_defaults_documents` after making them.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import weakref
+
+from collections import namedtuple
+
+import simplejson as json
+
+from zope import component
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import clear_default_values
+from nti.app.client_preferences.storage import default_values_version
+
+
+class DefaultsDocument(namedtuple('DefaultsDocument', ('external', 'body'))):
+    """
+    The external form of a preference group (and its readable
+    children) holding only default values: *external* is the
+    dictionary, which must not be modified, and *body* is its JSON
+    encoding.
+    """
+
+    __slots__ = ()
+
+
+class _NoPrincipal(object):
+    # Has no storage, and nothing buffered
+    id = None
+
+
+def _externalize_defaults(group):
+    # The IO uses these documents, so it can't be imported first
+    from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+    io = PreferenceGroupObjectIO(group, _NoPrincipal())
+    return io.toExternalObject(decorate=False)
+
+
+_documents_by_registry = weakref.WeakKeyDictionary()
+
+
+def get_defaults_document(group_id, registry=None):
+    """
+    Return the :class:`DefaultsDocument` for the readable group
+    *group_id* in *registry* (by default, the current site manager),
+    or None if there is no such group.
+    """
+    registry = component.getSiteManager() if registry is None else registry
+    utilities = registry.utilities
+    plans = get_preference_group_plans(registry)
+    cached = _documents_by_registry.get(utilities)
+    if cached is None or cached[0] is not plans:
+        cached = (plans, {})
+        _documents_by_registry[utilities] = cached
+    documents = cached[1]
+    version = default_values_version(group_id)
+    entry = documents.get(group_id)
+    if entry is None or entry[0] != version:
+        plan = plans.get(group_id)
+        if plan is None or not plan.readable:
+            return None
+        external = _externalize_defaults(registry.getUtility(IPreferenceGroup,
+                                                             name=group_id))
+        body = json.dumps(external).encode('utf-8')
+        entry = documents[group_id] = (version, DefaultsDocument(external, body))
+    return entry[1]
+
+
+def clear_defaults_documents():
+    """
+    Discard all defaults documents, and the resolved default values
+    they are built from. They will be built again as needed.
+    """
+    _documents_by_registry.clear()
+    clear_default_values()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clear_defaults_documents)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk export of the preferences of all users, as JSON Lines.
+
+Each line is a JSON object with the ``Username`` and the
+``Preferences``, the external form of the user's whole preference
+tree (as :class:`~.PreferenceGroupObjectIO` produces it, including
+defaults). Users are read in batches of *batch_size*, in username
+order, with :func:`~.users.iter_users`, so memory use doesn't grow
+with the number of users. The output is written as it is produced.
+
+The export is available to administrators as the
+``@@ExportUserPreferences`` view of the dataserver folder (see
+:mod:`.admin_views`), and as the ``nti_export_preferences`` console
+script (see :func:`main`).
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+import gzip
+import argparse
+
+import simplejson as json
+
+from zope import component
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+
+from nti.app.client_preferences.users import BATCH_SIZE
+from nti.app.client_preferences.users import iter_users
+
+from nti.dataserver.interfaces import IDataserver
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def export_user_preferences(user, group=None):
+    """
+    Return the external form of the preference *group* (by default, the
+    root) of the *user*. No interaction is needed, and nothing is written.
+    """
+    group = component.getUtility(IPreferenceGroup) if group is None else group
+    io = PreferenceGroupObjectIO(group.__bind__(user), IPrincipal(user))
+    return io.toExternalObject()
+
+
+def write_preferences_jsonl(ds_folder, out, batch_size=BATCH_SIZE):
+    """
+    Write a line of JSON (as bytes) to the file-like *out* for each
+    user of the dataserver folder, and return the number of users.
+    """
+    group = component.getUtility(IPreferenceGroup)
+    count = 0
+    for user in iter_users(ds_folder, batch_size):
+        line = {'Username': user.username,
+                'Preferences': export_user_preferences(user, group)}
+        out.write(json.dumps(line, sort_keys=True).encode('utf-8'))
+        out.write(b'\n')
+        count += 1
+    return count
+
+
+def open_output(path, compress=False):
+    """
+    Open the output file *path* (``-`` is standard output) for
+    writing bytes, compressing with gzip if asked.
+    """
+    if path == '-':
+        fileobj = getattr(sys.stdout, 'buffer', sys.stdout)
+        return gzip.GzipFile(fileobj=fileobj, mode='wb') if compress else fileobj
+    if compress:
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def _export(args):
+    dataserver = component.getUtility(IDataserver)
+    out = open_output(args.output, args.gzip)
+    try:
+        count = write_preferences_jsonl(dataserver.dataserver_folder, out,
+                                        args.batch_size)
+    finally:
+        if out is not getattr(sys.stdout, 'buffer', sys.stdout):
+            out.close()
+    logger.info("Exported the preferences of %d users", count)
+
+
+def main(argv=None):
+    """
+    Export the preferences of all users of the dataserver in the
+    environment named by ``$DATASERVER_DIR``.
+    """
+    from nti.dataserver.utils import run_with_dataserver
+    from nti.dataserver.utils.base_script import create_context
+
+    parser = argparse.ArgumentParser(description="Export the preferences of all users as JSON Lines")
+    parser.add_argument('output', nargs='?', default='-',
+                        help="The file to write; standard output by default")
+    parser.add_argument('--gzip', action='store_true',
+                        help="Compress the output with gzip")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help="The number of users read between minimizing the cache")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    env_dir = os.getenv('DATASERVER_DIR')
+    if not env_dir or not os.path.isdir(env_dir):
+        raise IOError("Invalid dataserver environment root directory")
+    context = create_context(env_dir)
+    run_with_dataserver(environment_dir=env_dir,
+                        xmlconfig_packages=('nti.app.client_preferences',),
+                        context=context,
+                        minimal_ds=True,
+                        verbose=args.verbose,
+                        function=lambda: _export(args))
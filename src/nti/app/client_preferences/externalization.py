@@ -26,28 +26,151 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import simplejson as json
+
 from zope import component
 
+from zope.event import notify
+
 from zope.preference.interfaces import IPreferenceGroup
 
-from nti.app.client_preferences.interfaces import TAG_EXTERNAL_PREFERENCE_GROUP
+from zope.schema import getValidationErrors
+
+from nti.app.client_preferences.cache import get_document_cache
+from nti.app.client_preferences.cache import document_cache_key
+
+from nti.app.client_preferences.defaults import get_defaults_document
+
+from nti.app.client_preferences.interfaces import PreferenceGroupUpdatedEvent
+
+from nti.app.client_preferences.metrics import clock
+from nti.app.client_preferences.metrics import query_metrics_sink
+
+from nti.app.client_preferences.plan import get_preference_group_plan
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import get_current_principal
+from nti.app.client_preferences.storage import query_write_buffer
+from nti.app.client_preferences.storage import read_preference_values
+from nti.app.client_preferences.storage import has_stored_preferences
+from nti.app.client_preferences.storage import buffer_preference_values
+from nti.app.client_preferences.storage import buffered_preference_values
+from nti.app.client_preferences.storage import store_preference_value
+from nti.app.client_preferences.storage import get_preference_storage
+from nti.app.client_preferences.storage import query_preference_storage
 
 from nti.externalization.datastructures import InterfaceObjectIO
+from nti.externalization.datastructures import LocatedExternalDict
 
-from nti.externalization.externalization import to_external_object
+from nti.externalization.extension_points import get_current_request
+
+from nti.externalization.externalization.decorate import decorate_external_object
 
 from nti.externalization.interfaces import StandardExternalFields
+from nti.externalization.interfaces import IExternalObjectDecorator
+from nti.externalization.interfaces import IExternalMappingDecorator
+
+from nti.externalization.internalization import validate_named_field_value
+
+
+def parse_field_paths(paths):
+    """
+    Turn dotted *paths* of fields or sub-groups, relative to some
+    group (for example, ``WebApp.useHighContrast`` or ``Sort.courses``),
+    into the nested selection that
+    :meth:`PreferenceGroupObjectIO.toExternalObject` accepts as
+    *fields*: a dictionary from local name to the selection within it,
+    where None selects everything.
+    """
+    result = {}
+    for path in paths:
+        parts = [part for part in path.strip().split('.') if part]
+        if not parts:
+            continue
+        node = result
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                # Everything below is already selected
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return result
+
+
+def _freeze_selection(fields):
+    # The hashable form of a selection, for cache keys
+    if fields is None:
+        return None
+    return tuple(sorted((name, _freeze_selection(selection))
+                        for name, selection in fields.items()))
+
+
+_marker = object()
+
+
+def _decorate_subgroup(group, external, decorate=True, request=None, **unused_kwargs):
+    # Mapping decorators run as the sub-group's IO builds its
+    # dictionary; the object decorators are up to whoever called the
+    # IO, which for sub-groups is us.
+    if decorate:
+        request = get_current_request() if request is None else request
+        decorate_external_object(True, None,
+                                 IExternalObjectDecorator, 'decorateExternalObject',
+                                 group, external, None, request)
+
+
+def _decorate_document(group, plan, plans, external, request):
+    # Decorate a shared or cached (undecorated) external form the way
+    # externalizing would have: the mapping of every group, and the
+    # sub-groups as objects. The group itself is up to the caller.
+    decorate_external_object(True, None,
+                             IExternalMappingDecorator, 'decorateExternalMapping',
+                             group, external, None, request)
+    for local_name, child in plan.readable_children:
+        sub_external = external.get(local_name)
+        if sub_external is None:
+            # Not included
+            continue
+        child = child.__bind__(group)
+        _decorate_document(child, plans[child.__id__], plans, sub_external, request)
+        _decorate_subgroup(child, sub_external, request=request)
+
+
+class _FieldValues(object):
+    """
+    Receives the validated (and possibly converted) values
+    that :func:`validate_named_field_value` sets.
+    """
+
 
-from nti.externalization.internalization import update_from_external_object
+def validate_preference_value(plan, name, value):
+    """
+    Validate the external *value* of the field *name* of the group
+    described by *plan*, without storing it, and return the
+    (possibly converted) value. Raises the field's validation error
+    if it is invalid.
+    """
+    values = _FieldValues()
+    validate_named_field_value(values, plan.schema, name, value)()
+    return values.__dict__[name]
 
 
-def _check_read(schema, allow=('read', 'write')):
-    if schema is None:
+def validate_preference_values(plan, values):
+    """
+    Validate the effective *values* (a dictionary of every field) of
+    the group described by *plan* against its schema, including its
+    invariants, as updating the group from external data does
+    afterwards. Raises the first error (a
+    :class:`~zope.schema.interfaces.ValidationError`, or an :class:`~zope.interface.Invalid` for an invariant).
+    """
+    if plan.schema is None:
         return
-    for iface in schema.__iro__:
-        if iface.queryTaggedValue(TAG_EXTERNAL_PREFERENCE_GROUP) in allow:
-            return
-    raise ValueError('Unreadable schema')
+    obj = _FieldValues()
+    obj.__dict__.update(values)
+    errors = getValidationErrors(plan.schema, obj)
+    if errors:
+        raise errors[0][1]
 
 
 @component.adapter(IPreferenceGroup)
@@ -78,68 +201,248 @@ class PreferenceGroupObjectIO(InterfaceObjectIO):
     This overrides anything the specific subclass of PreferenceGroup
     or schema interface specified.
 
+    Storage
+    =======
+
+    Values are read straight from the principal's storage, falling
+    back to the defaults; reading through the preference group would
+    create the (empty) storage, so externalizing never writes
+    anything. Updated values are written to the
+    :class:`~nti.app.client_preferences.storage.PreferenceStorage` of
+    the *principal* given to the constructor (by default, the
+    principal of the current interaction), which keeps only values
+    that differ from the defaults.
+
+    Updates of volatile groups go to the write buffer instead, if
+    there is one (see :mod:`.writebehind`), when the transaction
+    commits; values are read from it first.
+
+    Projection
+    ==========
+
+    :meth:`toExternalObject` accepts *depth*, the number of levels of
+    sub-groups to include, and *fields*, a selection of fields and
+    sub-groups (see :func:`parse_field_paths`). Sub-groups that aren't
+    included are never looked at.
+
+    Shared and Cached Documents
+    ===========================
+
+    When externalizing for a request, principals who have never stored
+    a preference get a copy of the shared defaults document of the
+    group (see :mod:`.defaults`), and the external form of the groups
+    of everyone else is kept in the document cache (see :mod:`.cache`).
+    Both are kept undecorated; the copy is decorated for the request
+    as it would have been while externalizing, and whoever asked for
+    the group (typically, the renderer) still decorates and serializes
+    it, so it is the same as if it had been externalized again.
+
+    Updates
+    =======
+
+    Only the fields (and sub-groups) present in the external data are
+    updated, and only values that differ from the current ones are
+    written: updating a group with the data it externalized to changes
+    nothing and writes nothing.
+
     """
 
     # For the root object, the schema will be missing
     # and the id will be blank
 
-    def __init__(self, context):
-        _check_read(context.__schema__)
+    def __init__(self, context, principal=None):
+        self._principal = principal
+        self._storage = None
+        self._values = None
+        self._selection = None
+        # Everything that doesn't depend on the user's data
+        # is precomputed; see :mod:`.plan`
+        self._plan = get_preference_group_plan(context)
+        if not self._plan.readable:
+            raise ValueError('Unreadable schema')
         super(PreferenceGroupObjectIO, self).__init__(context,
-                                                      iface_upper_bound=context.__schema__ or IPreferenceGroup)
+                                                      iface_upper_bound=self._plan.schema or IPreferenceGroup)
 
     @property
-    def __external_resolvers__(self):
+    def principal(self):
+        if self._principal is None:
+            self._principal = get_current_principal()
+        return self._principal
+
+    def _get_storage(self, create=True):
+        storage = self._storage
+        if storage is None:
+            group = self._ext_replacement()
+            if not create:
+                return query_preference_storage(group, self.principal)
+            storage = self._storage = get_preference_storage(group, self.principal)
+        return storage
+
+    def _read_values(self):
+        values = self._values
+        if values is None:
+            storage = self._get_storage(create=False)
+            values = self._values = read_preference_values(self._plan, storage)
+            values.update(buffered_preference_values(self._plan, self.principal) or ())
+        return values
+
+    def _ext_getattr(self, ext_self, k, default=_marker):
+        if k in self._plan.fields:
+            return self._read_values()[k]
+        if default is _marker:
+            return super(PreferenceGroupObjectIO, self)._ext_getattr(ext_self, k)
+        return super(PreferenceGroupObjectIO, self)._ext_getattr(ext_self, k, default)
+
+    # Note: _ext_setattr validates against the interface, which adds
+    # the security of not being able to set a key that isn't in it.
+    # The values themselves bypass the PrefGroup (and its validation)
+    # and go straight to storage, which drops defaults. Unchanged
+    # values don't touch storage at all (not even to create it).
+
+    def _ext_setattr(self, ext_self, k, value):
+        plan = self._plan
+        if k not in plan.fields:
+            super(PreferenceGroupObjectIO, self)._ext_setattr(ext_self, k, value)
+        else:
+            value = validate_preference_value(plan, k, value)
+            if value == self._read_values()[k]:
+                return
+            buffer = query_write_buffer() if plan.volatile else None
+            if buffer is None or not buffer_preference_values(plan, self.principal,
+                                                              {k: value}, buffer):
+                store_preference_value(plan, self._get_storage(), k, value)
+            self._values[k] = value
+        self._ext_updated_names.append(k)
+
+    def _validate_after_update(self, iface, ext_self):
+        # Validate the values as we read them (including buffered
+        # ones) for our principal; reading through the PrefGroup would
+        # use the interaction's principal and could create the storage.
+        # If we changed nothing, there's nothing to validate.
+        if self._ext_updated_names:
+            values = _FieldValues()
+            values.__dict__.update(self._read_values())
+            super(PreferenceGroupObjectIO, self)._validate_after_update(iface, values)
+
+    def _ext_keys(self):
+        keys = super(PreferenceGroupObjectIO, self)._ext_keys()
+        selection = self._selection
+        if selection is not None:
+            keys = [k for k in keys if k in selection]
+        return keys
+
+    def _query_document(self, plans, depth, fields):
         """
-        Sub-groups are resolved to the actual utility, if it exists and is writable
+        Return the key to cache the external form under (or None) and
+        the shared or cached, undecorated, external form (or None).
         """
-        # We have to update them from the external value as we
-        # get them because simply assigning the attribute on the PrefGroup
-        # does nothing. Because of this, we don't even need to include
-        # subgroups in the result of _ext_all_possible_keys
-        context = self._ext_replacement()
-
-        def _make_resolver(local_name):
-            return lambda _x, _z, local_data: update_from_external_object(getattr(context, local_name), local_data)
-
-        return {
-            local_name: _make_resolver(local_name) for local_name in context.keys()
-        }
-
-    # Note: _ext_setattr winds up doing double-validation (because the
-    # PrefGroup does so as well). But it does add the security of not
-    # being able to set a key that isn't in the interface
+        group = self._ext_replacement()
+        principal = self.principal
+        if depth is None and fields is None \
+                and not has_stored_preferences(group, principal):
+            # Users who have never changed anything all get the same thing
+            document = get_defaults_document(self._plan.id)
+            if document is not None:
+                return None, json.loads(document.body,
+                                        object_pairs_hook=LocatedExternalDict)
+        storage = self._get_storage(create=False)
+        key = document_cache_key(group, principal, storage,
+                                 (depth, _freeze_selection(fields)))
+        if key is None:
+            return None, None
+        body = get_document_cache().get(key, plans)
+        if body is None:
+            return key, None
+        return key, json.loads(body, object_pairs_hook=LocatedExternalDict)
+
+    def toExternalObject(self, mergeFrom=None, depth=None, fields=None, **kwargs):
+        # pylint: disable=arguments-differ
+        if mergeFrom is not None or kwargs.get('request') is None \
+                or not kwargs.get('decorate', True):
+            return self._externalize(mergeFrom, depth, fields, **kwargs)
+        plans = get_preference_group_plans()
+        key, result = self._query_document(plans, depth, fields)
+        if result is None:
+            if key is None:
+                return self._externalize(None, depth, fields, **kwargs)
+            # What's cached can't depend on the request
+            kwargs['decorate'] = False
+            result = self._externalize(None, depth, fields, **kwargs)
+            get_document_cache().set(key, plans, json.dumps(result).encode('utf-8'))
+        _decorate_document(self._ext_replacement(), self._plan, plans,
+                           result, kwargs['request'])
+        return result
 
-    def toExternalObject(self, mergeFrom=None, **kwargs):
-        result = super(PreferenceGroupObjectIO, self).toExternalObject(mergeFrom=mergeFrom, **kwargs)
+    def _externalize(self, mergeFrom, depth, fields, **kwargs):
+        metrics = query_metrics_sink()
+        start = clock() if metrics is not None else None
+        self._values = None
+        self._selection = fields
+        result = super(PreferenceGroupObjectIO, self).toExternalObject(mergeFrom=mergeFrom,
+                                                                       **kwargs)
         context = self._ext_replacement()
-        group_id = context.__id__ or 'Root'
+        plan = self._plan
 
         # Now fixup names
-        # For class, '.' is often used as a delimiter in programming languages, and
-        # we don't want to force everyone to mirror our hierarchy. So we use _.
-        clazz = 'Preference_' + group_id.replace('.', '_')
-        result[StandardExternalFields.CLASS] = clazz
+        result[StandardExternalFields.CLASS] = plan.external_class
+        result[StandardExternalFields.MIMETYPE] = plan.mime_type
 
-        # And similar for mimetype, except we already have
-        # and use a dot convention
-        mimeType = 'application/vnd.nextthought.preference.' + group_id.lower()
-        result[StandardExternalFields.MIMETYPE] = mimeType
-
-        # Last but not least, add any registered sub-groups
+        # Last but not least, add any registered, readable sub-groups
         # (Since they are not added as possible keys, we have to do
-        # this manually. See __external_resolvers__)
-        for local_name, group in context.items():
-            assert local_name not in result, "Invalid group name, developer error"
-            try:
-                _check_read(group.__schema__)
-            except ValueError:
-                pass
-            else:
-                result[local_name] = to_external_object(group)
-
+        # this manually. See updateFromExternalObject). We already know
+        # how to externalize them, so there's no need to go back through
+        # the adapter lookup, but their decorators still run.
+        rendered = 0
+        if depth is None or depth > 0:
+            depth = depth - 1 if depth is not None else None
+            for local_name, group in plan.readable_children:
+                if fields is not None and local_name not in fields:
+                    continue
+                assert local_name not in result, "Invalid group name, developer error"
+                child = group.__bind__(context)
+                io = self.__class__(child, self._principal)
+                external = io._externalize(None, depth,
+                                           fields[local_name] if fields is not None else None,
+                                           **kwargs)
+                _decorate_subgroup(child, external, **kwargs)
+                result[local_name] = external
+                rendered += 1
+
+        if metrics is not None:
+            tags = {'group': plan.id}
+            metrics.timing('externalize', clock() - start, tags)
+            metrics.incr('subgroups_rendered', rendered, tags)
         return result
 
     def updateFromExternalObject(self, parsed, *args, **kwargs):
-        _check_read(self._ext_replacement().__schema__, allow=('write',))
+        if not self._plan.writable:
+            raise ValueError('Unreadable schema')
+        metrics = query_metrics_sink()
+        start = clock() if metrics is not None else None
+        # Sub-groups are updated from their part of the external data
+        # as we find it, because simply assigning the attribute on the
+        # PrefGroup does nothing. The registered children are part of the
+        # plan, so this needs no lookups (or closures).
+        context = self._ext_replacement()
+        children_updated = False
+        for local_name, group in self._plan.children:
+            local_data = parsed.get(local_name)
+            if local_data:
+                # For the same principal, not the interaction's
+                io = self.__class__(group.__bind__(context), self._principal)
+                children_updated = io.updateFromExternalObject(local_data) or children_updated
+        self._ext_updated_names = []
+        self._values = None
         super(PreferenceGroupObjectIO, self).updateFromExternalObject(parsed, *args, **kwargs)
+        names = self._ext_updated_names
+        if metrics is not None:
+            tags = {'group': self._plan.id}
+            metrics.timing('update', clock() - start, tags)
+            metrics.incr('fields_written', len(names), tags)
+        if not names:
+            # Nothing changed here, so no modified events either
+            return children_updated
+        notify(PreferenceGroupUpdatedEvent(self._ext_replacement(),
+                                           self.principal,
+                                           tuple(names)))
+        return True
@@ -3,6 +3,16 @@
 """
 Generation 2 evolver, which migrates user preferences
 
+Users are migrated in batches of :data:`BATCH_SIZE`, committing (and
+minimizing the connection's cache) after each one. The usernames of
+the users to migrate (the keys of the users folder, read without
+loading any user), and the last one migrated, are kept in the
+database root under :data:`CHECKPOINT_KEY` until the generation is
+complete, so an interrupted migration resumes where it stopped.
+
+For large databases, :func:`evolve_users` can be run before starting
+the application, and the generation itself has nothing left to do.
+
 .. $Id$
 """
 
@@ -10,88 +20,165 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from contextlib import contextmanager
+
+from itertools import islice
+
+from persistent import Persistent
+
+from BTrees.OOBTree import OOTreeSet
+
 from zope import component
-from zope import interface
 
 from zope.component.hooks import site, setHooks
 
 from zope.intid.interfaces import IIntIds
 
-from zope.preference.interfaces import IUserPreferences
+from zope.preference.interfaces import IPreferenceGroup
 
 from zope.security.interfaces import IPrincipal
-from zope.security.interfaces import IParticipation
 
-from zope.security.management import newInteraction, endInteraction
+from nti.app.client_preferences.externalization import validate_preference_value
 
-from nti.contentfragments.interfaces import PlainTextContentFragment
+from nti.app.client_preferences.plan import get_preference_group_plans
 
-from nti.dataserver.interfaces import IUser
+from nti.app.client_preferences.storage import get_preference_storage
+from nti.app.client_preferences.storage import store_preference_value
 
-generation = 2
+from nti.app.client_preferences.users import user_keys
+from nti.app.client_preferences.users import iter_users
 
-logger = __import__('logging').getLogger(__name__)
+from nti.contentfragments.interfaces import PlainTextContentFragment
 
+generation = 2
 
-@interface.implementer(IParticipation)
-class _Participation(object):
+#: The key in the database root under which the progress of the
+#: migration is kept.
+CHECKPOINT_KEY = 'nti.app.client_preferences.generations.evolve2'
 
-    __slots__ = ('interaction', 'principal')
+#: The number of users migrated in each transaction.
+BATCH_SIZE = 500
 
-    def __init__(self, principal):
-        self.interaction = None
-        self.principal = principal
+logger = __import__('logging').getLogger(__name__)
 
 
-def migrate_preferences(user):
-    principal = IPrincipal(user)
-    newInteraction(_Participation(principal))
-    try:
-        key = 'nti.dataserver.users.preferences.EntityPreferences'
-        ep = getattr(user, '__annotations__', {}).get(key, None)
-        if ep is None:
-            return
-
-        root_prefs = IUserPreferences(user)
-
-        kalturaPreferFlash = ep.get('webapp_kalturaPreferFlash', None) \
-                          or ep.get('kalturaPreferFlash')
-        if kalturaPreferFlash is not None:
-            webapp = root_prefs.WebApp
-            webapp.preferFlashVideo = kalturaPreferFlash
-
-        presence = ep.get('presence', {})
-        current = presence.get('active')
-        if current and current in presence:
-            status = presence.get(current, {}).get('status')
-            if status:
-                root_prefs.ChatPresence.Active.status = PlainTextContentFragment(status)
-
-        for name in ('Available', 'Away', 'DND'):
-            status = presence.get(name.lower(), {}).get('status')
-            pref_grp = getattr(root_prefs.ChatPresence, name)
-            if status:
-                pref_grp.status = PlainTextContentFragment(status)
-
-        del user.__annotations__[key]
-    finally:
-        endInteraction()
+def _store(plans, storage, group_id, name, value):
+    plan = plans[group_id]
+    value = validate_preference_value(plan, name, value)
+    store_preference_value(plan, storage, name, value)
 
 
-def evolve(context):
+def migrate_preferences(user):
+    """
+    Move the legacy preferences of the *user* into the preference
+    storage. The values are validated and written directly, with the
+    compiled plans; no interaction is needed.
+    """
+    key = 'nti.dataserver.users.preferences.EntityPreferences'
+    ep = getattr(user, '__annotations__', {}).get(key, None)
+    if ep is None:
+        return
+
+    plans = get_preference_group_plans()
+    root = component.getUtility(IPreferenceGroup)
+    storage = get_preference_storage(root, IPrincipal(user))
+
+    kalturaPreferFlash = ep.get('webapp_kalturaPreferFlash', None) \
+                      or ep.get('kalturaPreferFlash')
+    if kalturaPreferFlash is not None:
+        _store(plans, storage, 'WebApp', 'preferFlashVideo', kalturaPreferFlash)
+
+    presence = ep.get('presence', {})
+    current = presence.get('active')
+    if current and current in presence:
+        status = presence.get(current, {}).get('status')
+        if status:
+            _store(plans, storage, 'ChatPresence.Active', 'status',
+                   PlainTextContentFragment(status))
+
+    for name in ('Available', 'Away', 'DND'):
+        status = presence.get(name.lower(), {}).get('status')
+        if status:
+            _store(plans, storage, 'ChatPresence.' + name, 'status',
+                   PlainTextContentFragment(status))
+
+    del user.__annotations__[key]
+
+
+class _Checkpoint(Persistent):
+    """
+    The (sorted) usernames of the users to migrate, and the last one
+    migrated.
+    """
+
+    last = None
+
+    def __init__(self, usernames):
+        self.usernames = usernames
+
+    def next_batch(self, size):
+        if self.last is None:
+            remaining = self.usernames.keys()
+        else:
+            remaining = self.usernames.keys(min=self.last, excludemin=True)
+        return list(islice(remaining, size))
+
+
+@contextmanager
+def _dataserver_site(connection):
     setHooks()
-    ds_folder = context.connection.root()['nti.dataserver']
+    ds_folder = connection.root()['nti.dataserver']
     lsm = ds_folder.getSiteManager()
 
     ds_intid = lsm.getUtility(provided=IIntIds)
     component.provideUtility(ds_intid, IIntIds)
+    try:
+        with site(ds_folder):
+            assert component.getSiteManager() == ds_folder.getSiteManager(), \
+                   "Hooks not installed?"
+            yield ds_folder
+    finally:
+        component.getGlobalSiteManager().unregisterUtility(ds_intid, IIntIds)
+
+
+def _get_checkpoint(connection, ds_folder):
+    """
+    Return the checkpoint of a migration in progress, or start one.
+    """
+    root = connection.root()
+    checkpoint = root.get(CHECKPOINT_KEY)
+    if checkpoint is None:
+        usernames = user_keys(ds_folder)
+        checkpoint = root[CHECKPOINT_KEY] = _Checkpoint(OOTreeSet(usernames))
+        logger.info("Migrating the preferences of up to %d users", len(usernames))
+    return checkpoint
+
+
+def _migrate(connection, checkpoint, batch_size, transaction_manager):
+    ds_folder = connection.root()['nti.dataserver']
+    batch = checkpoint.next_batch(batch_size)
+    while batch:
+        # We minimize the cache ourselves
+        for user in iter_users(ds_folder, len(batch) + 1, batch):
+            migrate_preferences(user)
+        checkpoint.last = batch[-1]
+        transaction_manager.commit()
+        connection.cacheMinimize()
+        logger.info("Migrated the preferences of users up to %s", batch[-1])
+        batch = checkpoint.next_batch(batch_size)
+
+
+def evolve_users(connection, batch_size=BATCH_SIZE):
+    """
+    Migrate the preferences of all users not yet migrated, committing
+    the transaction of *connection* after every *batch_size* users.
+    """
+    with _dataserver_site(connection) as ds_folder:
+        checkpoint = _get_checkpoint(connection, ds_folder)
+        _migrate(connection, checkpoint, batch_size,
+                 connection.transaction_manager)
 
-    with site(ds_folder):
-        assert component.getSiteManager() == ds_folder.getSiteManager(), \
-               "Hooks not installed?"
-        users = ds_folder['users']
-        for user in users.values():
-            if IUser.providedBy(user):
-                migrate_preferences(user)
 
-    component.getGlobalSiteManager().unregisterUtility(ds_intid, IIntIds)
+def evolve(context):
+    evolve_users(context.connection)
+    context.connection.root().pop(CHECKPOINT_KEY, None)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generation 3 evolver, which installs the preference value index in
+the dataserver site and indexes all the users (or, if it is already
+installed, indexes them again).
+
+See :mod:`nti.app.client_preferences.index`.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from nti.app.client_preferences.generations.evolve2 import _dataserver_site
+
+from nti.app.client_preferences.index import index_users
+from nti.app.client_preferences.index import install_preference_value_index
+
+from nti.app.client_preferences.interfaces import IPreferenceValueIndex
+
+from nti.app.client_preferences.users import iter_users
+
+generation = 3
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def evolve(context):
+    with _dataserver_site(context.connection) as ds_folder:
+        registry = ds_folder.getSiteManager()
+        index = registry.queryUtility(IPreferenceValueIndex)
+        if index is None:
+            index = install_preference_value_index(registry)
+        else:
+            index_users(index, iter_users(ds_folder))
+        logger.info("Indexed the preferences of %d users", len(index.ids()))
@@ -15,7 +15,9 @@ from zope.generations.generations import SchemaManager as BaseSchemaManager
 
 from zope.generations.interfaces import IInstallableSchemaManager
 
-generation = 2
+from nti.app.client_preferences.generations import evolve3
+
+generation = 3
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -33,4 +35,6 @@ class SchemaManager(BaseSchemaManager):
             package_name='nti.app.client_preferences.generations')
 
     def install(self, context):
-        pass
+        # A new database has no users yet, but needs the index
+        if 'nti.dataserver' in context.connection.root():
+            evolve3.evolve(context)
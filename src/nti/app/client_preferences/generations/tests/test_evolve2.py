@@ -9,22 +9,36 @@ from __future__ import absolute_import
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
 from hamcrest import assert_that
 
 import fudge
 
 import simplejson as json
 
+from zope import interface
+
 from zope.preference import interfaces as pref_interfaces
 
 from zope.security.interfaces import IPrincipal
+from zope.security.interfaces import IParticipation
+
 from zope.security.management import newInteraction, endInteraction
 
 from nti.app.client_preferences.generations.evolve2 import evolve
-from nti.app.client_preferences.generations.evolve2 import _Participation
+from nti.app.client_preferences.generations.evolve2 import evolve_users
+from nti.app.client_preferences.generations.evolve2 import CHECKPOINT_KEY
+from nti.app.client_preferences.generations.evolve2 import _Checkpoint
+
+from BTrees.OOBTree import OOTreeSet
+
+from nti.app.client_preferences.reader import PreferenceReader
 
 from nti.base.deprecation import hides_warnings
 
+from nti.dataserver.interfaces import IUser
+
 from nti.dataserver.utils.example_database_initializer import ExampleDatabaseInitializer
 
 from nti.dataserver.tests.mock_dataserver import mock_db_trans, WithMockDS
@@ -59,6 +73,16 @@ _user_preferences = """
 from nti.app.client_preferences.tests import PreferenceLayerTest
 
 
+@interface.implementer(IParticipation)
+class _Participation(object):
+
+    __slots__ = ('interaction', 'principal')
+
+    def __init__(self, principal):
+        self.interaction = None
+        self.principal = principal
+
+
 class TestEvolve2(PreferenceLayerTest):
 
     @hides_warnings
@@ -89,17 +113,72 @@ class TestEvolve2(PreferenceLayerTest):
 
             principal = IPrincipal(user)
             newInteraction(_Participation(principal))
-
-            root_prefs = pref_interfaces.IUserPreferences(user)
-            assert_that(root_prefs.WebApp.preferFlashVideo, is_(True))
-
-            assert_that(root_prefs.ChatPresence.Active.status,
+            try:
+                root_prefs = pref_interfaces.IUserPreferences(user)
+                assert_that(root_prefs.WebApp.preferFlashVideo, is_(True))
+
+                assert_that(root_prefs.ChatPresence.Active.status,
+                            is_('Back from lunch'))
+                assert_that(root_prefs.ChatPresence.Available.status,
+                            is_('Back from lunch'))
+                assert_that(root_prefs.ChatPresence.Away.status,
+                            is_('Back from breakfast'))
+                assert_that(root_prefs.ChatPresence.DND.status,
+                            is_('Back from dinner'))
+            finally:
+                endInteraction()
+
+            # And without an interaction
+            reader = PreferenceReader()
+            assert_that(reader.get_value(user, 'WebApp.preferFlashVideo'),
+                        is_(True))
+
+            assert_that(reader.get_value(user, 'ChatPresence.Active.status'),
                         is_('Back from lunch'))
-            assert_that(root_prefs.ChatPresence.Available.status,
+            assert_that(reader.get_value(user, 'ChatPresence.Available.status'),
                         is_('Back from lunch'))
-            assert_that(root_prefs.ChatPresence.Away.status,
+            assert_that(reader.get_value(user, 'ChatPresence.Away.status'),
                         is_('Back from breakfast'))
-            assert_that(root_prefs.ChatPresence.DND.status,
+            assert_that(reader.get_value(user, 'ChatPresence.DND.status'),
                         is_('Back from dinner'))
 
-            endInteraction()
+    @hides_warnings
+    @WithMockDS
+    def test_evolve2_batches_and_resumes(self):
+        key = 'nti.dataserver.users.preferences.EntityPreferences'
+        with mock_db_trans() as conn:
+            context = fudge.Fake().has_attr(connection=conn)
+            initializer = ExampleDatabaseInitializer(max_test_users=5, skip_passwords=True)
+            initializer.install(context)
+
+            ds_folder = context.connection.root()['nti.dataserver']
+            users = ds_folder['users']
+            ordered = []
+            for name, user in users.items():
+                if IUser.providedBy(user):
+                    user.__annotations__[key] = json.loads(_user_preferences)
+                    ordered.append(name)
+            ordered.sort()
+            assert_that(len(ordered) > 3, is_(True))
+
+            # A previous run was interrupted after the first two users.
+            checkpoint = _Checkpoint(OOTreeSet(ordered))
+            checkpoint.last = ordered[1]
+            conn.root()[CHECKPOINT_KEY] = checkpoint
+
+        with mock_db_trans() as conn:
+            evolve_users(conn, batch_size=2)
+            assert_that(conn.root()[CHECKPOINT_KEY].last, is_(ordered[-1]))
+
+            ds_folder = conn.root()['nti.dataserver']
+            for i, name in enumerate(ordered):
+                annotations = ds_folder['users'][name].__annotations__
+                if i < 2:
+                    assert_that(annotations, has_key(key))
+                else:
+                    assert_that(annotations, is_not(has_key(key)))
+
+        with mock_db_trans() as conn:
+            context = fudge.Fake().has_attr(connection=conn)
+            evolve(context)
+            assert_that(conn.root(), is_not(has_key(CHECKPOINT_KEY)))
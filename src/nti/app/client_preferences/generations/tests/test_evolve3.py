@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import greater_than
+from hamcrest import assert_that
+
+import fudge
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.client_preferences.generations.evolve3 import evolve
+
+from nti.app.client_preferences.interfaces import IPreferenceValueIndex
+
+from nti.app.client_preferences.tests import PreferenceLayerTest
+
+from nti.dataserver.interfaces import IUser
+
+from nti.dataserver.utils.example_database_initializer import ExampleDatabaseInitializer
+
+from nti.dataserver.tests.mock_dataserver import mock_db_trans, WithMockDS
+
+
+class TestEvolve3(PreferenceLayerTest):
+
+    @WithMockDS
+    def test_evolve3(self):
+        with mock_db_trans() as conn:
+            context = fudge.Fake().has_attr(connection=conn)
+            ExampleDatabaseInitializer(max_test_users=5, skip_passwords=True).install(context)
+
+        with mock_db_trans() as conn:
+            context = fudge.Fake().has_attr(connection=conn)
+            evolve(context)
+
+        with mock_db_trans() as conn:
+            ds_folder = conn.root()['nti.dataserver']
+            sm = ds_folder.getSiteManager()
+            index = sm.getUtility(IPreferenceValueIndex)
+            users = ds_folder['users']
+            intids = sm.getUtility(IIntIds)
+            expected = [intids.getId(user) for user in users.values()
+                        if IUser.providedBy(user) and intids.queryId(user) is not None]
+            assert_that(expected, has_length(greater_than(0)))
+            # Installed, with everyone
+            assert_that(sorted(index.ids()), is_(sorted(expected)))
+
+        # Running it again indexes everyone again
+        with mock_db_trans() as conn:
+            context = fudge.Fake().has_attr(connection=conn)
+            evolve(context)
+            sm = conn.root()['nti.dataserver'].getSiteManager()
+            index = sm.getUtility(IPreferenceValueIndex)
+            assert_that(sorted(index.ids()), is_(sorted(expected)))
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+An optional inverted index of boolean preference values.
+
+Answering questions like "which users want a digest email and have
+push notifications enabled?" otherwise means loading every user
+and their preferences. When a :class:`PreferenceValueIndex` is
+registered as the :class:`~.IPreferenceValueIndex` utility of a site
+(see :func:`install_preference_value_index`), it is kept up to date as
+preferences are updated from external data, and such questions become
+set operations over intids::
+
+    index = component.getUtility(IPreferenceValueIndex)
+    intids = index.apply(And(Eq('PushNotifications.send_me_push_notifications'),
+                             Eq('PushNotifications.Email.email_a_summary_of_interesting_changes')))
+
+The index holds the values users stored (or that are buffered, see
+:mod:`.writebehind`); a user who never stored a value for a path has
+the default, which is resolved (from the current site) when the index
+is queried, so changing a site default changes the answers at once.
+
+Users are indexed when they are created and whenever one of their
+preference groups is updated from external data (including when
+buffered updates are written), or in bulk with :func:`index_users`.
+:func:`install_preference_value_index` indexes all the users of the
+site, and generation 3 installs the index in the dataserver site.
+Writes made directly through :mod:`zope.preference`, rather than by
+updating from external data, aren't seen; run :func:`index_users`
+after making them.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from functools import reduce
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.intid.interfaces import IIntIds
+from zope.intid.interfaces import IIntIdAddedEvent
+from zope.intid.interfaces import IIntIdRemovedEvent
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.schema.interfaces import IBool
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.client_preferences.interfaces import IPreferenceValueIndex
+from nti.app.client_preferences.interfaces import IPreferenceGroupUpdatedEvent
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import get_default_values
+from nti.app.client_preferences.storage import buffered_preference_values
+from nti.app.client_preferences.storage import query_preference_storage
+
+from nti.dataserver.interfaces import IUser
+
+from nti.app.client_preferences.users import iter_users
+
+from nti.dataserver.users.users import User
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _default_value(path):
+    # The current default of the field at path, or None if there's
+    # no such field
+    group_id, _, name = path.rpartition('.')
+    plan = get_preference_group_plans().get(group_id)
+    if plan is None or name not in plan.fields:
+        return None
+    return bool(get_default_values(plan)[name])
+
+
+@interface.implementer(IPreferenceValueIndex)
+class PreferenceValueIndex(Persistent):
+    """
+    Keeps, for each path, the sets of intids of the users who stored
+    a true and a false value, together with the set of all indexed
+    users (who have the default unless they are in one of those).
+    """
+
+    def __init__(self, family=None):
+        if family is None:
+            family = component.getUtility(IIntIds).family
+        self.family = family
+        self._ids = family.IF.TreeSet()
+        self._true = OOBTree()
+        self._false = OOBTree()
+
+    def _add(self, tree, path, intid):
+        ids = tree.get(path)
+        if ids is None:
+            ids = tree[path] = self.family.IF.TreeSet()
+        ids.insert(intid)
+
+    @staticmethod
+    def _discard(tree, path, intid):
+        ids = tree.get(path)
+        if ids is not None and intid in ids:
+            ids.remove(intid)
+
+    def index_user(self, intid, values):
+        self._ids.insert(intid)
+        for path, value in values.items():
+            if value is None:
+                self._discard(self._true, path, intid)
+                self._discard(self._false, path, intid)
+            elif value:
+                self._add(self._true, path, intid)
+                self._discard(self._false, path, intid)
+            else:
+                self._add(self._false, path, intid)
+                self._discard(self._true, path, intid)
+
+    def unindex_user(self, intid):
+        if intid not in self._ids:
+            return
+        self._ids.remove(intid)
+        for tree in (self._true, self._false):
+            for ids in tree.values():
+                if intid in ids:
+                    ids.remove(intid)
+
+    def __contains__(self, intid):
+        return intid in self._ids
+
+    def ids(self):
+        return self._ids
+
+    def ids_for(self, path, value=True):
+        value = bool(value)
+        if _default_value(path) == value:
+            # Everyone but those who stored the other value
+            others = (self._false if value else self._true).get(path)
+            if others is None:
+                return self._ids
+            return self.family.IF.difference(self._ids, others)
+        ids = (self._true if value else self._false).get(path)
+        return ids if ids is not None else self.family.IF.TreeSet()
+
+    def apply(self, query):
+        return query.apply(self)
+
+
+class Eq(object):
+    """
+    The users whose value at *path* is *value*.
+    """
+
+    def __init__(self, path, value=True):
+        self.path = path
+        self.value = bool(value)
+
+    def apply(self, index):
+        return index.ids_for(self.path, self.value)
+
+
+class And(object):
+    """
+    The users matching all of the *queries*.
+    """
+
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def apply(self, index):
+        intersection = index.family.IF.intersection
+        return reduce(intersection, (q.apply(index) for q in self.queries))
+
+
+class Or(object):
+    """
+    The users matching any of the *queries*.
+    """
+
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def apply(self, index):
+        union = index.family.IF.union
+        return reduce(union, (q.apply(index) for q in self.queries))
+
+
+class Not(object):
+    """
+    The indexed users not matching the *query*.
+    """
+
+    def __init__(self, query):
+        self.query = query
+
+    def apply(self, index):
+        return index.family.IF.difference(index.ids(), self.query.apply(index))
+
+
+def indexed_paths(plan):
+    """
+    Return the paths of the indexed fields of the group described by *plan*.
+    """
+    if not plan.readable or plan.schema is None:
+        return ()
+    prefix = plan.id + '.' if plan.id else ''
+    return tuple(prefix + name for name in plan.fields
+                 if IBool.providedBy(plan.schema[name]))
+
+
+def _indexed_values(plan, storage, principal):
+    # The stored (or buffered) values, or None for defaults
+    paths = indexed_paths(plan)
+    if not paths:
+        return {}
+    values = dict(storage.get(plan.id) or ()) if storage is not None else {}
+    values.update(buffered_preference_values(plan, principal) or ())
+    prefix = len(plan.id) + 1 if plan.id else 0
+    result = {}
+    for path in paths:
+        value = values.get(path[prefix:])
+        result[path] = bool(value) if value is not None else None
+    return result
+
+
+def index_user(index, user, plans=None):
+    """
+    Index all the values of the *user*.
+    """
+    intid = component.getUtility(IIntIds).queryId(user)
+    if intid is None:
+        return
+    plans = get_preference_group_plans() if plans is None else plans
+    principal = IPrincipal(user)
+    root = component.getUtility(IPreferenceGroup)
+    storage = query_preference_storage(root, principal)
+    values = {}
+    for plan in plans.values():
+        values.update(_indexed_values(plan, storage, principal))
+    index.index_user(intid, values)
+
+
+def index_user_group(index, user, plan, principal=None):
+    """
+    Index the values of the group described by *plan* of the *user*,
+    or all of their values if they aren't indexed yet.
+    """
+    intid = component.getUtility(IIntIds).queryId(user)
+    if intid is None:
+        return
+    if intid not in index:
+        index_user(index, user)
+        return
+    principal = IPrincipal(user) if principal is None else principal
+    storage = query_preference_storage(component.getUtility(IPreferenceGroup),
+                                       principal)
+    index.index_user(intid, _indexed_values(plan, storage, principal))
+
+
+def index_users(index, users):
+    """
+    Index all the values of each of the *users*.
+    """
+    plans = get_preference_group_plans()
+    for user in users:
+        if IUser.providedBy(user):
+            index_user(index, user, plans)
+
+
+def install_preference_value_index(registry, family=None, users=None):
+    """
+    Create a :class:`PreferenceValueIndex`, register it in the
+    (persistent) site manager *registry*, and index the *users* (by
+    default, all the users of the dataserver folder that is the site
+    of *registry*). This must be called in that site. Returns the
+    index.
+    """
+    index = PreferenceValueIndex(family)
+    registry.registerUtility(index, IPreferenceValueIndex)
+    if users is None:
+        users = iter_users(registry.__parent__)
+    index_users(index, users)
+    return index
+
+
+@component.adapter(IPreferenceGroupUpdatedEvent)
+def _preference_group_updated(event):
+    index = component.queryUtility(IPreferenceValueIndex)
+    if index is None:
+        return
+    user = User.get_user(event.principal.id)
+    plan = get_preference_group_plans().get(event.object.__id__)
+    if user is not None and plan is not None:
+        index_user_group(index, user, plan, event.principal)
+
+
+@component.adapter(IIntIdAddedEvent)
+def _intid_added(event):
+    if not IUser.providedBy(event.object):
+        return
+    index = component.queryUtility(IPreferenceValueIndex)
+    if index is not None:
+        index_user(index, event.object)
+
+
+@component.adapter(IIntIdRemovedEvent)
+def _intid_removed(event):
+    if not IUser.providedBy(event.object):
+        return
+    index = component.queryUtility(IPreferenceValueIndex)
+    if index is not None:
+        intid = component.getUtility(IIntIds).queryId(event.object)
+        if intid is not None:
+            index.unindex_user(intid)
@@ -24,7 +24,9 @@ Things to remember:
   schema? Because children can be fetched and edited independently,
   settings that are frequently updated together (or not updated when
   other settings are) are a good candidate for a group. When parent
-  data is fetched, all (recursive) children are also fetched. A sub-group
+  data is fetched, all (recursive) children are also fetched, unless
+  the client limits that with the ``depth`` and ``fields`` query
+  parameters (see :func:`.pyramid.PreferencesGetView`). A sub-group
   is the easiest way to introduce modeled preferences that go together; otherwise,
   you are limited to what you can define for the Dict or Mapping types.
 * If you add a group, you must add it to the ZCML file.
@@ -45,15 +47,28 @@ from __future__ import absolute_import
 
 # pylint: disable=inherit-non-class,no-value-for-parameter
 
+from zope.interface import Attribute
 from zope.interface import Interface
+from zope.interface import implementer
 
 from zope.interface.interface import taggedValue
 
+from zope.interface.interfaces import ObjectEvent
+from zope.interface.interfaces import IObjectEvent
+
 from nti.schema.field import Bool
 from nti.schema.field import ValidTextLine
 
 TAG_EXTERNAL_PREFERENCE_GROUP = '__external_preference_group__'
 
+#: A tagged value of a preference schema that, when true, marks the
+#: groups using it as frequently written. When an
+#: :class:`IPreferenceWriteBuffer` is registered, their updates are
+#: buffered and written in the background; see
+#: :mod:`nti.app.client_preferences.writebehind`. Like access, the
+#: first schema in the resolution order with a value decides.
+TAG_VOLATILE_PREFERENCE_GROUP = '__volatile_preference_group__'
+
 
 class IWebAppUserSettings(Interface):
     """
@@ -75,6 +90,9 @@ class IWebAppUserSettings(Interface):
 
 from nti.chatserver.interfaces import IUnattachedPresenceInfo
 IUnattachedPresenceInfo.setTaggedValue(TAG_EXTERNAL_PREFERENCE_GROUP, 'write')
+# The active presence changes far more often than anything else;
+# the presets (below) do not.
+IUnattachedPresenceInfo.setTaggedValue(TAG_VOLATILE_PREFERENCE_GROUP, True)
 
 from nti.contentfragments.interfaces import PlainTextContentFragment
 
@@ -91,8 +109,11 @@ class IChatPresenceSettings(Interface):
     corresponding preset.
 
     When the user picks a preset, the Active group should be updated
-    by copying the preset. If the user customizes their state, those
-    customizations can be recorded in the Active group.
+    by copying the preset; POSTing the name of the preset to the
+    ``@@activate`` view of this group does that in one request (see
+    :class:`.pyramid.ChatPresenceActivateView`). If the user customizes
+    their state, those customizations can be recorded in the Active
+    group.
 
     Subgroups may include: DND, Available, Away (but see the ZCML
     file for definitions).
@@ -114,6 +135,7 @@ class IAvailableChatPresenceSettings(IUnattachedPresenceInfo):
     show = IUnattachedPresenceInfo['show'].bind(None)
     status = IUnattachedPresenceInfo['status'].bind(None)
     taggedValue(TAG_EXTERNAL_PREFERENCE_GROUP, 'write')
+    taggedValue(TAG_VOLATILE_PREFERENCE_GROUP, False)
 
 
 IAvailableChatPresenceSettings['status'].default = PlainTextContentFragment('Available')
@@ -127,6 +149,7 @@ class IAwayChatPresenceSettings(IUnattachedPresenceInfo):
     show = IUnattachedPresenceInfo['show'].bind(None)
     status = IUnattachedPresenceInfo['status'].bind(None)
     taggedValue(TAG_EXTERNAL_PREFERENCE_GROUP, 'write')
+    taggedValue(TAG_VOLATILE_PREFERENCE_GROUP, False)
 
 IAwayChatPresenceSettings['status'].default = PlainTextContentFragment('Away')
 IAwayChatPresenceSettings['show'].default = 'away'
@@ -139,6 +162,7 @@ class IDNDChatPresenceSettings(IUnattachedPresenceInfo):
     show = IUnattachedPresenceInfo['show'].bind(None)
     status = IUnattachedPresenceInfo['status'].bind(None)
     taggedValue(TAG_EXTERNAL_PREFERENCE_GROUP, 'write')
+    taggedValue(TAG_VOLATILE_PREFERENCE_GROUP, False)
 
 
 IDNDChatPresenceSettings['status'].default = PlainTextContentFragment('Do Not Disturb')
@@ -177,15 +201,16 @@ class IPushNotificationSettings(Interface):
     have the advantage of being easily queryable and even editable by
     an administrator.
 
-    Preferences, OTOH, require beginning and ending a zope.security
-    interaction to gain access to. This is complicated to do in normal
-    request processing, and not recommended. However, for an action
-    that might need to send email to tens or hundreds of interested
-    parties, it wouldn't be recommended to do that in
-    request-processing code anyway. Instead, the request processing
-    code should do nothing more then enqueue the event somewhere, and
-    a different process should process this queue, one where beginning
-    and ending interactions should be substantially simpler.
+    Preferences, OTOH, are normally accessed through a zope.security
+    interaction for the user, which is complicated to set up outside
+    of request processing. For an action that might need to send email
+    to tens or hundreds of interested parties, the request processing
+    code should do nothing more than enqueue the event somewhere, and
+    a different process should process this queue. That process needs
+    no interaction: it should read the settings with
+    :class:`nti.app.client_preferences.reader.PreferenceReader`, or
+    :func:`nti.app.client_preferences.notify.should_notify` for many
+    users at once.
     """
     taggedValue(TAG_EXTERNAL_PREFERENCE_GROUP, 'write')
 
@@ -232,3 +257,150 @@ class ISortGroupSettings(Interface):
     Settings to store sorts on various UI views.
     """
     taggedValue(TAG_EXTERNAL_PREFERENCE_GROUP, 'write')
+
+
+class IPreferenceGroupUpdatedEvent(IObjectEvent):
+    """
+    Fired when the values of a preference group (the object) have been
+    updated from external data on behalf of a principal.
+    """
+
+    principal = Attribute(u"The principal whose preferences were updated")
+
+    names = Attribute(u"The names of the fields that were assigned")
+
+
+@implementer(IPreferenceGroupUpdatedEvent)
+class PreferenceGroupUpdatedEvent(ObjectEvent):
+
+    def __init__(self, obj, principal, names=()):
+        super(PreferenceGroupUpdatedEvent, self).__init__(obj)
+        self.principal = principal
+        self.names = names
+
+
+class IPreferenceValueIndex(Interface):
+    """
+    An optional index of the boolean preference values of users, by intid.
+
+    Values are indexed by their path, the id of the preference group
+    and the name of the field joined with a dot (for example,
+    ``PushNotifications.Email.notify_on_mention``). Only the fields of
+    groups that can be read externally are indexed. The index holds
+    the values users stored; queries answer with the effective value,
+    resolving the (current) defaults for everyone else.
+    """
+
+    def index_user(intid, values):
+        """
+        Index the *values*, a mapping from path to the boolean the user
+        with the given intid stored, or None if they have the default.
+        Paths not in *values* are left alone.
+        """
+
+    def unindex_user(intid):
+        """
+        Remove the user from the index.
+        """
+
+    def ids():
+        """
+        Return the set of intids of all indexed users.
+        """
+
+    def ids_for(path, value=True):
+        """
+        Return the set of intids of the indexed users whose effective
+        value at *path* is *value*.
+        """
+
+    def apply(query):
+        """
+        Return the set of intids matching the *query*; see
+        :mod:`nti.app.client_preferences.index`.
+        """
+
+
+class IPreferenceMetricsSink(Interface):
+    """
+    Receives timings and counts from the preference views, the
+    externalizer and the preference storage.
+
+    Register one as a utility to turn instrumentation on; see
+    :mod:`nti.app.client_preferences.metrics`. Most metrics are tagged
+    with the ``group`` id they concern.
+    """
+
+    def timing(name, seconds, tags=None):
+        """
+        Record that one *name* operation took *seconds*.
+        """
+
+    def incr(name, count=1, tags=None):
+        """
+        Add *count* to the counter *name*.
+        """
+
+
+class IPreferenceWriteBuffer(Interface):
+    """
+    Holds the updates of volatile preference groups (see
+    :const:`TAG_VOLATILE_PREFERENCE_GROUP`) until they are written to
+    the preference storage.
+
+    Register one as a utility to turn write-behind on; see
+    :mod:`nti.app.client_preferences.writebehind`. Values are the
+    effective (validated) values of fields, by principal id and group id.
+
+    Buffered values are seen by the externalized groups and by
+    :class:`~nti.app.client_preferences.reader.PreferenceReader`, but
+    not when reading the attributes of a :mod:`zope.preference` group
+    (which reads the storage) until they are written.
+    """
+
+    flush_interval = Attribute(u"The number of seconds between writes to storage")
+
+    def get(principal_id, group_id):
+        """
+        Return a dictionary of the pending values of the group, or None.
+        """
+
+    def has_pending(principal_id):
+        """
+        Return whether any values of the principal are pending.
+        """
+
+    def reserve(principal_id, group_id):
+        """
+        Make room for values of the group, to be added by :meth:`put`
+        once the transaction that updated them commits. Return false if
+        the buffer is full; the values must then be written to storage
+        instead.
+        """
+
+    def release(principal_id, group_id):
+        """
+        Give up a reservation made by :meth:`reserve`, once the
+        transaction that made it has ended (whether or not it
+        committed). Nothing happens if values of the group are pending.
+        """
+
+    def put(principal_id, group_id, values):
+        """
+        Add the *values* (a dictionary) of the group, replacing any
+        pending values of the same fields. This always succeeds for a
+        group that was reserved, even if it has since been written.
+        """
+
+    def pending():
+        """
+        Return a list of ``(principal_id, group_id, values)`` of
+        everything pending. The values are copies.
+        """
+
+    def discard(entries):
+        """
+        Forget the *entries* returned by :meth:`pending`, once they
+        have been written. Values that were replaced in the meantime
+        remain pending.
+        """
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Optional timing and counting of preference operations.
+
+Nothing is recorded unless an
+:class:`~nti.app.client_preferences.interfaces.IPreferenceMetricsSink`
+utility is registered. This module provides two: a
+:class:`StatsdMetricsSink` that sends each metric over UDP, and a
+:class:`MetricsRecorder` that keeps them in memory (for tests).
+
+The metrics, all tagged with the ``group`` id unless noted, are:
+
+``externalize`` (timer)
+    :meth:`~.PreferenceGroupObjectIO.toExternalObject`, including
+    the sub-groups it renders.
+``subgroups_rendered`` (counter)
+    The sub-groups an externalization rendered directly.
+``update`` (timer)
+    :meth:`~.PreferenceGroupObjectIO.updateFromExternalObject`.
+``fields_written`` (counter)
+    The fields an update actually changed.
+``view.get`` and ``view.put`` (timers)
+    The views, also tagged with the ``result`` of a GET
+    (``not_modified``, ``projected``, ``full`` or ``changes``) or the
+    ``method`` of an update.
+``view.batch`` (timer) and ``batch_groups`` (counter)
+    Batch updates, tagged with the ``group`` they were posted to,
+    and the groups they updated.
+``retry`` (counter)
+    Updates that are being retried (as reported by the request's
+    ``retry_attempt``).
+``writes_flushed`` (counter, untagged)
+    Buffered groups written to storage (see :mod:`.writebehind`).
+``conflict_resolved`` and ``conflict`` (counters)
+    Concurrent writes to the preferences of a user that were merged,
+    and the (per group) collisions that couldn't be.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import re
+import time
+import socket
+
+from collections import defaultdict
+
+from zope import component
+from zope import interface
+
+from nti.app.client_preferences.interfaces import IPreferenceMetricsSink
+
+#: The clock used for timings.
+clock = getattr(time, 'perf_counter', time.time)
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def query_metrics_sink():
+    """
+    Return the registered metrics sink, or None if metrics are off.
+    """
+    return component.queryUtility(IPreferenceMetricsSink)
+
+
+@interface.implementer(IPreferenceMetricsSink)
+class MetricsRecorder(object):
+    """
+    Keeps every metric in memory.
+
+    ``timings`` is a list of ``(name, seconds, tags)``, and
+    ``counters`` maps ``(name, tags)`` to the total count, where
+    *tags* is a sorted tuple of ``(key, value)`` pairs.
+    """
+
+    def __init__(self):
+        self.timings = []
+        self.counters = defaultdict(int)
+
+    def timing(self, name, seconds, tags=None):
+        self.timings.append((name, seconds, dict(tags or {})))
+
+    def incr(self, name, count=1, tags=None):
+        self.counters[(name, tuple(sorted((tags or {}).items())))] += count
+
+    def count(self, name, **tags):
+        """
+        Return the total of the counter *name* with exactly the given *tags*.
+        """
+        return self.counters.get((name, tuple(sorted(tags.items()))), 0)
+
+    def timed(self, name, **tags):
+        """
+        Return the number of timings recorded for *name* having the
+        given *tags* (among others).
+        """
+        return len([t for t in self.timings
+                    if t[0] == name and all(t[2].get(k) == v for k, v in tags.items())])
+
+    def clear(self):
+        del self.timings[:]
+        self.counters.clear()
+
+
+_unsafe = re.compile(r'[^A-Za-z0-9_\-]')
+
+
+@interface.implementer(IPreferenceMetricsSink)
+class StatsdMetricsSink(object):
+    """
+    Sends each metric to a statsd server over UDP.
+
+    Plain statsd has no tags, so by default the tag values are
+    appended to the metric name (``preferences.externalize.PushNotifications_Email``).
+    With *dogstatsd*, they are sent as DogStatsD tags instead.
+    Errors sending are ignored.
+    """
+
+    def __init__(self, host='localhost', port=8125,
+                 prefix='nti.preferences', dogstatsd=False):
+        self.address = (host, int(port))
+        self.prefix = prefix + '.' if prefix else ''
+        self.dogstatsd = dogstatsd
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _format(self, name, value, kind, tags):
+        name = self.prefix + name
+        suffix = ''
+        if tags:
+            items = sorted(tags.items())
+            if self.dogstatsd:
+                suffix = '|#' + ','.join('%s:%s' % item for item in items)
+            else:
+                name = '.'.join([name] + [_unsafe.sub('_', str(v)) or '_'
+                                          for _, v in items])
+        return '%s:%s|%s%s' % (name, value, kind, suffix)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, UnicodeError):  # pragma: no cover
+            logger.debug("Failed to send metric %r", data, exc_info=True)
+
+    def timing(self, name, seconds, tags=None):
+        self._send(self._format(name, int(round(seconds * 1000)), 'ms', tags))
+
+    def incr(self, name, count=1, tags=None):
+        self._send(self._format(name, count, 'c', tags))
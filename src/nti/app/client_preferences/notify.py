@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deciding, for many users at once, who wants to be notified of an event.
+
+Whether to email a user about an event depends on two preferences:
+``PushNotifications.send_me_push_notifications``, which overrides
+everything, and the flag for the type of event in
+``PushNotifications.Email``. :func:`should_notify` answers that for a
+whole batch of user intids using the
+:class:`~.index.PreferenceValueIndex`, when one is registered: the
+users that want to be notified are found with set operations over
+the index, and the mask is built from them in one step. Users that
+aren't indexed (or all users, without an index) have their
+preferences read with a :class:`~.reader.PreferenceReader`.
+
+The result is a NumPy boolean array when NumPy is installed (the
+``numpy`` extra), and a list of booleans otherwise.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.client_preferences.interfaces import IPreferenceValueIndex
+
+from nti.app.client_preferences.reader import PreferenceReader
+
+from nti.dataserver.interfaces import IUser
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+#: The path of the preference that overrides all push notifications.
+PUSH_NOTIFICATIONS_PATH = 'PushNotifications.send_me_push_notifications'
+
+#: The path of the email preference for each type of event.
+EMAIL_NOTIFICATION_PATHS = {
+    'mention': 'PushNotifications.Email.notify_on_mention',
+    'reply': 'PushNotifications.Email.immediate_threadable_reply',
+    'digest': 'PushNotifications.Email.email_a_summary_of_interesting_changes',
+}
+
+
+def _read_notify(intids, path):
+    # The users that aren't indexed
+    utility = component.getUtility(IIntIds)
+    reader = PreferenceReader()
+    result = []
+    for intid in intids:
+        user = utility.queryObject(intid)
+        result.append(IUser.providedBy(user)
+                      and bool(reader.get_value(user, PUSH_NOTIFICATIONS_PATH))
+                      and bool(reader.get_value(user, path)))
+    return result
+
+
+def _indexed_notify(index, intids, path):
+    # The indexed users among the intids, and those of them to notify
+    family = index.family
+    requested = family.IF.TreeSet(intids)
+    indexed = family.IF.intersection(index.ids(), requested)
+    wanted = family.IF.intersection(index.ids_for(PUSH_NOTIFICATIONS_PATH),
+                                    index.ids_for(path))
+    return indexed, family.IF.intersection(wanted, indexed)
+
+
+def _numpy_mask(intids, indexed, wanted, path):
+    intids = numpy.array(intids, dtype=numpy.int64)
+    result = numpy.isin(intids, numpy.fromiter(wanted, numpy.int64, len(wanted)))
+    missing = ~numpy.isin(intids, numpy.fromiter(indexed, numpy.int64, len(indexed)))
+    if missing.any():
+        result[missing] = _read_notify(intids[missing].tolist(), path)
+    return result
+
+
+def _list_mask(intids, indexed, wanted, path):
+    indexed = set(indexed)
+    wanted = set(wanted)
+    missing = [intid for intid in intids if intid not in indexed]
+    read = dict(zip(missing, _read_notify(missing, path)))
+    return [intid in wanted if intid in indexed else read[intid]
+            for intid in intids]
+
+
+def should_notify(intids, event_type, index=None):
+    """
+    Return a mask of booleans, one for each of the *intids* (a
+    sequence of user intids), telling whether that user should be
+    emailed about an event of the *event_type* (a key of
+    :data:`EMAIL_NOTIFICATION_PATHS`).
+
+    *index* defaults to the registered
+    :class:`~.interfaces.IPreferenceValueIndex`, if there is one.
+    """
+    try:
+        path = EMAIL_NOTIFICATION_PATHS[event_type]
+    except KeyError:
+        raise ValueError('Unknown event type %s' % event_type)
+    index = component.queryUtility(IPreferenceValueIndex) if index is None else index
+
+    intids = [int(intid) for intid in intids]
+    if index is not None:
+        indexed, wanted = _indexed_notify(index, intids, path)
+    else:
+        indexed = wanted = ()
+    if numpy is not None:
+        return _numpy_mask(intids, indexed, wanted, path)
+    return _list_mask(intids, indexed, wanted, path)
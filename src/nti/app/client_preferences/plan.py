@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compiled externalization plans for preference groups.
+
+The tree of preference groups is defined in ZCML and does not change
+once configuration has been loaded. Everything that
+:class:`~nti.app.client_preferences.externalization.PreferenceGroupObjectIO`
+needs to know about a group that is not user data (whether it is
+readable or writable, its external ``Class`` and ``MimeType``, and
+which of its children should be written out) is therefore computed
+once for each group and kept in an immutable
+:class:`PreferenceGroupPlan`.
+
+Plans are compiled for all the groups registered in a component
+registry at the same time, the first time one of them is needed (for
+the global registry, that's when the database is opened, after
+configuration). They are recompiled if the utility registrations of
+that registry (or one of its bases) change.
+
+Compiling groups the registered groups by parent in a single pass,
+so the plans also serve as an index of the tree: the children of a
+group are found in O(children) (see
+:func:`get_preference_group_children`), where
+:class:`zope.preference.preference.PreferenceGroup` scans every
+registered group.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import weakref
+
+from collections import namedtuple
+
+from zope import component
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.processlifetime import IDatabaseOpenedWithRoot
+
+from zope.schema import getFieldNamesInOrder
+
+from nti.app.client_preferences.interfaces import TAG_EXTERNAL_PREFERENCE_GROUP
+from nti.app.client_preferences.interfaces import TAG_VOLATILE_PREFERENCE_GROUP
+
+#: The tagged values that allow a group to be read.
+READ_ACCESS = ('read', 'write')
+
+#: The tagged values that allow a group to be written.
+WRITE_ACCESS = ('write',)
+
+
+def _has_access(schema, allow):
+    # For the root object, the schema will be missing
+    if schema is None:
+        return True
+    for iface in schema.__iro__:
+        if iface.queryTaggedValue(TAG_EXTERNAL_PREFERENCE_GROUP) in allow:
+            return True
+    return False
+
+
+def _is_volatile(schema):
+    if schema is None:
+        return False
+    for iface in schema.__iro__:
+        volatile = iface.queryTaggedValue(TAG_VOLATILE_PREFERENCE_GROUP)
+        if volatile is not None:
+            return bool(volatile)
+    return False
+
+
+def _field_names(schema):
+    if schema is None:
+        return ()
+    return tuple(name for name in getFieldNamesInOrder(schema)
+                 if not schema[name].queryTaggedValue('_ext_excluded_out', False))
+
+
+class PreferenceGroupPlan(namedtuple('PreferenceGroupPlan',
+                                     ('id',
+                                      'schema',
+                                      'readable',
+                                      'writable',
+                                      'external_class',
+                                      'mime_type',
+                                      'fields',
+                                      'children',
+                                      'readable_children',
+                                      'volatile'))):
+    """
+    The compiled, immutable description of how to externalize one
+    preference group.
+
+    ``fields`` are the names of the schema fields, in order.
+    ``children`` and ``readable_children`` are sequences of ``(local_name,
+    group)`` pairs, where *group* is the registered (unbound) group
+    utility.
+    """
+
+    __slots__ = ()
+
+
+def compile_plan(group_id, schema, children=()):
+    """
+    Compile the plan for the group with the given id and schema,
+    having the given ``(local_name, group)`` children.
+    """
+    name = group_id or 'Root'
+    # For class, '.' is often used as a delimiter in programming languages, and
+    # we don't want to force everyone to mirror our hierarchy. So we use _.
+    external_class = 'Preference_' + name.replace('.', '_')
+    # And similar for mimetype, except we already have
+    # and use a dot convention
+    mime_type = 'application/vnd.nextthought.preference.' + name.lower()
+    readable_children = tuple((local_name, group) for local_name, group in children
+                              if _has_access(group.__schema__, READ_ACCESS))
+    return PreferenceGroupPlan(group_id,
+                               schema,
+                               _has_access(schema, READ_ACCESS),
+                               _has_access(schema, WRITE_ACCESS),
+                               external_class,
+                               mime_type,
+                               _field_names(schema),
+                               tuple(children),
+                               readable_children,
+                               _is_volatile(schema))
+
+
+def _compile_plans(registry):
+    groups = dict(registry.getUtilitiesFor(IPreferenceGroup))
+    children = {}
+    for group_id, group in groups.items():
+        if group_id:
+            parent_id, _, local_name = group_id.rpartition('.')
+            children.setdefault(parent_id, []).append((local_name, group))
+    return {
+        group_id: compile_plan(group_id,
+                               group.__schema__,
+                               sorted(children.get(group_id, ()), key=lambda x: x[0]))
+        for group_id, group in groups.items()
+    }
+
+
+#: utility registry -> (generation, {group id: plan})
+_plans_by_registry = weakref.WeakKeyDictionary()
+
+
+def _registry_generation(utilities):
+    # The utility registry bumps this every time it, or one of its
+    # bases, changes; its own lookup caches depend on it too. Using
+    # it (rather than registration events) means we also notice
+    # ``provideUtility``, which does not send events.
+    return utilities._generation  # pylint: disable=protected-access
+
+
+def get_preference_group_plans(registry=None):
+    """
+    Return a mapping from group id to the :class:`PreferenceGroupPlan` for
+    every group registered in *registry* (by default, the current site manager).
+    """
+    registry = component.getSiteManager() if registry is None else registry
+    utilities = registry.utilities
+    generation = _registry_generation(utilities)
+    cached = _plans_by_registry.get(utilities)
+    if cached is None or cached[0] != generation:
+        cached = (generation, _compile_plans(registry))
+        _plans_by_registry[utilities] = cached
+    return cached[1]
+
+
+def get_preference_group_plan(group):
+    """
+    Return the :class:`PreferenceGroupPlan` for the given preference group.
+
+    Groups that are registered in the current site use the
+    compiled plan. A group object that doesn't match its registration
+    (for example, one created directly rather than from ZCML) gets a
+    plan compiled just for it.
+    """
+    plan = get_preference_group_plans().get(group.__id__)
+    if plan is None or plan.schema is not group.__schema__:
+        children = plan.children if plan is not None else ()
+        plan = compile_plan(group.__id__, group.__schema__, children)
+    return plan
+
+
+def get_preference_group_children(group_id, registry=None):
+    """
+    Return the ``(local_name, group)`` pairs of the children of the
+    group *group_id* registered in *registry* (by default, the
+    current site manager), sorted by name. The groups are unbound.
+    """
+    plan = get_preference_group_plans(registry).get(group_id)
+    return plan.children if plan is not None else ()
+
+
+@component.adapter(IDatabaseOpenedWithRoot)
+def _compile_global_plans(unused_event=None):
+    # Configuration is complete by the time the database is opened;
+    # compile ahead of the first request.
+    get_preference_group_plans(component.getGlobalSiteManager())
+
+
+def clear_preference_group_plans():
+    """
+    Discard all compiled plans. They will be compiled again as needed.
+    """
+    _plans_by_registry.clear()
+
+
+def set_external_preference_group(schema, access):
+    """
+    Set the :const:`~.TAG_EXTERNAL_PREFERENCE_GROUP` of *schema* to
+    *access* (``'read'``, ``'write'``, or anything else to deny
+    access) and discard the plans compiled with the previous value.
+
+    Tagged values can't be watched, so schemas that may already have
+    been used must be changed with this function rather than with
+    ``setTaggedValue``. (Changes made when the schema's module is
+    imported, like those in :mod:`.interfaces`, happen before any plan
+    is compiled.)
+    """
+    schema.setTaggedValue(TAG_EXTERNAL_PREFERENCE_GROUP, access)
+    clear_preference_group_plans()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clear_preference_group_plans)
@@ -10,19 +10,70 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import hashlib
+
+from pyramid import httpexceptions as hexc
+
 from pyramid.view import view_config
 
+from zope import component
+
+from zope.interface import Invalid
+
 from zope.preference.interfaces import IPreferenceGroup
 
+from zope.schema.interfaces import ValidationError
+
 from nti.app.base.abstract_views import AbstractAuthenticatedView
 
+from nti.app.client_preferences.externalization import parse_field_paths
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+from nti.app.client_preferences.externalization import validate_preference_value
+from nti.app.client_preferences.externalization import validate_preference_values
+
+from nti.app.client_preferences.metrics import clock
+from nti.app.client_preferences.metrics import query_metrics_sink
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import get_current_principal
+from nti.app.client_preferences.storage import iter_changed_group_ids
+from nti.app.client_preferences.storage import read_preference_values
+from nti.app.client_preferences.storage import buffered_preference_values
+from nti.app.client_preferences.storage import query_preference_storage
+from nti.app.client_preferences.storage import preference_version_token
+from nti.app.client_preferences.storage import preference_storage_version
+
 from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
 
 from nti.dataserver import authorization as nauth
 
+from nti.externalization.interfaces import StandardExternalFields
+
+from nti.externalization.internalization import update_from_external_object
+
 logger = __import__('logging').getLogger(__name__)
 
 
+def _get_projection(request):
+    """
+    Return the ``depth`` (an int) and ``fields`` (a list of paths)
+    query parameters, either of which may be None.
+    """
+    depth = request.params.get('depth')
+    if depth is not None:
+        try:
+            depth = int(depth)
+        except ValueError:
+            depth = -1
+        if depth < 0:
+            raise hexc.HTTPUnprocessableEntity('Invalid depth')
+    fields = request.params.get('fields')
+    if fields is not None:
+        fields = sorted(set(path.strip() for path in fields.split(',')) - {''})
+    return depth, fields
+
+
 @view_config(route_name='objects.generic.traversal',
              request_method='GET',
              renderer='rest',
@@ -34,9 +85,94 @@ def PreferencesGetView(request):
     # Because we load the ++preference++ traversal namespace,
     # this is available at /path/to/principal/++preference++
     # (and sub-paths, nice! for automatic fetch-in-part)
-    # We should supply etag and/or last modified for this
-    # (does the default etag kick in?)
-    return request.context
+    # The ETag is derived from the stored values of the groups
+    # we're returning, so answering a conditional request
+    # doesn't require externalizing anything.
+    # The ``depth`` and ``fields`` (comma-separated dotted paths of
+    # fields and sub-groups) query parameters limit what is returned;
+    # anything left out isn't externalized.
+    # Every response has a sync token header. Passing it back as the
+    # ``since`` query parameter returns an object with the ``Items``
+    # that changed after it (each group on its own, by relative path)
+    # and the new ``Token``.
+    # The external form is shared by users without stored
+    # preferences, and cached for the others (see
+    # PreferenceGroupObjectIO); either way, the renderer decorates and
+    # serializes it as usual.
+    # When metrics are on, this is timed; note that the
+    # externalization of a full response happens later, in the
+    # renderer (and is timed there by the externalizer).
+    metrics = query_metrics_sink()
+    start = clock() if metrics is not None else None
+    result, kind = _get(request)
+    if metrics is not None:
+        metrics.timing('view.get', clock() - start,
+                       {'group': request.context.__id__, 'result': kind})
+    return result
+
+
+#: The response header of a GET holding the token to pass as
+#: ``since`` to get the groups that change after it.
+SYNC_TOKEN_HEADER = 'X-NTI-Preferences-Token'
+
+
+def _sync_token(storage):
+    # Storage that doesn't keep versions reports everything as
+    # changed, whatever the token.
+    return str(preference_storage_version(storage) or 0)
+
+
+def _changes(request, context, since, storage):
+    """
+    Return the external form of the groups below *context* (and
+    including it) that changed after the token *since*, without
+    their sub-groups, by their path relative to *context*.
+    """
+    try:
+        since = int(since)
+    except ValueError:
+        since = -1
+    if since < 0:
+        raise hexc.HTTPUnprocessableEntity('Invalid since')
+    prefix = len(context.__id__) + 1 if context.__id__ else 0
+    items = {}
+    for group_id in iter_changed_group_ids(context, storage, since):
+        group = context
+        if group_id != context.__id__:
+            group = component.getUtility(IPreferenceGroup, name=group_id)
+            group = group.__bind__(context)
+        io = PreferenceGroupObjectIO(group)
+        items[group_id[prefix:]] = io.toExternalObject(request=request, depth=0)
+    return {'Items': items, 'Token': _sync_token(storage)}
+
+
+def _get(request):
+    context = request.context
+    principal = get_current_principal()
+    storage = query_preference_storage(context, principal)
+    since = request.params.get('since')
+    if since is not None:
+        return _changes(request, context, since, storage), 'changes'
+    request.response.headers[SYNC_TOKEN_HEADER] = _sync_token(storage)
+    depth, fields = _get_projection(request)
+    projected = depth is not None or fields is not None
+    etag = preference_version_token(context)
+    if etag is not None:
+        if projected:
+            projection = repr((depth, fields)).encode('utf-8')
+            etag = etag + '.' + hashlib.md5(projection).hexdigest()[:8]
+        if etag in request.if_none_match:
+            response = hexc.HTTPNotModified(etag=etag)
+            response.headers[SYNC_TOKEN_HEADER] = request.response.headers[SYNC_TOKEN_HEADER]
+            return response, 'not_modified'
+        request.response.etag = etag
+    if not projected:
+        return context, 'full'
+    io = PreferenceGroupObjectIO(context)
+    result = io.toExternalObject(request=request,
+                                 depth=depth,
+                                 fields=parse_field_paths(fields) if fields is not None else None)
+    return result, 'projected'
 
 
 @view_config(route_name='objects.generic.traversal',
@@ -44,6 +180,11 @@ def PreferencesGetView(request):
              renderer='rest',
              context=IPreferenceGroup,
              permission=nauth.ACT_UPDATE)
+@view_config(route_name='objects.generic.traversal',
+             request_method='PATCH',
+             renderer='rest',
+             context=IPreferenceGroup,
+             permission=nauth.ACT_UPDATE)
 class PreferencesPutView(AbstractAuthenticatedView,
                          ModeledContentUploadRequestUtilsMixin):
     # Although this is the UPDATE permission,
@@ -51,6 +192,182 @@ class PreferencesPutView(AbstractAuthenticatedView,
     # implicitly, regardless of traversal path. We could add
     # an ACLProvider (and hook into the zope checker machinery?)
     # but that would be primarily for aesthetics
+    # PUT and PATCH are the same: fields and groups not in the body
+    # are left alone, and fields whose value doesn't change aren't
+    # written, so a PUT of what a GET returned writes nothing.
     def __call__(self):
+        metrics = query_metrics_sink()
+        if metrics is None:
+            return self._do_call()
+        request = self.request
+        tags = {'group': request.context.__id__, 'method': request.method}
+        if getattr(request, 'retry_attempt', 0):
+            metrics.incr('retry', 1, tags)
+        start = clock()
+        try:
+            return self._do_call()
+        finally:
+            metrics.timing('view.put', clock() - start, tags)
+
+    def _do_call(self):
         externalValue = self.readInput()
         return self.updateContentObject(self.request.context, externalValue, notify=False)
+
+
+#: Keys of the external form of a group that are accepted, and
+#: ignored, in the values of a batch update.
+_IGNORED_BATCH_KEYS = (StandardExternalFields.CLASS,
+                       StandardExternalFields.MIMETYPE,
+                       'href')
+
+
+@view_config(route_name='objects.generic.traversal',
+             request_method='POST',
+             renderer='rest',
+             context=IPreferenceGroup,
+             name='batch',
+             permission=nauth.ACT_UPDATE)
+class PreferencesBatchView(AbstractAuthenticatedView,
+                           ModeledContentUploadRequestUtilsMixin):
+    """
+    Update the fields of several groups below the context at once.
+
+    The body is a JSON object whose ``Items`` is a list of objects
+    with a ``path`` (the dotted path of a group, relative to the
+    context; the context itself if empty) and the ``values`` of some
+    of the fields of that group, for example::
+
+        {"Items": [{"path": "WebApp", "values": {"useHighContrast": true}},
+                   {"path": "Sort.books", "values": {"sortOn": "title"}}]}
+
+    Every group and value is validated before anything is written,
+    including the invariants of each group's schema (against the
+    group's values as they would be after the update); if any is
+    invalid, the response is a 422 and nothing changes.
+    Otherwise only those groups are updated (sub-groups are not
+    touched unless they are listed themselves), in the transaction of
+    the request, and the response has ``Items`` mapping each path to
+    the external form of that group, without its sub-groups.
+    """
+
+    def _group_id(self, path):
+        prefix = self.request.context.__id__
+        if not path:
+            return prefix
+        return prefix + '.' + path if prefix else path
+
+    def _validate(self, items):
+        """
+        Return a list of ``(path, plan, values)``, with the values of
+        each group (listed more than once) merged.
+        """
+        if not isinstance(items, list):
+            raise hexc.HTTPUnprocessableEntity('Items must be a list')
+        plans = get_preference_group_plans()
+        by_path = {}
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get('values'), dict):
+                raise hexc.HTTPUnprocessableEntity('Invalid batch item')
+            path = item.get('path') or ''
+            plan = plans.get(self._group_id(path))
+            if plan is None or not plan.writable:
+                raise hexc.HTTPUnprocessableEntity('Invalid preference group %s' % path)
+            values = by_path.setdefault(path, (plan, {}))[1]
+            for name, value in item['values'].items():
+                if name in _IGNORED_BATCH_KEYS:
+                    continue
+                if name not in plan.fields:
+                    raise hexc.HTTPUnprocessableEntity('Invalid preference %s.%s' % (path, name))
+                try:
+                    validate_preference_value(plan, name, value)
+                except ValidationError as e:
+                    raise hexc.HTTPUnprocessableEntity('Invalid value for %s.%s: %s'
+                                                       % (path, name, e))
+                values[name] = value
+        # Then each group as a whole (with its invariants), as it will
+        # be after the update, before anything is written.
+        principal = get_current_principal()
+        storage = query_preference_storage(self.request.context, principal)
+        for path, (plan, values) in by_path.items():
+            if not values:
+                continue
+            current = read_preference_values(plan, storage)
+            current.update(buffered_preference_values(plan, principal) or ())
+            for name, value in values.items():
+                current[name] = validate_preference_value(plan, name, value)
+            try:
+                validate_preference_values(plan, current)
+            except (ValidationError, Invalid) as e:
+                raise hexc.HTTPUnprocessableEntity('Invalid values for %s: %s'
+                                                   % (path, e))
+        return [(path, plan, values) for path, (plan, values) in sorted(by_path.items())]
+
+    def __call__(self):
+        metrics = query_metrics_sink()
+        start = clock() if metrics is not None else None
+        request = self.request
+        context = request.context
+        values = self.readInput()
+        batch = self._validate(values.get('Items') if isinstance(values, dict) else None)
+        result = {}
+        for path, plan, values in batch:
+            group = context
+            if path:
+                group = component.getUtility(IPreferenceGroup, name=plan.id)
+                group = group.__bind__(context)
+            update_from_external_object(group, values, notify=False)
+            io = PreferenceGroupObjectIO(group)
+            result[path] = io.toExternalObject(request=request, depth=0)
+        if metrics is not None:
+            metrics.timing('view.batch', clock() - start,
+                           {'group': context.__id__})
+            metrics.incr('batch_groups', len(batch), {'group': context.__id__})
+        return {'Items': result}
+
+
+#: The group holding the chat presence presets, and the name of the
+#: one of them that is in use. See
+#: :class:`~.interfaces.IChatPresenceSettings`.
+CHAT_PRESENCE_GROUP = 'ChatPresence'
+ACTIVE_CHAT_PRESENCE = 'Active'
+
+
+@view_config(route_name='objects.generic.traversal',
+             request_method='POST',
+             renderer='rest',
+             context=IPreferenceGroup,
+             name='activate',
+             permission=nauth.ACT_UPDATE)
+class ChatPresenceActivateView(AbstractAuthenticatedView,
+                               ModeledContentUploadRequestUtilsMixin):
+    """
+    Make a chat presence preset the active one by copying its values
+    into the ``Active`` group, in one write.
+
+    Only available on the ``ChatPresence`` group. The body is a JSON
+    object with the name of the ``preset`` (e.g., ``Away``); the
+    response is the external form of the ``Active`` group.
+    """
+
+    def __call__(self):
+        request = self.request
+        context = request.context
+        if context.__id__ != CHAT_PRESENCE_GROUP:
+            raise hexc.HTTPNotFound()
+        values = self.readInput()
+        preset = values.get('preset') if isinstance(values, dict) else None
+        plans = get_preference_group_plans()
+        children = dict(plans[CHAT_PRESENCE_GROUP].readable_children)
+        if preset == ACTIVE_CHAT_PRESENCE or preset not in children:
+            raise hexc.HTTPUnprocessableEntity('Invalid preset')
+        active = children[ACTIVE_CHAT_PRESENCE].__bind__(context)
+        active_plan = plans[active.__id__]
+        storage = query_preference_storage(context)
+        preset_values = read_preference_values(plans[children[preset].__id__],
+                                               storage)
+        update_from_external_object(active,
+                                    {name: value for name, value in preset_values.items()
+                                     if name in active_plan.fields},
+                                    notify=False)
+        io = PreferenceGroupObjectIO(active)
+        return io.toExternalObject(request=request, depth=0)
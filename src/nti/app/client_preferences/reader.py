@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Trusted, read-only access to the effective preferences of any user,
+for server-side code such as background workers.
+
+Reading preferences through :mod:`zope.preference` needs a
+:mod:`zope.security` interaction for the user whose preferences they
+are (and may write to the user). A :class:`PreferenceReader` instead
+reads the user's preference storage directly, with the compiled plans
+(see :mod:`.plan`) and the usual default resolution; no interaction,
+security proxies or checks are involved. That's why it is only for
+trusted code: nothing here is used to answer requests, and nothing
+here checks permissions.
+
+A reader holds the plans of the site that is current when it is
+created; create one for each job (or batch of users)::
+
+    reader = PreferenceReader()
+    for user in users:
+        if reader.get_value(user, 'PushNotifications.send_me_push_notifications'):
+            ...
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import query_write_buffer
+from nti.app.client_preferences.storage import read_preference_values
+from nti.app.client_preferences.storage import query_preference_storage
+from nti.app.client_preferences.storage import buffered_preference_values
+
+
+class PreferenceReader(object):
+    """
+    Reads the effective preference values of users in the site
+    manager *registry* (by default, the current one).
+    """
+
+    def __init__(self, registry=None):
+        registry = component.getSiteManager() if registry is None else registry
+        self._plans = get_preference_group_plans(registry)
+        self._root = registry.getUtility(IPreferenceGroup)
+        self._buffer = query_write_buffer()
+
+    def _plan(self, group_id):
+        plan = self._plans.get(group_id)
+        if plan is None:
+            raise KeyError(group_id)
+        return plan
+
+    def _values(self, plan, principal, storage):
+        values = read_preference_values(plan, storage)
+        values.update(buffered_preference_values(plan, principal, self._buffer) or ())
+        return values
+
+    def _storage(self, user):
+        principal = IPrincipal(user)
+        return principal, query_preference_storage(self._root, principal)
+
+    def get_values(self, user, group_id):
+        """
+        Return a dictionary of the effective values of the fields of
+        the group *group_id* for the *user*. Raises :exc:`KeyError`
+        if there is no such group.
+        """
+        plan = self._plan(group_id)
+        principal, storage = self._storage(user)
+        return self._values(plan, principal, storage)
+
+    def get_value(self, user, path):
+        """
+        Return the effective value of the field at *path* (the group id
+        and the field name, joined by a dot) for the *user*.
+        """
+        group_id, _, name = path.rpartition('.')
+        values = self.get_values(user, group_id)
+        return values[name]
+
+    def get_tree(self, user, group_id=''):
+        """
+        Return the effective values of the group *group_id* (by
+        default, the root) and all of its readable children, nested
+        by name, for the *user*.
+        """
+        plan = self._plan(group_id)
+        principal, storage = self._storage(user)
+        return self._tree(plan, principal, storage)
+
+    def _tree(self, plan, principal, storage):
+        result = self._values(plan, principal, storage)
+        for local_name, group in plan.readable_children:
+            result[local_name] = self._tree(self._plans[group.__id__],
+                                            principal, storage)
+        return result
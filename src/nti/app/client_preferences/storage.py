@@ -0,0 +1,739 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Access to the persistent storage behind preference groups.
+
+:mod:`zope.preference` keeps the values of a principal's preferences
+in an annotation of that principal (found by adapting the principal
+and a preference group to
+:class:`~zope.annotation.interfaces.IAnnotations`). The annotation is
+a mapping from group id to a mapping of field values. Simply looking
+at a group through :mod:`zope.preference` creates both of those
+mappings; the query functions here only ever look.
+
+Out of the box, the annotation is a BTree of BTrees, one for every
+group that has ever been looked at. We instead store a single
+:class:`PreferenceStorage` that holds only the values that differ
+from their defaults. It supports the parts of the mapping protocol
+:mod:`zope.preference` uses, so both can read and write it. Existing
+BTree storage is still read, and is converted the first time it is
+written through :func:`get_preference_storage`.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import copy
+import numbers
+import hashlib
+import weakref
+
+import transaction
+
+from transaction.interfaces import IDataManager
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.preference.interfaces import IDefaultPreferenceProvider
+
+from zope.preference.preference import pref_key
+
+from zope.security.management import getInteraction
+
+from ZODB.POSException import ConflictError
+
+from nti.app.client_preferences.interfaces import IPreferenceWriteBuffer
+
+from nti.app.client_preferences.metrics import query_metrics_sink
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+#: The annotation key the preference storage is kept under.
+PREFERENCES_KEY = pref_key
+
+_marker = object()
+
+
+class PreferenceStorage(Persistent):
+    """
+    The stored preference values of one principal, in one persistent
+    object.
+
+    Only values that differ from the effective default are kept (see
+    :func:`store_preference_value`); a group with no such values has
+    no entry at all.
+
+    Every change increments the ``version`` of the storage, and
+    records it as the version of the group that changed (see
+    :meth:`changed_since`).
+    """
+
+    # Instances stored before versions were kept have neither.
+    _version = 0
+    _group_versions = None
+
+    def __init__(self):
+        # group id -> {name: value}
+        self._groups = {}
+        # group id -> the version it last changed in
+        self._group_versions = {}
+
+    @property
+    def version(self):
+        return self._version
+
+    def _changed(self, group_id):
+        if self._group_versions is None:
+            self._group_versions = {}
+        self._version += 1
+        self._group_versions[group_id] = self._version
+        self._p_changed = True
+
+    def changed_since(self, version):
+        """
+        Return the ids of the groups that changed after *version*.
+        """
+        versions = self._group_versions or {}
+        return [group_id for group_id, changed in versions.items()
+                if changed > version]
+
+    def get_value(self, group_id, name, default=None):
+        return self._groups.get(group_id, {}).get(name, default)
+
+    def set_value(self, group_id, name, value):
+        values = self._groups.get(group_id)
+        if values is not None and name in values and values[name] == value:
+            # Don't dirty ourself for nothing
+            return
+        self._groups.setdefault(group_id, {})[name] = value
+        self._changed(group_id)
+
+    def discard_value(self, group_id, name):
+        values = self._groups.get(group_id)
+        if values is None or name not in values:
+            return
+        del values[name]
+        if not values:
+            del self._groups[group_id]
+        self._changed(group_id)
+
+    def group_values(self, group_id):
+        """
+        Return a copy of the values stored for the group.
+        """
+        return dict(self._groups.get(group_id, ()))
+
+    # The mapping protocol, as used by zope.preference.
+    # It asks for the group id in keys(), and if it's not present,
+    # assigns a new empty mapping. We ignore that so that just looking
+    # doesn't store anything.
+
+    def keys(self):
+        return list(self._groups)
+
+    def __contains__(self, group_id):
+        return group_id in self._groups
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __iter__(self):
+        return iter(list(self._groups))
+
+    def get(self, group_id, default=None):
+        if group_id not in self._groups:
+            return default
+        return _GroupValues(self, group_id)
+
+    def __getitem__(self, group_id):
+        return _GroupValues(self, group_id)
+
+    def __setitem__(self, group_id, values):
+        for name, value in values.items():
+            _GroupValues(self, group_id)[name] = value
+
+    def __delitem__(self, group_id):
+        if self._groups.pop(group_id, None) is not None:
+            self._changed(group_id)
+
+    def _p_resolveConflict(self, old, committed, new):
+        """
+        Merge concurrent changes field by field. Only two transactions
+        changing the same field of the same group to different values
+        conflict.
+
+        The groups changed by the transaction being resolved are given
+        versions after those of the committed transaction, so that
+        clients that saw the committed version still see them.
+        """
+        metrics = query_metrics_sink()
+        result = {}
+        for key in set(old) | set(committed) | set(new):
+            if key == '_groups':
+                value = _merge_groups(old.get(key, {}),
+                                      committed.get(key, {}),
+                                      new.get(key, {}),
+                                      metrics)
+            elif key in ('_version', '_group_versions'):
+                continue
+            else:
+                value = _merge_value(old.get(key, _marker),
+                                     committed.get(key, _marker),
+                                     new.get(key, _marker))
+            if value is not _marker:
+                result[key] = value
+        result['_version'], result['_group_versions'] = _merge_versions(old, committed, new)
+        if metrics is not None:
+            metrics.incr('conflict_resolved')
+        return result
+
+
+def _merge_value(old, committed, new):
+    if committed == new or old == new:
+        return committed
+    if old == committed:
+        return new
+    raise ConflictError("Conflicting preference values")
+
+
+def _merge_versions(old, committed, new):
+    old_version = old.get('_version', 0)
+    version = committed.get('_version', 0)
+    versions = dict(committed.get('_group_versions') or {})
+    new_versions = new.get('_group_versions') or {}
+    # Renumber the groups changed on our side, in the order they changed
+    changed = sorted((changed, group_id) for group_id, changed in new_versions.items()
+                     if changed > old_version)
+    for _, group_id in changed:
+        version += 1
+        versions[group_id] = version
+    return version, versions
+
+
+def _merge_groups(old, committed, new, metrics=None):
+    result = {}
+    for group_id in set(old) | set(committed) | set(new):
+        old_values = old.get(group_id, {})
+        committed_values = committed.get(group_id, {})
+        new_values = new.get(group_id, {})
+        values = {}
+        for name in set(old_values) | set(committed_values) | set(new_values):
+            try:
+                value = _merge_value(old_values.get(name, _marker),
+                                     committed_values.get(name, _marker),
+                                     new_values.get(name, _marker))
+            except ConflictError:
+                if metrics is not None:
+                    metrics.incr('conflict', 1, {'group': group_id})
+                raise
+            if value is not _marker:
+                values[name] = value
+        if values:
+            result[group_id] = values
+    return result
+
+
+class _GroupValues(object):
+    """
+    A live mapping view of the values of one group in a :class:`PreferenceStorage`.
+    """
+
+    __slots__ = ('_storage', '_group_id')
+
+    def __init__(self, storage, group_id):
+        self._storage = storage
+        self._group_id = group_id
+
+    def _values(self):
+        return self._storage._groups.get(self._group_id, {})  # pylint: disable=protected-access
+
+    def get(self, name, default=None):
+        return self._values().get(name, default)
+
+    def __getitem__(self, name):
+        return self._values()[name]
+
+    def __contains__(self, name):
+        return name in self._values()
+
+    def __len__(self):
+        return len(self._values())
+
+    def __iter__(self):
+        return iter(list(self._values()))
+
+    def keys(self):
+        return list(self._values())
+
+    def items(self):
+        return list(self._values().items())
+
+    def __setitem__(self, name, value):
+        plan = get_preference_group_plans().get(self._group_id)
+        if plan is not None and name in plan.fields:
+            store_preference_value(plan, self._storage, name, value)
+        else:
+            self._storage.set_value(self._group_id, name, value)
+
+    def __delitem__(self, name):
+        if name not in self._values():
+            raise KeyError(name)
+        self._storage.discard_value(self._group_id, name)
+
+
+def get_current_principal():
+    """
+    The principal whose preferences are in use: the principal of the
+    first participation in the current interaction, just like
+    :mod:`zope.preference`.
+    """
+    return getInteraction().participations[0].principal
+
+
+def query_preference_storage(group, principal=None):
+    """
+    Return the preference storage (a mapping from group id to values)
+    of the *principal*, defaulting to the current principal, or None
+    if the principal has never stored any preferences.
+
+    *group* is any preference group; it is needed to find the
+    annotations. Nothing is ever created.
+    """
+    principal = get_current_principal() if principal is None else principal
+    annotations = component.queryMultiAdapter((principal, group), IAnnotations)
+    if annotations is None:
+        return None
+    return annotations.get(PREFERENCES_KEY)
+
+
+def get_preference_storage(group, principal=None):
+    """
+    Return the :class:`PreferenceStorage` of the *principal*,
+    defaulting to the current principal, creating it if needed. This
+    is for writing; values found in the original BTree storage are
+    moved into it.
+    """
+    principal = get_current_principal() if principal is None else principal
+    annotations = component.getMultiAdapter((principal, group), IAnnotations)
+    storage = annotations.get(PREFERENCES_KEY)
+    if not isinstance(storage, PreferenceStorage):
+        legacy = storage
+        storage = PreferenceStorage()
+        if legacy is not None:
+            for group_id in list(legacy.keys()):
+                storage[group_id] = legacy[group_id]
+        annotations[PREFERENCES_KEY] = storage
+    return storage
+
+
+def query_write_buffer():
+    """
+    Return the registered write buffer, or None if write-behind is
+    off (see :mod:`.writebehind`).
+    """
+    return component.queryUtility(IPreferenceWriteBuffer)
+
+
+@interface.implementer(IDataManager)
+class _PendingWrites(object):
+    """
+    The values of volatile groups updated in a transaction, which are
+    added to the write buffer when (and if) it commits. Either way,
+    the groups reserved for them are released.
+    """
+
+    def __init__(self, buffer, transaction_manager):
+        self.buffer = buffer
+        self.transaction_manager = transaction_manager
+        # (principal id, group id) -> {name: value}
+        self.values = {}
+        self.reserved = set()
+
+    def _release(self):
+        for principal_id, group_id in self.reserved:
+            self.buffer.release(principal_id, group_id)
+        self.reserved.clear()
+        self.values.clear()
+
+    def abort(self, unused_txn):
+        self._release()
+
+    def tpc_begin(self, unused_txn):
+        pass
+
+    def commit(self, unused_txn):
+        pass
+
+    def tpc_vote(self, unused_txn):
+        pass
+
+    def tpc_finish(self, unused_txn):
+        for (principal_id, group_id), values in self.values.items():
+            self.buffer.put(principal_id, group_id, values)
+        self._release()
+
+    def tpc_abort(self, unused_txn):
+        self._release()
+
+    def sortKey(self):
+        # After the database has committed
+        return '~nti.app.client_preferences:%d' % id(self)
+
+    def savepoint(self):
+        return _PendingWritesSavepoint(self)
+
+
+class _PendingWritesSavepoint(object):
+
+    def __init__(self, pending):
+        self.pending = pending
+        self.values = {key: dict(values) for key, values in pending.values.items()}
+
+    def rollback(self):
+        # Still reserved, until the transaction ends
+        self.pending.values = {key: dict(values) for key, values in self.values.items()}
+
+
+def _pending_writes(buffer, create=False):
+    txn = transaction.get()
+    try:
+        return txn.data(buffer)
+    except KeyError:
+        if not create:
+            return None
+    pending = _PendingWrites(buffer, transaction.manager)
+    txn.set_data(buffer, pending)
+    txn.join(pending)
+    return pending
+
+
+def buffer_preference_values(plan, principal, values, buffer):
+    """
+    Add the *values* (a dictionary) of the group described by *plan*
+    that the *principal* updated to the write *buffer* once the
+    current transaction commits; until then, they are only visible in
+    this transaction. Return false, doing nothing, if the buffer is
+    full.
+    """
+    key = (principal.id, plan.id)
+    pending = _pending_writes(buffer)
+    if pending is None or key not in pending.reserved:
+        if not buffer.reserve(*key):
+            return False
+        pending = _pending_writes(buffer, create=True)
+        pending.reserved.add(key)
+    pending.values.setdefault(key, {}).update(values)
+    return True
+
+
+def buffered_preference_values(plan, principal, buffer=_marker):
+    """
+    Return a dictionary of the values of the group described by
+    *plan* that the *principal* updated but that haven't been written
+    to storage yet, or None. This includes values updated in the
+    current transaction.
+    """
+    if not plan.volatile:
+        return None
+    buffer = query_write_buffer() if buffer is _marker else buffer
+    if buffer is None:
+        return None
+    result = buffer.get(principal.id, plan.id)
+    pending = _pending_writes(buffer)
+    values = pending.values.get((principal.id, plan.id)) if pending is not None else None
+    if values:
+        result = dict(result or ())
+        result.update(values)
+    return result
+
+
+def iter_readable_group_ids(group_id):
+    """
+    Iterate the ids of the group and of all its (recursive) readable
+    children; these are the groups an externalized *group_id* contains.
+    """
+    plans = get_preference_group_plans()
+    pending = [group_id]
+    while pending:
+        group_id = pending.pop()
+        yield group_id
+        plan = plans.get(group_id)
+        if plan is not None:
+            pending.extend(child.__id__ for _, child in plan.readable_children)
+
+
+def has_stored_preferences(group, principal=None):
+    """
+    Return whether the *principal*, defaulting to the current principal,
+    has stored any value for *group* or its readable children. If not,
+    the group externalizes to its defaults (see :mod:`.defaults`).
+    """
+    principal = get_current_principal() if principal is None else principal
+    buffer = query_write_buffer()
+    if buffer is not None and buffer.has_pending(principal.id):
+        return True
+    storage = query_preference_storage(group, principal)
+    if not storage:
+        return False
+    return any(storage.get(group_id)
+               for group_id in iter_readable_group_ids(group.__id__))
+
+
+def preference_storage_version(storage):
+    """
+    Return the version of the preference *storage* (0 if it is None),
+    or None if it doesn't keep versions (it's the original BTree
+    storage).
+    """
+    if storage is None:
+        return 0
+    if not isinstance(storage, PreferenceStorage):
+        return None
+    return storage.version
+
+
+def iter_changed_group_ids(group, storage, version):
+    """
+    Iterate the ids of *group* and its readable children (see
+    :func:`iter_readable_group_ids`) that changed in the preference
+    *storage* (which may be None) after *version*. That's all of them
+    if the storage doesn't keep versions, or if *version* is newer
+    than the storage (so it must have come from a different one).
+    """
+    current = preference_storage_version(storage)
+    if current is None or version > current:
+        return iter_readable_group_ids(group.__id__)
+    if storage is None:
+        return iter(())
+    readable = set(iter_readable_group_ids(group.__id__))
+    return iter(sorted(group_id for group_id in storage.changed_since(version)
+                       if group_id in readable))
+
+
+def _stored_items(data):
+    # Empty and missing values externalize the same way, so they
+    # get the same version.
+    if not data:
+        return None
+    result = []
+    for name, value in sorted(data.items()):
+        if isinstance(value, (set, frozenset)):
+            value = sorted(value)
+        result.append((name, value))
+    return result
+
+
+def preference_version_token(group, principal=None):
+    """
+    Return an opaque string that changes whenever the externalized form of
+    *group* (and its readable children) for *principal*, defaulting to the
+    current principal, may have changed. This is cheap: it only needs the
+    (few, non-default) stored values of the groups involved, and their
+    (cached, see :func:`get_default_values`) effective defaults, so it
+    changes when the site's defaults do.
+    """
+    principal = get_current_principal() if principal is None else principal
+    storage = query_preference_storage(group, principal)
+    plans = get_preference_group_plans()
+    buffer = query_write_buffer()
+    parts = [principal.id]
+    for group_id in sorted(iter_readable_group_ids(group.__id__)):
+        plan = plans.get(group_id)
+        schema = plan.schema if plan is not None else group.__schema__
+        parts.append(group_id)
+        parts.append(getattr(schema, '__identifier__', None))
+        data = storage.get(group_id) if storage is not None else None
+        parts.append(_stored_items(data))
+        if plan is not None:
+            parts.append(_stored_items(buffered_preference_values(plan, principal, buffer)))
+            parts.append(_stored_items(get_default_values(plan)))
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _resolve_default_value(plan, name, provider):
+    if provider is None:
+        return plan.schema[name].default
+    return getattr(provider.getDefaultPreferenceGroup(plan.id), name)
+
+
+def _resolve_default_values(plan, provider):
+    return {name: _resolve_default_value(plan, name, provider)
+            for name in plan.fields}
+
+
+def _serial(obj):
+    activate = getattr(obj, '_p_activate', None)
+    if activate is not None:
+        activate()
+    return getattr(obj, '_p_serial', None)
+
+
+def _provider_version(provider, group_id):
+    # The serials of the persistent objects that hold the defaults of
+    # the group: the provider and, for a
+    # zope.preference.default.DefaultPreferenceProvider, its data and
+    # the group's values in it. They change when any process commits a
+    # change to the defaults.
+    if provider is None:
+        return None
+    objects = [provider]
+    data = getattr(provider, 'data', None)
+    if data is not None:
+        objects.append(data)
+        if hasattr(data, 'get'):
+            objects.append(data.get(group_id))
+    return tuple(_serial(obj) for obj in objects)
+
+
+_IMMUTABLE_TYPES = (type(None), numbers.Number, bytes, type(u''), str, frozenset)
+
+
+def _mutable_names(defaults):
+    return tuple(name for name, value in defaults.items()
+                 if not isinstance(value, _IMMUTABLE_TYPES))
+
+
+_defaults_by_registry = weakref.WeakKeyDictionary()
+
+
+def _default_values_entry(plan):
+    # (defaults, names of the mutable ones)
+    provider = component.queryUtility(IDefaultPreferenceProvider)
+    registry = component.getSiteManager()
+    plans = get_preference_group_plans(registry)
+    if plans.get(plan.id) is not plan:
+        # Not a plan of this site
+        defaults = _resolve_default_values(plan, provider)
+        return defaults, _mutable_names(defaults)
+    utilities = registry.utilities
+    cached = _defaults_by_registry.get(utilities)
+    if cached is None or cached[0] is not plans:
+        cached = (plans, {})
+        _defaults_by_registry[utilities] = cached
+    version = _provider_version(provider, plan.id)
+    entry = cached[1].get(plan.id)
+    if entry is None or entry[0] != version:
+        defaults = _resolve_default_values(plan, provider)
+        entry = cached[1][plan.id] = (version, defaults, _mutable_names(defaults))
+    return entry[1], entry[2]
+
+
+def get_default_values(plan):
+    """
+    Return a dictionary of the values all the fields of the group
+    described by *plan* have when the user hasn't stored them (see
+    :func:`get_default_value`). The dictionary, and its values, must
+    not be modified.
+
+    The defaults are resolved once for each group of the current site,
+    and resolved again whenever the plans of the site are compiled
+    again (see :mod:`.plan`), which happens when the utility
+    registrations of the site (or its bases) change, including the
+    registration of default preference providers; or when the
+    (persistent) default preference provider is changed and committed,
+    in any process.
+
+    .. note:: Uncommitted changes to the provider, and changes to the
+       values of a provider that isn't persistent, are not noticed;
+       call :func:`clear_default_values` after making them.
+    """
+    return _default_values_entry(plan)[0]
+
+
+def default_values_version(group_id):
+    """
+    Return an opaque (hashable) value that changes when a committed
+    change to the (persistent) default preference provider may have
+    changed the defaults of the group *group_id* or its readable
+    children. Things built from defaults and cached keep it to know
+    when they are stale, in addition to the plans.
+    """
+    provider = component.queryUtility(IDefaultPreferenceProvider)
+    if provider is None:
+        return None
+    return tuple(_provider_version(provider, child_id)
+                 for child_id in sorted(iter_readable_group_ids(group_id)))
+
+
+def clear_default_values():
+    """
+    Discard all resolved defaults. They will be resolved again as needed.
+    """
+    _defaults_by_registry.clear()
+
+
+def get_default_value(plan, name, provider=_marker):
+    """
+    Return the value the field *name* of the group described by *plan*
+    has when the user hasn't stored one: the value of the site's
+    default preference provider, if there is one, otherwise the schema
+    default. Mutable values are copies.
+    """
+    if provider is _marker:
+        defaults, mutable = _default_values_entry(plan)
+        if name in defaults:
+            value = defaults[name]
+            return copy.deepcopy(value) if name in mutable else value
+        provider = component.queryUtility(IDefaultPreferenceProvider)
+    return _resolve_default_value(plan, name, provider)
+
+
+def get_preference_value(plan, storage, name):
+    """
+    Return the effective value of the field *name* of the group
+    described by *plan*, given the preference *storage* (which may be
+    None) of some principal.
+    """
+    data = storage.get(plan.id) if storage is not None else None
+    value = data.get(name, _marker) if data else _marker
+    if value is _marker:
+        value = get_default_value(plan, name)
+    return value
+
+
+def store_preference_value(plan, storage, name, value):
+    """
+    Store the *value* of the field *name* of the group described by
+    *plan* in the :class:`PreferenceStorage`, or, if the value is the
+    effective default, remove any stored value.
+    """
+    if value == get_default_value(plan, name):
+        storage.discard_value(plan.id, name)
+    else:
+        storage.set_value(plan.id, name, value)
+
+
+def read_preference_values(plan, storage):
+    """
+    Return a dictionary of the effective values of all the fields of
+    the group described by *plan*, given the preference *storage*
+    (which may be None) of some principal.
+    """
+    defaults, mutable = _default_values_entry(plan)
+    result = dict(defaults)
+    data = storage.get(plan.id) if storage is not None else None
+    if data:
+        for name, value in data.items():
+            if name in result:
+                result[name] = value
+    for name in mutable:
+        if result[name] is defaults[name]:
+            # Don't share the cached value
+            result[name] = copy.deepcopy(result[name])
+    return result
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clear_default_values)
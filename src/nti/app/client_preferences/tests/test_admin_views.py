@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods,arguments-differ
+
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import has_item
+from hamcrest import has_entry
+from hamcrest import has_entries
+from hamcrest import assert_that
+
+import io
+import gzip
+
+import fudge
+
+import simplejson as json
+
+from zope import component
+
+from nti.app.client_preferences import admin_views
+
+from nti.app.client_preferences.interfaces import IPreferenceWriteBuffer
+
+from nti.app.client_preferences.writebehind import MemoryPreferenceWriteBuffer
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.app.client_preferences.tests.test_preferences_views import PrefApplicationTestLayer
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.dataserver.users.users import User
+
+
+class TestAdminViews(ApplicationLayerTest):
+    layer = PrefApplicationTestLayer
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_user_preferences(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications/Email'
+        self.testapp.put_json(href, {'notify_on_mention': False})
+
+        res = self.testapp.post_json('/dataserver2/@@UserPreferences',
+                                     {'usernames': ['sjohnson@nextthought.COM', 'nobody@nowhere'],
+                                      'path': 'PushNotifications.Email'})
+        assert_that(res.json_body,
+                    has_entries('Items',
+                                has_entry('sjohnson@nextthought.COM',
+                                          has_entries('notify_on_mention', False,
+                                                      'email_a_summary_of_interesting_changes', True,
+                                                      'immediate_threadable_reply', False)),
+                                'Missing', ['nobody@nowhere']))
+
+        # Readable children are nested
+        res = self.testapp.post_json('/dataserver2/@@UserPreferences',
+                                     {'usernames': ['sjohnson@nextthought.COM'],
+                                      'path': 'PushNotifications'})
+        assert_that(res.json_body['Items']['sjohnson@nextthought.COM'],
+                    has_entries('send_me_push_notifications', True,
+                                'Email', has_entry('notify_on_mention', False)))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_user_preferences_invalid_group(self):
+        self.testapp.post_json('/dataserver2/@@UserPreferences',
+                               {'usernames': ['sjohnson@nextthought.COM'],
+                                'path': 'ZMISettings.Hidden'},
+                               status=422)
+        res = self.testapp.post_json('/dataserver2/@@UserPreferences',
+                                     {'path': 'WebApp'})
+        assert_that(res.json_body, is_({'Items': {}, 'Missing': []}))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_user_preferences_streamed(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            User.create_user(username=u'jason@nextthought.com')
+        buffer = MemoryPreferenceWriteBuffer()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(buffer, IPreferenceWriteBuffer)
+        self.addCleanup(gsm.unregisterUtility, buffer, IPreferenceWriteBuffer)
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/ChatPresence/Active'
+        self.testapp.put_json(href, {'status': u'Out to lunch'})
+        assert_that(len(buffer), is_(1))
+
+        patched = fudge.patch_object(admin_views, 'BATCH_SIZE', 1)
+        self.addCleanup(patched.restore)
+        res = self.testapp.post_json('/dataserver2/@@UserPreferences',
+                                     {'usernames': ['sjohnson@nextthought.COM',
+                                                    'nobody@nowhere',
+                                                    'jason@nextthought.com'],
+                                      'path': 'ChatPresence'})
+        assert_that(res.content_type, is_('application/json'))
+        items = res.json_body['Items']
+        assert_that(sorted(items),
+                    is_(['jason@nextthought.com', 'sjohnson@nextthought.COM']))
+        # Buffered values are included
+        assert_that(items['sjohnson@nextthought.COM'],
+                    has_entry('Active', has_entry('status', 'Out to lunch')))
+        assert_that(items['jason@nextthought.com'],
+                    has_entries('Away', has_entry('status', 'Away'),
+                                'Active', is_not(has_entry('status', 'Out to lunch'))))
+        assert_that(res.json_body['Missing'], is_(['nobody@nowhere']))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_document_cache_stats(self):
+        res = self.testapp.get('/dataserver2/@@PreferenceDocumentCache')
+        assert_that(res.json_body,
+                    has_entries('hits', is_(int),
+                                'hit_rate', is_(float),
+                                'bytes', is_(int)))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_export_user_preferences(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications/Email'
+        self.testapp.put_json(href, {'notify_on_mention': False})
+
+        res = self.testapp.get('/dataserver2/@@ExportUserPreferences')
+        assert_that(res.content_type, is_('application/x-ndjson'))
+        lines = [json.loads(line) for line in res.body.splitlines()]
+        assert_that(lines, has_item(
+            has_entries('Username', 'sjohnson@nextthought.COM',
+                        'Preferences', has_entries(
+                            'Class', 'Preference_Root',
+                            'PushNotifications', has_entry(
+                                'Email', has_entry('notify_on_mention', False))))))
+
+        res = self.testapp.get('/dataserver2/@@ExportUserPreferences',
+                               params={'gzip': 'true'})
+        assert_that(res.content_type, is_('application/gzip'))
+        body = gzip.GzipFile(fileobj=io.BytesIO(res.body)).read()
+        assert_that(len(body.splitlines()), is_(len(lines)))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_bulk_set_user_preferences(self):
+        body = {'usernames': ['sjohnson@nextthought.COM', 'nobody@nowhere'],
+                'path': 'PushNotifications.Email',
+                'values': {'notify_on_mention': False}}
+        res = self.testapp.post_json('/dataserver2/@@BulkSetUserPreferences', body)
+        assert_that(res.json_body,
+                    has_entries('Updated', 1,
+                                'Skipped', 0,
+                                'Missing', ['nobody@nowhere']))
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications/Email'
+        res = self.testapp.get(href)
+        assert_that(res.json_body, has_entry('notify_on_mention', False))
+
+        # Already set
+        res = self.testapp.post_json('/dataserver2/@@BulkSetUserPreferences', body)
+        assert_that(res.json_body, has_entries('Updated', 0,
+                                               'Skipped', 1))
+
+        for path, values in (('ZMISettings.ReadOnly', {}),
+                             ('PushNotifications.Email', {'noSuchField': True}),
+                             ('ChatPresence.Active', {'show': u'bogus'})):
+            self.testapp.post_json('/dataserver2/@@BulkSetUserPreferences',
+                                   {'usernames': ['sjohnson@nextthought.COM'],
+                                    'path': path,
+                                    'values': values},
+                                   status=422)
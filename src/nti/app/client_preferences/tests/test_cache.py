@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import unittest
+
+from nti.app.client_preferences.cache import document_cache_key
+from nti.app.client_preferences.cache import SerializedDocumentCache
+
+from nti.app.client_preferences.storage import PreferenceStorage
+
+
+class Principal(object):
+    id = u'zope.user'
+
+
+class Group(object):
+    __id__ = 'WebApp'
+
+
+class TestSerializedDocumentCache(unittest.TestCase):
+
+    def test_lru(self):
+        plans = {}
+        cache = SerializedDocumentCache(max_bytes=10)
+        cache.set('a', plans, b'aaaa')
+        cache.set('b', plans, b'bbbb')
+        assert_that(cache.get('a', plans), is_(b'aaaa'))
+        # 'b' is now the least recently used
+        cache.set('c', plans, b'cccc')
+        assert_that(cache.get('b', plans), is_(none()))
+        assert_that(cache.get('c', plans), is_(b'cccc'))
+        # Too big to keep at all
+        cache.set('d', plans, b'd' * 11)
+        assert_that(cache.get('d', plans), is_(none()))
+
+        assert_that(cache.stats(),
+                    has_entries('hits', 2,
+                                'misses', 2,
+                                'evictions', 1,
+                                'hit_rate', 0.5,
+                                'entries', 2,
+                                'bytes', 8,
+                                'max_bytes', 10))
+
+    def test_stale_plans(self):
+        cache = SerializedDocumentCache()
+        cache.set('a', {}, b'aaaa')
+        assert_that(cache.get('a', {}), is_(none()))
+        assert_that(cache.stats(), has_entries('entries', 0,
+                                               'bytes', 0))
+
+    def test_key(self):
+        storage = PreferenceStorage()
+        # Never committed
+        assert_that(document_cache_key(Group(), Principal(), storage),
+                    is_(none()))
+        assert_that(document_cache_key(Group(), Principal(), None),
+                    is_(none()))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
+from hamcrest import has_entry
+from hamcrest import assert_that
+from hamcrest import has_entries
+from hamcrest import same_instance
+
+import simplejson as json
+
+from zope.component import getUtility
+from zope.component import provideAdapter
+from zope.component import provideUtility
+from zope.component import getGlobalSiteManager
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.preference import preference
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from nti.app.client_preferences.defaults import get_defaults_document
+
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+
+from nti.app.client_preferences.tests import PreferenceLayerTest
+
+from nti.app.client_preferences.tests.test_externalization import IFolderSettings
+from nti.app.client_preferences.tests.test_externalization import _PrincipalAnnotationFactory
+
+
+class _Principal(object):
+    id = u'zope.user'
+
+
+class TestDefaults(PreferenceLayerTest):
+
+    def test_document(self):
+        document = get_defaults_document('ZMISettings')
+        assert_that(document.external,
+                    has_entries('email', none(),
+                                'skin', 'Rotterdam',
+                                'showZopeLogo', True,
+                                'Class', 'Preference_ZMISettings',
+                                'MimeType', 'application/vnd.nextthought.preference.zmisettings',
+                                'Folder', has_entries('sortedBy', 'name',
+                                                      'shownFields', is_(list))))
+        assert_that(document.external, is_not(has_key('Hidden')))
+        assert_that(json.loads(document.body), is_(document.external))
+
+        assert_that(get_defaults_document('ZMISettings'),
+                    is_(same_instance(document)))
+        assert_that(get_defaults_document('ZMISettings.Hidden'), is_(none()))
+        assert_that(get_defaults_document('No.Such.Group'), is_(none()))
+
+    def test_document_is_external_form_without_storage(self):
+        # What a user who has never stored anything would get
+        provideAdapter(_PrincipalAnnotationFactory,
+                       (_Principal, IPreferenceGroup),
+                       IAnnotations)
+        try:
+            for group_id in ('', 'ZMISettings', 'ZMISettings.Folder'):
+                group = getUtility(IPreferenceGroup, name=group_id)
+                io = PreferenceGroupObjectIO(group, _Principal())
+                assert_that(get_defaults_document(group_id).external,
+                            is_(io.toExternalObject()))
+        finally:
+            getGlobalSiteManager().unregisterAdapter(_PrincipalAnnotationFactory,
+                                                     (_Principal, IPreferenceGroup),
+                                                     IAnnotations)
+
+    def test_rebuilt_when_registrations_change(self):
+        document = get_defaults_document('ZMISettings')
+        group = preference.PreferenceGroup('ZMISettings.Other',
+                                           schema=IFolderSettings,
+                                           title=u"Other Settings")
+        provideUtility(group, IPreferenceGroup, name=group.__id__)
+        try:
+            new_document = get_defaults_document('ZMISettings')
+            assert_that(new_document, is_not(same_instance(document)))
+            assert_that(new_document.external,
+                        has_entry('Other', has_entry('sortedBy', 'name')))
+        finally:
+            getGlobalSiteManager().unregisterUtility(group, IPreferenceGroup,
+                                                     name=group.__id__)
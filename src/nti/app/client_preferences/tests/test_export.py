@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods,arguments-differ
+
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_item
+from hamcrest import has_entry
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import io
+import os
+import gzip
+import shutil
+import tempfile
+
+import fudge
+
+import simplejson as json
+
+from nti.app.client_preferences import export
+
+from nti.app.client_preferences.export import main
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.app.client_preferences.tests.test_preferences_views import PrefApplicationTestLayer
+
+from nti.dataserver.tests import mock_dataserver
+
+
+class _Stdout(object):
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+
+class _Sys(object):
+
+    def __init__(self):
+        self.stdout = _Stdout()
+
+
+class TestExport(ApplicationLayerTest):
+    layer = PrefApplicationTestLayer
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.env_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.env_dir)
+        patched = fudge.patch_object(os, 'environ',
+                                     dict(os.environ, DATASERVER_DIR=self.env_dir))
+        self.addCleanup(patched.restore)
+
+    def _patch_dataserver(self, fake_run, fake_create):
+        fake_create.is_callable().returns(fudge.Fake('context'))
+
+        def run(function=None, **unused_kwargs):
+            with mock_dataserver.mock_db_trans(self.ds):
+                function()
+        fake_run.is_callable().calls(run)
+
+    def _lines(self, data):
+        lines = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+        assert_that(lines, has_item(
+            has_entries('Username', 'sjohnson@nextthought.COM',
+                        'Preferences', has_entry(
+                            'PushNotifications', has_entry(
+                                'Email', has_entry('notify_on_mention', False))))))
+
+    def _set_preference(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications/Email'
+        self.testapp.put_json(href, {'notify_on_mention': False})
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.dataserver.utils.run_with_dataserver',
+                 'nti.dataserver.utils.base_script.create_context')
+    def test_main(self, fake_run, fake_create):
+        self._set_preference()
+        self._patch_dataserver(fake_run, fake_create)
+        path = os.path.join(self.env_dir, 'preferences.jsonl')
+        main([path, '--batch-size', '1'])
+        with open(path, 'rb') as f:
+            self._lines(f.read())
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.dataserver.utils.run_with_dataserver',
+                 'nti.dataserver.utils.base_script.create_context')
+    def test_main_gzip(self, fake_run, fake_create):
+        self._set_preference()
+        self._patch_dataserver(fake_run, fake_create)
+        path = os.path.join(self.env_dir, 'preferences.jsonl.gz')
+        main([path, '--gzip'])
+        with gzip.open(path, 'rb') as f:
+            self._lines(f.read())
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.dataserver.utils.run_with_dataserver',
+                 'nti.dataserver.utils.base_script.create_context')
+    def test_main_stdout(self, fake_run, fake_create):
+        self._set_preference()
+        self._patch_dataserver(fake_run, fake_create)
+        fake_sys = _Sys()
+        patched = fudge.patch_object(export, 'sys', fake_sys)
+        self.addCleanup(patched.restore)
+        main([])
+        # Standard output is left open
+        self._lines(fake_sys.stdout.buffer.getvalue())
+
+        fake_sys = _Sys()
+        patched = fudge.patch_object(export, 'sys', fake_sys)
+        self.addCleanup(patched.restore)
+        main(['-', '--gzip'])
+        stdout = fake_sys.stdout
+        self._lines(gzip.GzipFile(fileobj=io.BytesIO(stdout.buffer.getvalue())).read())
+
+    def test_main_invalid_environment(self):
+        os.environ['DATASERVER_DIR'] = os.path.join(self.env_dir, 'missing')
+        assert_that(calling(main).with_args([]), raises(IOError))
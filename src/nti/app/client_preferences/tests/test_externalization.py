@@ -7,7 +7,10 @@ from __future__ import absolute_import
 
 # pylint: disable=protected-access,too-many-public-methods,inherit-non-class
 
+from hamcrest import is_
 from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
 from hamcrest import assert_that
 from hamcrest import has_entries
 from hamcrest import has_property
@@ -17,14 +20,21 @@ import zope.interface
 
 from zope.component import provideAdapter
 from zope.component import provideUtility
+from zope.component import getGlobalSiteManager
+from zope.component import provideSubscriptionAdapter
 
 from zope.interface.interface import taggedValue
 
 from zope.preference import preference
 from zope.preference.interfaces import IPreferenceGroup
 
+from nti.externalization.interfaces import IExternalObjectDecorator
+
 from nti.externalization.internalization import update_from_external_object
 
+from nti.app.client_preferences.externalization import parse_field_paths
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+
 # First, define a basic preference schema
 
 
@@ -177,6 +187,19 @@ class TestExternalizePreferences(PreferenceLayerTest):
                                              'Class', 'Preference_ZMISettings',
                                              'MimeType', 'application/vnd.nextthought.preference.zmisettings')))
 
+    def test_externalize_is_read_only(self):
+        principal = self.Principal()
+        participation = self.Participation(principal)
+        zope.security.management.newInteraction(participation)
+
+        assert_that(self.settings, externalizes(has_entries('skin', 'Rotterdam')))
+        annotations = AttributeAnnotations(principal)
+        assert_that(annotations.get(preference.pref_key), is_(none()))
+
+        update_from_external_object(self.settings, {'skin': 'Basic'})
+        assert_that(self.settings, externalizes(has_entries('skin', 'Basic')))
+        assert_that(annotations.get(preference.pref_key), is_not(none()))
+
     def test_externalize_sub_prefs(self):
         # When we start with a root object,
         # and there are sub-objects in ZCA,
@@ -194,6 +217,84 @@ class TestExternalizePreferences(PreferenceLayerTest):
                                             has_entries('Class', 'Preference_ZMISettings_Folder',
                                                         'MimeType', 'application/vnd.nextthought.preference.zmisettings.folder'))))
 
+    def test_externalize_sub_prefs_decorated(self):
+        participation = self.Participation(self.Principal())
+        zope.security.management.newInteraction(participation)
+
+        provideUtility(self.settings, IPreferenceGroup,
+                       name=self.settings.__id__)
+        provideUtility(self.folder_settings, IPreferenceGroup,
+                       name=self.folder_settings.__id__)
+
+        @zope.interface.implementer(IExternalObjectDecorator)
+        class Decorator(object):
+
+            def __init__(self, *args):
+                pass
+
+            def decorateExternalObject(self, original, external):
+                external['Decorated'] = original.__id__
+
+        provideSubscriptionAdapter(Decorator, (IPreferenceGroup,),
+                                   IExternalObjectDecorator)
+        try:
+            ext = PreferenceGroupObjectIO(self.settings).toExternalObject()
+            assert_that(ext, has_entries('Folder',
+                                         has_entries('Decorated', 'ZMISettings.Folder')))
+        finally:
+            getGlobalSiteManager().unregisterSubscriptionAdapter(Decorator, (IPreferenceGroup,),
+                                                                 IExternalObjectDecorator)
+
+    def test_update_sub_prefs_for_principal(self):
+        # No interaction; the children are updated for the
+        # principal given, too
+        provideUtility(self.settings, IPreferenceGroup,
+                       name=self.settings.__id__)
+        provideUtility(self.folder_settings, IPreferenceGroup,
+                       name=self.folder_settings.__id__)
+        principal = self.Principal()
+
+        io = PreferenceGroupObjectIO(self.settings, principal)
+        assert_that(io.updateFromExternalObject({'Folder': {'sortedBy': u'size'}}),
+                    is_(True))
+        io = PreferenceGroupObjectIO(self.settings, principal)
+        assert_that(io.toExternalObject(),
+                    has_entries('skin', 'Rotterdam',
+                                'Folder', has_entries('sortedBy', 'size')))
+        annotations = AttributeAnnotations(principal)
+        assert_that(annotations.get(preference.pref_key), is_not(none()))
+
+    def test_parse_field_paths(self):
+        assert_that(parse_field_paths(['WebApp.useHighContrast', 'Sort.courses',
+                                       'Sort.courses.sortOn', 'Sort', ' ', 'Sort.books']),
+                    is_({'WebApp': {'useHighContrast': None},
+                         'Sort': None}))
+        assert_that(parse_field_paths(['Sort.courses.sortOn', 'Sort.courses']),
+                    is_({'Sort': {'courses': None}}))
+
+    def test_externalize_projection(self):
+        participation = self.Participation(self.Principal())
+        zope.security.management.newInteraction(participation)
+
+        provideUtility(self.settings, IPreferenceGroup,
+                       name=self.settings.__id__)
+        provideUtility(self.folder_settings, IPreferenceGroup,
+                       name=self.folder_settings.__id__)
+
+        io = PreferenceGroupObjectIO(self.settings)
+        ext = io.toExternalObject(depth=0)
+        assert_that(ext, has_entries('skin', 'Rotterdam',
+                                     'Class', 'Preference_ZMISettings'))
+        assert_that(ext, is_not(has_key('Folder')))
+
+        io = PreferenceGroupObjectIO(self.settings)
+        ext = io.toExternalObject(fields=parse_field_paths(['skin', 'Folder.sortedBy']))
+        assert_that(ext, has_entries('skin', 'Rotterdam',
+                                     'Folder', has_entries('sortedBy', 'name',
+                                                           'Class', 'Preference_ZMISettings_Folder')))
+        assert_that(ext, is_not(has_key('showZopeLogo')))
+        assert_that(ext['Folder'], is_not(has_key('shownFields')))
+
     def test_update_prefs(self):
         participation = self.Participation(self.Principal())
         zope.security.management.newInteraction(participation)
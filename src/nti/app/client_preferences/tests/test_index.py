@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods,arguments-differ
+
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import has_item
+from hamcrest import contains
+from hamcrest import assert_that
+
+import unittest
+
+import BTrees
+
+import fudge
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.client_preferences.index import Eq
+from nti.app.client_preferences.index import Or
+from nti.app.client_preferences.index import And
+from nti.app.client_preferences.index import Not
+from nti.app.client_preferences.index import PreferenceValueIndex
+from nti.app.client_preferences.index import install_preference_value_index
+
+from nti.app.client_preferences.interfaces import IPreferenceValueIndex
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.app.client_preferences.tests.test_preferences_views import PrefApplicationTestLayer
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.dataserver.users.users import User
+
+MENTION = 'PushNotifications.Email.notify_on_mention'
+PUSH = 'PushNotifications.send_me_push_notifications'
+
+
+class TestPreferenceValueIndex(unittest.TestCase):
+
+    def _makeOne(self):
+        index = PreferenceValueIndex(BTrees.family64)
+        index.index_user(1, {MENTION: True, PUSH: True})
+        index.index_user(2, {MENTION: False, PUSH: True})
+        index.index_user(3, {MENTION: True, PUSH: False})
+        return index
+
+    def test_queries(self):
+        index = self._makeOne()
+        assert_that(list(index.ids_for(MENTION)), contains(1, 3))
+        assert_that(list(index.ids_for(MENTION, False)), contains(2))
+        assert_that(list(index.apply(And(Eq(MENTION), Eq(PUSH)))),
+                    contains(1))
+        assert_that(list(index.apply(Or(Eq(MENTION, False), Eq(PUSH, False)))),
+                    contains(2, 3))
+        assert_that(list(index.apply(Not(Eq(PUSH)))),
+                    contains(3))
+        assert_that(list(index.ids_for('Missing.path')), is_([]))
+
+    def test_reindex_and_unindex(self):
+        index = self._makeOne()
+        index.index_user(1, {MENTION: False})
+        assert_that(list(index.ids_for(MENTION)), contains(3))
+        assert_that(list(index.ids_for(PUSH)), contains(1, 2))
+
+        index.unindex_user(2)
+        index.unindex_user(42)
+        assert_that(list(index.ids()), contains(1, 3))
+        assert_that(list(index.ids_for(PUSH)), contains(1))
+
+    @fudge.patch('nti.app.client_preferences.index._default_value')
+    def test_defaults_resolved_when_querying(self, fake_default):
+        defaults = {PUSH: True}
+        fake_default.is_callable().calls(defaults.get)
+        index = PreferenceValueIndex(BTrees.family64)
+        index.index_user(1, {PUSH: False})
+        index.index_user(2, {PUSH: True})
+        index.index_user(3, {})
+        assert_that(list(index.ids_for(PUSH)), contains(2, 3))
+        assert_that(list(index.ids_for(PUSH, False)), contains(1))
+
+        # The site default changed
+        defaults[PUSH] = False
+        assert_that(list(index.ids_for(PUSH)), contains(2))
+        assert_that(list(index.ids_for(PUSH, False)), contains(1, 3))
+
+        # Back to the default
+        index.index_user(2, {PUSH: None})
+        assert_that(list(index.ids_for(PUSH)), is_([]))
+
+
+class TestIndexMaintenance(ApplicationLayerTest):
+    layer = PrefApplicationTestLayer
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_updated_on_put(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            sm = self.ds.dataserver_folder.getSiteManager()
+            install_preference_value_index(sm, sm.getUtility(IIntIds).family)
+
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications/Email'
+        self.testapp.put_json(href, {'notify_on_mention': False})
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            sm = self.ds.dataserver_folder.getSiteManager()
+            index = sm.getUtility(IPreferenceValueIndex)
+            user = User.get_user('sjohnson@nextthought.COM')
+            intid = sm.getUtility(IIntIds).getId(user)
+            # Defaults apply to everything else
+            assert_that(list(index.ids_for(MENTION, False)), contains(intid))
+            assert_that(list(index.ids_for(PUSH)), has_item(intid))
+
+        self.testapp.put_json(href, {'notify_on_mention': True})
+        with mock_dataserver.mock_db_trans(self.ds):
+            sm = self.ds.dataserver_folder.getSiteManager()
+            index = sm.getUtility(IPreferenceValueIndex)
+            assert_that(list(index.ids_for(MENTION)), has_item(intid))
+            assert_that(list(index.ids_for(MENTION, False)), is_([]))
+            sm.unregisterUtility(index, IPreferenceValueIndex)
+            assert_that(component.queryUtility(IPreferenceValueIndex), is_(None))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_backfill(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications/Email'
+        self.testapp.put_json(href, {'notify_on_mention': False})
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            sm = self.ds.dataserver_folder.getSiteManager()
+            user = User.get_user('sjohnson@nextthought.COM')
+            intid = sm.getUtility(IIntIds).getId(user)
+            index = install_preference_value_index(sm, sm.getUtility(IIntIds).family,
+                                                   users=[user])
+            assert_that(list(index.ids_for(MENTION, False)), contains(intid))
+            sm.unregisterUtility(index, IPreferenceValueIndex)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_installed_with_all_users(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            sm = self.ds.dataserver_folder.getSiteManager()
+            intids = sm.getUtility(IIntIds)
+            index = install_preference_value_index(sm, intids.family)
+            try:
+                user = User.get_user('sjohnson@nextthought.COM')
+                # Never stored anything, so has the defaults
+                assert_that(list(index.ids()), has_item(intids.getId(user)))
+                assert_that(list(index.ids_for(PUSH)), has_item(intids.getId(user)))
+
+                # New users are indexed too
+                new_user = User.create_user(self.ds, username=u'new.user@nextthought.com')
+                new_id = intids.getId(new_user)
+                assert_that(list(index.ids_for(PUSH)), has_item(new_id))
+                assert_that(list(index.ids_for(PUSH, False)), is_not(has_item(new_id)))
+            finally:
+                sm.unregisterUtility(index, IPreferenceValueIndex)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import socket
+import unittest
+
+from zope.annotation.attribute import AttributeAnnotations
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.component import getUtility
+from zope.component import provideAdapter
+from zope.component import provideUtility
+from zope.component import getGlobalSiteManager
+
+from zope.preference.interfaces import IPreferenceGroup
+
+import zope.security.management
+
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+
+from nti.app.client_preferences.interfaces import IPreferenceMetricsSink
+
+from nti.app.client_preferences.metrics import MetricsRecorder
+from nti.app.client_preferences.metrics import StatsdMetricsSink
+
+from nti.app.client_preferences.tests import PreferenceLayerTest
+
+from nti.externalization.internalization import update_from_external_object
+
+
+class TestStatsd(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+
+    def tearDown(self):
+        self.server.close()
+
+    def _received(self):
+        return self.server.recv(1024).decode('utf-8')
+
+    def test_plain(self):
+        sink = StatsdMetricsSink('127.0.0.1', self.server.getsockname()[1])
+        sink.timing('externalize', 0.0123, {'group': 'PushNotifications.Email'})
+        assert_that(self._received(),
+                    is_('nti.preferences.externalize.PushNotifications_Email:12|ms'))
+        sink.incr('fields_written', 2, {'group': 'WebApp'})
+        assert_that(self._received(),
+                    is_('nti.preferences.fields_written.WebApp:2|c'))
+        sink.incr('conflict_resolved')
+        assert_that(self._received(),
+                    is_('nti.preferences.conflict_resolved:1|c'))
+
+    def test_dogstatsd(self):
+        sink = StatsdMetricsSink('127.0.0.1', self.server.getsockname()[1],
+                                 prefix='prefs', dogstatsd=True)
+        sink.incr('view.get', tags={'group': 'Sort.courses', 'result': 'full'})
+        assert_that(self._received(),
+                    is_('prefs.view.get:1|c|#group:Sort.courses,result:full'))
+
+
+class Principal(object):
+    id = u'zope.user'
+
+
+class Participation(object):
+    interaction = None
+
+    def __init__(self, principal):
+        self.principal = principal
+
+
+def _PrincipalAnnotationFactory(prin, unused_group):
+    return AttributeAnnotations(prin)
+
+
+class TestInstrumentation(PreferenceLayerTest):
+
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        provideAdapter(_PrincipalAnnotationFactory,
+                       (Principal, IPreferenceGroup),
+                       IAnnotations)
+        zope.security.management.newInteraction(Participation(Principal()))
+        self.recorder = MetricsRecorder()
+        provideUtility(self.recorder, IPreferenceMetricsSink)
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterUtility(self.recorder, IPreferenceMetricsSink)
+        zope.security.management.endInteraction()
+        super(TestInstrumentation, self).tearDown()
+
+    def test_externalize_and_update(self):
+        recorder = self.recorder
+        group = getUtility(IPreferenceGroup, name='ZMISettings')
+        PreferenceGroupObjectIO(group).toExternalObject()
+        assert_that(recorder.timed('externalize', group='ZMISettings'), is_(1))
+        assert_that(recorder.timed('externalize', group='ZMISettings.Folder'), is_(1))
+        # Folder and ReadOnly, but not Hidden
+        assert_that(recorder.count('subgroups_rendered', group='ZMISettings'), is_(2))
+
+        recorder.clear()
+        update_from_external_object(group, {'skin': u'Basic', 'showZopeLogo': True})
+        assert_that(recorder.timed('update', group='ZMISettings'), is_(1))
+        assert_that(recorder.count('fields_written', group='ZMISettings'), is_(1))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import calling
+from hamcrest import raises
+from hamcrest import assert_that
+
+import BTrees
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.client_preferences.index import PreferenceValueIndex
+
+from nti.app.client_preferences.notify import should_notify
+from nti.app.client_preferences.notify import PUSH_NOTIFICATIONS_PATH
+from nti.app.client_preferences.notify import EMAIL_NOTIFICATION_PATHS
+
+from nti.app.client_preferences.tests import PreferenceLayerTest
+
+from nti.app.client_preferences.tests.test_preferences_views import PrefApplicationTestLayer
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.dataserver.users.users import User
+
+MENTION = EMAIL_NOTIFICATION_PATHS['mention']
+REPLY = EMAIL_NOTIFICATION_PATHS['reply']
+
+
+class TestShouldNotify(PreferenceLayerTest):
+
+    def setUp(self):
+        super(TestShouldNotify, self).setUp()
+        index = self.index = PreferenceValueIndex(BTrees.family64)
+        index.index_user(1, {PUSH_NOTIFICATIONS_PATH: True, MENTION: True, REPLY: False})
+        index.index_user(2, {PUSH_NOTIFICATIONS_PATH: True, MENTION: False, REPLY: True})
+        index.index_user(3, {PUSH_NOTIFICATIONS_PATH: False, MENTION: True, REPLY: True})
+
+    def test_mask(self):
+        mask = should_notify([1, 2, 3], 'mention', self.index)
+        assert_that([bool(x) for x in mask], is_([True, False, False]))
+        mask = should_notify([3, 2, 1, 2], 'reply', self.index)
+        assert_that([bool(x) for x in mask], is_([False, True, False, True]))
+        assert_that(list(should_notify([], 'digest', self.index)), is_([]))
+
+    def test_updated_incrementally(self):
+        self.index.index_user(3, {PUSH_NOTIFICATIONS_PATH: True})
+        mask = should_notify([3], 'mention', self.index)
+        assert_that([bool(x) for x in mask], is_([True]))
+
+    def test_unknown_event(self):
+        assert_that(calling(should_notify).with_args([1], 'poke', self.index),
+                    raises(ValueError))
+
+
+class TestShouldNotifyUnindexed(ApplicationLayerTest):
+    layer = PrefApplicationTestLayer
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_reads_unindexed_users(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications/Email'
+        self.testapp.put_json(href, {'notify_on_mention': False})
+        with mock_dataserver.mock_db_trans(self.ds):
+            intid = component.getUtility(IIntIds).getId(User.get_user('sjohnson@nextthought.COM'))
+            # Without an index, and with an index that doesn't have the user,
+            # the stored opt-out is respected
+            for index in None, PreferenceValueIndex(BTrees.family64):
+                mask = should_notify([intid], 'mention', index)
+                assert_that([bool(x) for x in mask], is_([False]))
+                mask = should_notify([intid], 'digest', index)
+                assert_that([bool(x) for x in mask], is_([True]))
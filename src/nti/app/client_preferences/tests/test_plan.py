@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import is_in
+from hamcrest import is_not
+from hamcrest import has_key
+from hamcrest import contains
+from hamcrest import assert_that
+from hamcrest import has_properties
+from hamcrest import same_instance
+
+from zope import component
+
+from zope.preference import preference
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from nti.app.client_preferences.plan import get_preference_group_plan
+from nti.app.client_preferences.plan import get_preference_group_plans
+from nti.app.client_preferences.plan import get_preference_group_children
+from nti.app.client_preferences.plan import set_external_preference_group
+
+from nti.app.client_preferences.tests import PreferenceLayerTest
+
+from nti.app.client_preferences.tests.test_externalization import IFolderSettings
+from nti.app.client_preferences.tests.test_externalization import IZMIUserSettings
+from nti.app.client_preferences.tests.test_externalization import IReadOnlySettings
+
+
+class TestPlan(PreferenceLayerTest):
+
+    def test_root_plan(self):
+        plan = get_preference_group_plans()['']
+        assert_that(plan,
+                    has_properties('readable', True,
+                                   'writable', True,
+                                   'external_class', 'Preference_Root',
+                                   'mime_type', 'application/vnd.nextthought.preference.root'))
+        names = [name for name, _ in plan.readable_children]
+        for name in ('WebApp', 'ChatPresence', 'PushNotifications', 'Sort'):
+            assert_that(name, is_in(names))
+
+    def test_nested_plan(self):
+        plan = get_preference_group_plans()['PushNotifications.Email']
+        assert_that(plan,
+                    has_properties('external_class', 'Preference_PushNotifications_Email',
+                                   'mime_type', 'application/vnd.nextthought.preference.pushnotifications.email',
+                                   'fields', ('email_a_summary_of_interesting_changes',
+                                              'immediate_threadable_reply',
+                                              'notify_on_mention'),
+                                   'children', ()))
+
+        plan = get_preference_group_plans()['Sort.courses']
+        assert_that([name for name, _ in plan.children],
+                    contains('administered'))
+
+    def test_access(self):
+        plans = get_preference_group_plans()
+        assert_that(plans['ZMISettings.ReadOnly'],
+                    has_properties('readable', True,
+                                   'writable', False))
+        assert_that(plans['ZMISettings.Hidden'],
+                    has_properties('readable', False,
+                                   'writable', False))
+
+        plan = plans['ZMISettings']
+        assert_that([name for name, _ in plan.children],
+                    contains('Folder', 'Hidden', 'ReadOnly'))
+        assert_that([name for name, _ in plan.readable_children],
+                    contains('Folder', 'ReadOnly'))
+
+    def test_access_changed(self):
+        plans = get_preference_group_plans()
+        set_external_preference_group(IReadOnlySettings, 'write')
+        try:
+            new_plans = get_preference_group_plans()
+            assert_that(new_plans, is_not(same_instance(plans)))
+            assert_that(new_plans['ZMISettings.ReadOnly'],
+                        has_properties('readable', True,
+                                       'writable', True))
+        finally:
+            set_external_preference_group(IReadOnlySettings, 'read')
+        assert_that(get_preference_group_plans()['ZMISettings.ReadOnly'],
+                    has_properties('writable', False))
+
+    def test_children(self):
+        children = get_preference_group_children('Sort')
+        assert_that([name for name, _ in children],
+                    contains('books', 'communities', 'courses'))
+        assert_that([group.__id__ for _, group in children],
+                    contains('Sort.books', 'Sort.communities', 'Sort.courses'))
+        assert_that(get_preference_group_children('Sort.courses.administered'),
+                    is_(()))
+        assert_that(get_preference_group_children('No.Such.Group'),
+                    is_(()))
+
+    def test_plans_are_cached(self):
+        assert_that(get_preference_group_plans(),
+                    is_(same_instance(get_preference_group_plans())))
+
+    def test_recompiled_on_registration(self):
+        plans = get_preference_group_plans()
+        assert_that(plans, is_not(has_key('ZMISettings.Extra')))
+
+        group = preference.PreferenceGroup('ZMISettings.Extra',
+                                           schema=IFolderSettings,
+                                           title=u"Extra")
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(group, IPreferenceGroup, name=group.__id__)
+        try:
+            plans = get_preference_group_plans()
+            assert_that(plans, has_key('ZMISettings.Extra'))
+            assert_that('Extra',
+                        is_in([name for name, _ in plans['ZMISettings'].children]))
+        finally:
+            gsm.unregisterUtility(group, IPreferenceGroup, name=group.__id__)
+
+        assert_that(get_preference_group_plans(),
+                    is_not(has_key('ZMISettings.Extra')))
+
+    def test_unregistered_group(self):
+        # A group whose schema doesn't match the registration
+        # gets its own plan, but keeps the registered children.
+        group = preference.PreferenceGroup('ZMISettings',
+                                           schema=IFolderSettings,
+                                           title=u"Not registered")
+        plan = get_preference_group_plan(group)
+        assert_that(plan.schema, is_(same_instance(IFolderSettings)))
+        assert_that(plan.children,
+                    is_(get_preference_group_plans()['ZMISettings'].children))
+
+        group = preference.PreferenceGroup('ZMISettings',
+                                           schema=IZMIUserSettings,
+                                           title=u"Registered")
+        assert_that(get_preference_group_plan(group),
+                    is_(same_instance(get_preference_group_plans()['ZMISettings'])))
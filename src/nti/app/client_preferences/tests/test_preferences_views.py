@@ -9,17 +9,95 @@ from __future__ import absolute_import
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import is_not
 from hamcrest import has_key
 from hamcrest import has_entry
+from hamcrest import has_length
 from hamcrest import has_entries
 from hamcrest import assert_that
 from hamcrest import is_not as does_not
 
+import fudge
+
 from nti.app.testing.application_webtest import ApplicationTestLayer
 from nti.app.testing.application_webtest import ApplicationLayerTest
 
 from nti.app.testing.decorators import WithSharedApplicationMockDS
 
+from zope import component
+from zope import schema
+from zope import interface
+
+from zope.interface.interface import taggedValue
+
+from zope.preference import preference
+
+from zope.preference.interfaces import IPreferenceGroup
+from zope.preference.interfaces import IDefaultPreferenceProvider
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.client_preferences.cache import get_document_cache
+from nti.app.client_preferences.cache import clear_document_cache
+
+from nti.app.client_preferences.storage import query_preference_storage
+
+from nti.externalization.interfaces import IExternalObjectDecorator
+from nti.externalization.interfaces import IExternalMappingDecorator
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.dataserver.users.users import User
+
+
+class _Defaults(object):
+
+    def __init__(self, group_id):
+        self.group_id = group_id
+
+    def __getattr__(self, name):
+        if (self.group_id, name) == ('WebApp', 'useHighContrast'):
+            return True
+        group = component.getUtility(IPreferenceGroup, name=self.group_id)
+        return group.__schema__[name].default
+
+
+class _HighContrastProvider(object):
+    """
+    Site defaults that turn on high contrast.
+    """
+
+    def getDefaultPreferenceGroup(self, group_id=''):
+        return _Defaults(group_id)
+
+
+@interface.implementer(IExternalMappingDecorator, IExternalObjectDecorator)
+class _RequestDecorator(object):
+    """
+    Decorations that depend on the request.
+    """
+
+    def __init__(self, unused_context, request):
+        self.request = request
+
+    def decorateExternalMapping(self, unused_original, external):
+        external['RequestedMapping'] = self.request.params.get('marker')
+
+    def decorateExternalObject(self, unused_original, external):
+        external['RequestedObject'] = self.request.params.get('marker')
+
+
+class IRangeSettings(interface.Interface):
+    taggedValue('__external_preference_group__', 'write')
+
+    low = schema.Int(title=u"Low", default=0)
+    high = schema.Int(title=u"High", default=10)
+
+    @interface.invariant
+    def low_not_above_high(obj):  # pylint: disable=no-self-argument
+        if obj.low > obj.high:
+            raise interface.Invalid("low is above high")
+
 
 class PrefApplicationTestLayer(ApplicationTestLayer):
 
@@ -124,3 +202,311 @@ class TestPreferencesViews(ApplicationLayerTest):
         res = self._fetch_user_url('/++preferences++/ZMISettings')
         assert_that(res.json_body,
                     has_entries('skin', 'Basic'))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_etag(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++'
+        res = self.testapp.get(href)
+        etag = res.headers['ETag']
+        token = res.headers['X-NTI-Preferences-Token']
+
+        res = self.testapp.get(href,
+                               headers={'If-None-Match': etag},
+                               status=304)
+        assert_that(res.headers['X-NTI-Preferences-Token'], is_(token))
+
+        # Changing a value anywhere in the tree changes the tag
+        self.testapp.put_json(href + '/WebApp', {'useHighContrast': True})
+        res = self.testapp.get(href,
+                               headers={'If-None-Match': etag},
+                               status=200)
+        assert_that(res.headers['ETag'], is_not(etag))
+        assert_that(res.json_body,
+                    has_entry('WebApp', has_entry('useHighContrast', True)))
+
+        # But a subtree we didn't change keeps its tag
+        res = self.testapp.get(href + '/Sort')
+        self.testapp.get(href + '/Sort',
+                         headers={'If-None-Match': res.headers['ETag']},
+                         status=304)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_etag_changes_with_defaults(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/WebApp'
+        res = self.testapp.get(href)
+        etag = res.headers['ETag']
+
+        provider = _HighContrastProvider()
+        component.provideUtility(provider, IDefaultPreferenceProvider)
+        try:
+            res = self.testapp.get(href, headers={'If-None-Match': etag})
+            assert_that(res.headers['ETag'], is_not(etag))
+            assert_that(res.json_body, has_entry('useHighContrast', True))
+        finally:
+            component.getGlobalSiteManager().unregisterUtility(provider,
+                                                               IDefaultPreferenceProvider)
+
+    def _stored(self, username='sjohnson@nextthought.COM'):
+        with mock_dataserver.mock_db_trans(self.ds):
+            principal = IPrincipal(User.get_user(username))
+            storage = query_preference_storage(component.getUtility(IPreferenceGroup),
+                                               principal)
+            return None if storage is None else storage.keys()
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_unchanged_put_writes_nothing(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/PushNotifications'
+        res = self.testapp.get(href)
+        self.testapp.put_json(href, res.json_body)
+        assert_that(self._stored(), is_(none()))
+
+        # A partial update writes only what changed
+        self.testapp.patch_json(href + '/Email', {'notify_on_mention': False})
+        assert_that(self._stored(), is_(['PushNotifications.Email']))
+        res = self.testapp.get(href)
+        assert_that(res.json_body,
+                    has_entries('send_me_push_notifications', True,
+                                'Email', has_entries('notify_on_mention', False,
+                                                     'email_a_summary_of_interesting_changes', True)))
+
+        # Setting it back to the default stores nothing again
+        self.testapp.put_json(href, {'Email': {'notify_on_mention': True}})
+        assert_that(self._stored(), is_([]))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_projection(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++'
+        res = self.testapp.get(href, params={'depth': '1'})
+        assert_that(res.json_body,
+                    has_entries('Class', 'Preference_Root',
+                                'PushNotifications', has_entry('send_me_push_notifications', True)))
+        assert_that(res.json_body['PushNotifications'],
+                    does_not(has_key('Email')))
+        etag = res.headers['ETag']
+        self.testapp.get(href, params={'depth': '1'},
+                         headers={'If-None-Match': etag},
+                         status=304)
+        # The whole tree is a different representation
+        res = self.testapp.get(href, headers={'If-None-Match': etag})
+        assert_that(res.headers['ETag'], is_not(etag))
+
+        res = self.testapp.get(href,
+                               params={'fields': 'WebApp.useHighContrast,Sort.courses'})
+        assert_that(res.json_body,
+                    has_entries('WebApp', has_entry('useHighContrast', False),
+                                'Sort', has_entry('courses', has_entry('administered', is_(dict)))))
+        for key in ('ChatPresence', 'PushNotifications', 'ZMISettings'):
+            assert_that(res.json_body, does_not(has_key(key)))
+        assert_that(res.json_body['WebApp'], does_not(has_key('preferFlashVideo')))
+        assert_that(res.json_body['Sort'], does_not(has_key('books')))
+
+        self.testapp.get(href, params={'depth': 'all'}, status=422)
+
+        # None of that stored anything
+        assert_that(self._stored(), is_(none()))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_shared_defaults(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/WebApp'
+        res = self.testapp.get(href)
+        assert_that(res.json_body,
+                    has_entries('href', href,
+                                'Class', 'Preference_WebApp',
+                                'useHighContrast', False))
+        self.testapp.put_json(href, {'useHighContrast': True})
+        res = self.testapp.get(href)
+        assert_that(res.json_body,
+                    has_entries('href', href,
+                                'useHighContrast', True))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_cached_documents(self):
+        clear_document_cache()
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/WebApp'
+        self.testapp.put_json(href, {'useHighContrast': True})
+        hits = get_document_cache().hits
+        for _ in range(2):
+            res = self.testapp.get(href)
+            assert_that(res.json_body,
+                        has_entries('href', href,
+                                    'Class', 'Preference_WebApp',
+                                    'useHighContrast', True))
+        assert_that(get_document_cache().hits, is_(hits + 1))
+
+        # Committing a change gives the storage a new serial
+        self.testapp.put_json(href, {'preferFlashVideo': True})
+        res = self.testapp.get(href)
+        assert_that(res.json_body,
+                    has_entries('useHighContrast', True,
+                                'preferFlashVideo', True))
+        assert_that(get_document_cache().hits, is_(hits + 1))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_cached_documents_rendered(self):
+        # What comes from the cache is rendered just like what doesn't
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/'
+        self.testapp.put_json(href + 'WebApp', {'useHighContrast': True})
+        for path in ('', 'WebApp', 'ChatPresence?depth=1'):
+            clear_document_cache()
+            hits = get_document_cache().hits
+            rendered = self.testapp.get(href + path)
+            cached = self.testapp.get(href + path)
+            assert_that(get_document_cache().hits, is_(hits + 1))
+            assert_that(cached.content_type, is_(rendered.content_type))
+            assert_that(cached.body, is_(rendered.body))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_shared_and_cached_documents_decorated_per_request(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/'
+        gsm = component.getGlobalSiteManager()
+        for provided in IExternalMappingDecorator, IExternalObjectDecorator:
+            gsm.registerSubscriptionAdapter(_RequestDecorator,
+                                            (IPreferenceGroup, interface.Interface),
+                                            provided)
+        try:
+            # First with the shared defaults document, then with the cache
+            for _ in range(2):
+                self.testapp.get(href, params={'marker': 'first'})
+                served = self.testapp.get(href, params={'marker': 'second'}).json_body
+                assert_that(served,
+                            has_entries('RequestedMapping', 'second',
+                                        'WebApp', has_entries('RequestedMapping', 'second',
+                                                              'RequestedObject', 'second')))
+                # Externalized again, without either
+                with fudge.patch('nti.app.client_preferences.externalization.get_defaults_document',
+                                 'nti.app.client_preferences.externalization.document_cache_key') \
+                        as (fake_defaults, fake_key):
+                    fake_defaults.is_callable().returns(None)
+                    fake_key.is_callable().returns(None)
+                    rendered = self.testapp.get(href, params={'marker': 'second'}).json_body
+                assert_that(served, is_(rendered))
+                self.testapp.put_json(href + 'WebApp', {'useHighContrast': True})
+        finally:
+            for provided in IExternalMappingDecorator, IExternalObjectDecorator:
+                gsm.unregisterSubscriptionAdapter(_RequestDecorator,
+                                                  (IPreferenceGroup, interface.Interface),
+                                                  provided)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_batch(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++'
+        res = self.testapp.post_json(href + '/@@batch',
+                                     {'Items': [{'path': 'WebApp',
+                                                 'values': {'useHighContrast': True}},
+                                                {'path': 'Sort.books',
+                                                 'values': {'sortOn': u'title'}},
+                                                {'path': 'PushNotifications.Email',
+                                                 'values': {'notify_on_mention': False,
+                                                            'Class': 'Preference_PushNotifications_Email'}}]})
+        assert_that(res.json_body['Items'],
+                    has_entries('WebApp', has_entry('useHighContrast', True),
+                                'Sort.books', has_entry('sortOn', 'title'),
+                                'PushNotifications.Email', has_entry('notify_on_mention', False)))
+        assert_that(res.json_body['Items'], does_not(has_key('Sort')))
+        assert_that(sorted(self._stored()),
+                    is_(['PushNotifications.Email', 'Sort.books', 'WebApp']))
+
+        # Relative to the context
+        res = self.testapp.post_json(href + '/Sort/@@batch',
+                                     {'Items': [{'path': 'books',
+                                                 'values': {'sortOrder': u'descending'}}]})
+        assert_that(res.json_body['Items'],
+                    has_entry('books', has_entries('sortOn', 'title',
+                                                   'sortOrder', 'descending')))
+
+        # Anything invalid and nothing is written
+        for items in ([{'path': 'WebApp', 'values': {'useHighContrast': False}},
+                       {'path': 'No.Such', 'values': {}}],
+                      [{'path': 'WebApp', 'values': {'useHighContrast': False}},
+                       {'path': 'ZMISettings.ReadOnly', 'values': {}}],
+                      [{'path': 'WebApp', 'values': {'useHighContrast': False}},
+                       {'path': 'Sort.books', 'values': {'noSuchField': 1}}],
+                      [{'path': 'WebApp', 'values': {'useHighContrast': False}},
+                       {'path': 'ChatPresence.Active', 'values': {'show': u'bogus'}}],
+                      {'path': 'WebApp'}):
+            self.testapp.post_json(href + '/@@batch', {'Items': items}, status=422)
+        res = self.testapp.get(href + '/WebApp')
+        assert_that(res.json_body, has_entry('useHighContrast', True))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_batch_invariants(self):
+        group = preference.PreferenceGroup('ZMISettings.Range',
+                                           schema=IRangeSettings,
+                                           title=u"Range")
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(group, IPreferenceGroup, name=group.__id__)
+        self.addCleanup(gsm.unregisterUtility, group, IPreferenceGroup,
+                        name=group.__id__)
+
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++'
+        res = self.testapp.post_json(href + '/@@batch',
+                                     {'Items': [{'path': 'ZMISettings.Range',
+                                                 'values': {'low': 5}}]})
+        assert_that(res.json_body['Items'],
+                    has_entry('ZMISettings.Range', has_entries('low', 5, 'high', 10)))
+
+        # The second group breaks its invariant, given its stored
+        # values; the first isn't written either
+        self.testapp.post_json(href + '/@@batch',
+                               {'Items': [{'path': 'WebApp',
+                                           'values': {'useHighContrast': True}},
+                                          {'path': 'ZMISettings.Range',
+                                           'values': {'high': 3}}]},
+                               status=422)
+        res = self.testapp.get(href + '/WebApp')
+        assert_that(res.json_body, has_entry('useHighContrast', False))
+        res = self.testapp.get(href + '/ZMISettings/Range')
+        assert_that(res.json_body, has_entries('low', 5, 'high', 10))
+
+        # Both at once are fine
+        res = self.testapp.post_json(href + '/@@batch',
+                                     {'Items': [{'path': 'ZMISettings.Range',
+                                                 'values': {'high': 3, 'low': 1}}]})
+        assert_that(res.json_body['Items'],
+                    has_entry('ZMISettings.Range', has_entries('low', 1, 'high', 3)))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_activate_chat_presence(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/ChatPresence'
+        self.testapp.put_json(href + '/Away', {'status': u'Out to lunch'})
+        res = self.testapp.post_json(href + '/@@activate', {'preset': 'Away'})
+        assert_that(res.json_body,
+                    has_entries('Class', 'Preference_ChatPresence_Active',
+                                'show', 'away',
+                                'status', 'Out to lunch'))
+        assert_that(res.json_body, does_not(has_key('Away')))
+        res = self.testapp.get(href + '/Active')
+        assert_that(res.json_body, has_entries('show', 'away',
+                                               'status', 'Out to lunch'))
+
+        res = self.testapp.post_json(href + '/@@activate', {'preset': 'DND'})
+        assert_that(res.json_body, has_entries('show', 'dnd',
+                                               'status', 'Do Not Disturb'))
+
+        for preset in ('Active', 'Busy', None):
+            self.testapp.post_json(href + '/@@activate', {'preset': preset}, status=422)
+        self.testapp.post_json(href + '/Away/@@activate', {'preset': 'DND'}, status=404)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_changes_since(self):
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++'
+        res = self.testapp.get(href)
+        token = res.headers['X-NTI-Preferences-Token']
+        res = self.testapp.get(href, params={'since': token})
+        assert_that(res.json_body, is_({'Items': {}, 'Token': token}))
+
+        self.testapp.put_json(href + '/Sort/books', {'sortOn': u'title'})
+        self.testapp.put_json(href + '/WebApp', {'useHighContrast': True})
+        res = self.testapp.get(href, params={'since': token})
+        assert_that(res.json_body['Items'],
+                    has_entries('Sort.books', has_entry('sortOn', 'title'),
+                                'WebApp', has_entry('useHighContrast', True)))
+        assert_that(res.json_body['Items'], has_length(2))
+        token = res.json_body['Token']
+
+        self.testapp.put_json(href + '/Sort/books', {'sortOn': None})
+        res = self.testapp.get(href + '/Sort', params={'since': token})
+        assert_that(list(res.json_body['Items']), is_(['books']))
+        assert_that(res.json_body['Items']['books'], has_entry('sortOn', none()))
+
+        self.testapp.get(href, params={'since': 'yesterday'}, status=422)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods,arguments-differ
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import calling
+from hamcrest import raises
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+from zope import component
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.security.interfaces import IPrincipal
+
+from zope.security.management import queryInteraction
+
+from nti.app.client_preferences.interfaces import IPreferenceWriteBuffer
+
+from nti.app.client_preferences.reader import PreferenceReader
+
+from nti.app.client_preferences.storage import query_preference_storage
+
+from nti.app.client_preferences.writebehind import MemoryPreferenceWriteBuffer
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.app.client_preferences.tests.test_preferences_views import PrefApplicationTestLayer
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.dataserver.users.users import User
+
+USERNAME = 'sjohnson@nextthought.COM'
+
+
+class TestPreferenceReader(ApplicationLayerTest):
+    layer = PrefApplicationTestLayer
+
+    href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/'
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_defaults_without_storage(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            user = User.get_user(USERNAME)
+            assert_that(queryInteraction(), is_(none()))
+            reader = PreferenceReader()
+            assert_that(reader.get_value(user, 'PushNotifications.send_me_push_notifications'),
+                        is_(True))
+            assert_that(reader.get_values(user, 'WebApp'),
+                        has_entries('preferFlashVideo', False))
+            assert_that(reader.get_tree(user),
+                        has_entries('ChatPresence',
+                                    has_entries('Away', has_entries('show', 'away'))))
+            assert_that(calling(reader.get_values).with_args(user, 'Bogus'),
+                        raises(KeyError))
+            # Nothing was created
+            storage = query_preference_storage(component.getUtility(IPreferenceGroup),
+                                               IPrincipal(user))
+            assert_that(storage, is_(none()))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_stored_and_buffered_values(self):
+        self.testapp.put_json(self.href + 'WebApp', {'preferFlashVideo': True})
+
+        buffer = MemoryPreferenceWriteBuffer()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(buffer, IPreferenceWriteBuffer)
+        try:
+            self.testapp.put_json(self.href + 'ChatPresence/Active',
+                                  {'status': u'Out to lunch'})
+            with mock_dataserver.mock_db_trans(self.ds):
+                user = User.get_user(USERNAME)
+                reader = PreferenceReader()
+                assert_that(reader.get_value(user, 'WebApp.preferFlashVideo'),
+                            is_(True))
+                assert_that(reader.get_value(user, 'ChatPresence.Active.status'),
+                            is_('Out to lunch'))
+                assert_that(reader.get_tree(user, 'ChatPresence'),
+                            has_entries('Active', has_entries('status', 'Out to lunch')))
+        finally:
+            gsm.unregisterUtility(buffer, IPreferenceWriteBuffer)
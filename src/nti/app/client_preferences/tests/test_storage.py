@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_key
+from hamcrest import assert_that
+from hamcrest import has_length
+from hamcrest import has_entries
+from hamcrest import same_instance
+from hamcrest import calling
+from hamcrest import raises
+
+import os
+import shutil
+import tempfile
+
+import transaction
+
+from BTrees.OOBTree import OOBTree
+
+from ZODB import DB
+
+from ZODB.FileStorage import FileStorage
+
+from ZODB.POSException import ConflictError
+
+from zope.annotation.attribute import AttributeAnnotations
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.component import getUtility
+from zope.component import provideAdapter
+from zope.component import provideUtility
+from zope.component import getGlobalSiteManager
+
+from zope.preference.interfaces import IPreferenceGroup
+from zope.preference.interfaces import IDefaultPreferenceProvider
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import PREFERENCES_KEY
+from nti.app.client_preferences.storage import PreferenceStorage
+from nti.app.client_preferences.storage import get_default_value
+from nti.app.client_preferences.storage import get_default_values
+from nti.app.client_preferences.storage import clear_default_values
+from nti.app.client_preferences.storage import get_preference_value
+from nti.app.client_preferences.storage import read_preference_values
+from nti.app.client_preferences.storage import get_preference_storage
+from nti.app.client_preferences.storage import store_preference_value
+from nti.app.client_preferences.storage import query_preference_storage
+from nti.app.client_preferences.storage import iter_changed_group_ids
+from nti.app.client_preferences.storage import preference_version_token
+
+from nti.app.client_preferences.tests import PreferenceLayerTest
+
+
+class Principal(object):
+    id = u'zope.user'
+
+
+def _PrincipalAnnotationFactory(prin, unused_group):
+    return AttributeAnnotations(prin)
+
+
+class TestStorage(PreferenceLayerTest):
+
+    def setUp(self):
+        super(TestStorage, self).setUp()
+        provideAdapter(_PrincipalAnnotationFactory,
+                       (Principal, IPreferenceGroup),
+                       IAnnotations)
+        self.principal = Principal()
+        self.plan = get_preference_group_plans()['ZMISettings']
+        self.group = getUtility(IPreferenceGroup, name='ZMISettings')
+
+    def test_sparse(self):
+        storage = PreferenceStorage()
+        store_preference_value(self.plan, storage, 'skin', u'Basic')
+        assert_that(storage.group_values('ZMISettings'),
+                    is_({'skin': u'Basic'}))
+        assert_that(read_preference_values(self.plan, storage),
+                    has_entries('skin', u'Basic',
+                                'showZopeLogo', True))
+
+        # Going back to the default removes the value, and the group
+        store_preference_value(self.plan, storage, 'skin', u'Rotterdam')
+        assert_that(storage, is_not(has_key('ZMISettings')))
+        assert_that(storage.get('ZMISettings'), is_(none()))
+        assert_that(read_preference_values(self.plan, storage),
+                    has_entries('skin', u'Rotterdam'))
+
+        assert_that(get_preference_value(self.plan, storage, 'skin'),
+                    is_(u'Rotterdam'))
+        assert_that(get_preference_value(self.plan, None, 'skin'),
+                    is_(u'Rotterdam'))
+
+        # Which is never stored to begin with
+        store_preference_value(self.plan, storage, 'showZopeLogo', True)
+        assert_that(storage.keys(), is_([]))
+
+    def test_default_values_cached(self):
+        defaults = get_default_values(self.plan)
+        assert_that(defaults, has_entries('skin', u'Rotterdam',
+                                          'showZopeLogo', True))
+        assert_that(get_default_values(self.plan), is_(same_instance(defaults)))
+        # Callers get their own copy
+        values = read_preference_values(self.plan, None)
+        values['skin'] = u'Basic'
+        assert_that(get_default_values(self.plan), has_entries('skin', u'Rotterdam'))
+
+        clear_default_values()
+        assert_that(get_default_values(self.plan), is_not(same_instance(defaults)))
+
+    def test_mutable_default_values_copied(self):
+        plan = get_preference_group_plans()['ZMISettings.Folder']
+        values = read_preference_values(plan, None)
+        values['shownFields'].add(u'creator')
+        assert_that(get_default_values(plan)['shownFields'],
+                    is_({u'name', u'size'}))
+        assert_that(read_preference_values(plan, None)['shownFields'],
+                    is_({u'name', u'size'}))
+        assert_that(get_default_value(plan, 'shownFields'),
+                    is_not(same_instance(get_default_values(plan)['shownFields'])))
+
+    def test_default_values_follow_committed_provider_changes(self):
+
+        class Group(object):
+            email = None
+            skin = u'Basic'
+            showZopeLogo = True
+
+        class Provider(object):
+            _p_serial = b'1'
+
+            def getDefaultPreferenceGroup(self, unused_id):
+                return Group()
+
+        provider = Provider()
+        provideUtility(provider, IDefaultPreferenceProvider)
+        try:
+            plan = get_preference_group_plans()['ZMISettings']
+            defaults = get_default_values(plan)
+            assert_that(get_default_values(plan), is_(same_instance(defaults)))
+            # Another process committed a change
+            Group.skin = u'ZopeTop'
+            provider._p_serial = b'2'
+            assert_that(get_default_values(plan), has_entries('skin', u'ZopeTop'))
+        finally:
+            getGlobalSiteManager().unregisterUtility(provider,
+                                                     IDefaultPreferenceProvider)
+
+    def test_default_values_follow_registrations(self):
+        defaults = get_default_values(self.plan)
+
+        class Group(object):
+            email = None
+            skin = u'Basic'
+            showZopeLogo = True
+
+        class Provider(object):
+            def getDefaultPreferenceGroup(self, unused_id):
+                return Group()
+
+        provider = Provider()
+        provideUtility(provider, IDefaultPreferenceProvider)
+        try:
+            plan = get_preference_group_plans()['ZMISettings']
+            assert_that(get_default_values(plan), is_not(same_instance(defaults)))
+            assert_that(read_preference_values(plan, None),
+                        has_entries('skin', u'Basic'))
+            assert_that(get_preference_value(plan, None, 'skin'), is_(u'Basic'))
+        finally:
+            getGlobalSiteManager().unregisterUtility(provider,
+                                                     IDefaultPreferenceProvider)
+
+    def test_versions(self):
+        storage = PreferenceStorage()
+        assert_that(storage.version, is_(0))
+        storage.set_value('Sort.books', 'sortOn', u'title')
+        storage.set_value('WebApp', 'useHighContrast', True)
+        # Unchanged values aren't changes
+        storage.set_value('Sort.books', 'sortOn', u'title')
+        assert_that(storage.version, is_(2))
+        assert_that(sorted(storage.changed_since(0)), is_(['Sort.books', 'WebApp']))
+        assert_that(storage.changed_since(1), is_(['WebApp']))
+        assert_that(storage.changed_since(2), is_([]))
+
+        # Going back to the default is a change too
+        storage.discard_value('Sort.books', 'sortOn')
+        assert_that(storage.changed_since(2), is_(['Sort.books']))
+
+        sort = getUtility(IPreferenceGroup, name='Sort')
+        assert_that(list(iter_changed_group_ids(sort, storage, 0)),
+                    is_(['Sort.books']))
+        # A token from some other storage
+        assert_that(sorted(iter_changed_group_ids(sort, storage, 42)),
+                    is_(['Sort', 'Sort.books', 'Sort.communities',
+                         'Sort.courses', 'Sort.courses.administered']))
+        assert_that(list(iter_changed_group_ids(sort, None, 0)), is_([]))
+
+    def test_mapping_protocol(self):
+        # As used by zope.preference
+        storage = PreferenceStorage()
+        storage['ZMISettings'] = OOBTree()
+        assert_that(storage.keys(), is_([]))
+
+        data = storage['ZMISettings']
+        data['skin'] = u'Rotterdam'
+        assert_that(storage.keys(), is_([]))
+        data['skin'] = u'Basic'
+        assert_that(data.get('skin'), is_(u'Basic'))
+        assert_that(storage.keys(), is_(['ZMISettings']))
+        del data['skin']
+        assert_that(storage.keys(), is_([]))
+
+    def test_query_does_not_create(self):
+        assert_that(query_preference_storage(self.group, self.principal),
+                    is_(none()))
+        assert_that(query_preference_storage(self.group, self.principal),
+                    is_(none()))
+
+        storage = get_preference_storage(self.group, self.principal)
+        assert_that(storage, is_(PreferenceStorage))
+        assert_that(query_preference_storage(self.group, self.principal),
+                    is_(same_instance(storage)))
+
+    def test_convert_legacy(self):
+        annotations = AttributeAnnotations(self.principal)
+        legacy = annotations[PREFERENCES_KEY] = OOBTree()
+        legacy['ZMISettings'] = OOBTree({'skin': u'Basic', 'showZopeLogo': True})
+        legacy['ZMISettings.Folder'] = OOBTree()
+        token = preference_version_token(self.group, self.principal)
+
+        storage = get_preference_storage(self.group, self.principal)
+        assert_that(storage, is_(PreferenceStorage))
+        assert_that(annotations[PREFERENCES_KEY], is_(same_instance(storage)))
+        assert_that(storage.keys(), is_(['ZMISettings']))
+        assert_that(storage.group_values('ZMISettings'),
+                    is_({'skin': u'Basic'}))
+        # The effective values are the same, and so is the version
+        assert_that(preference_version_token(self.group, self.principal),
+                    is_(token))
+
+
+class TestConflictResolution(PreferenceLayerTest):
+
+    def setUp(self):
+        super(TestConflictResolution, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.db = DB(FileStorage(os.path.join(self.tmpdir, 'Data.fs')))
+        self.addCleanup(self.db.close)
+        tm = transaction.TransactionManager()
+        with tm:
+            storage = self._open(tm).root()['storage'] = PreferenceStorage()
+            storage.set_value('ChatPresence.Active', 'status', u'Here')
+            storage.set_value('Sort.courses', 'sortOn', u'title')
+
+    def _open(self, tm):
+        # Closed, dropping anything uncommitted, before the database
+        conn = self.db.open(tm)
+        self.addCleanup(conn.close)
+        self.addCleanup(tm.abort)
+        return conn
+
+    def _concurrently(self, first, second):
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        storage1 = self._open(tm1).root()['storage']
+        storage2 = self._open(tm2).root()['storage']
+        first(storage1)
+        second(storage2)
+        tm1.commit()
+        try:
+            tm2.commit()
+        except ConflictError:
+            tm2.abort()
+            raise
+        tm = transaction.TransactionManager()
+        with tm:
+            return dict(self._open(tm).root()['storage']._groups)
+
+    def test_disjoint_groups_merge(self):
+        groups = self._concurrently(
+            lambda s: s.set_value('ChatPresence.Active', 'status', u'Away'),
+            lambda s: s.discard_value('Sort.courses', 'sortOn'))
+        assert_that(groups, is_({'ChatPresence.Active': {'status': u'Away'}}))
+
+    def test_disjoint_fields_merge(self):
+        groups = self._concurrently(
+            lambda s: s.set_value('Sort.courses', 'sortOrder', u'ascending'),
+            lambda s: s.set_value('Sort.courses', 'sortOn', u'date'))
+        assert_that(groups['Sort.courses'],
+                    is_({'sortOn': u'date', 'sortOrder': u'ascending'}))
+
+    def test_versions_renumbered(self):
+        tm = transaction.TransactionManager()
+        with tm:
+            version = self._open(tm).root()['storage'].version
+        self._concurrently(
+            lambda s: s.set_value('ChatPresence.Active', 'status', u'Away'),
+            lambda s: s.set_value('Sort.courses', 'sortOrder', u'ascending'))
+        with tm:
+            storage = self._open(tm).root()['storage']
+            assert_that(storage.version, is_(version + 2))
+            assert_that(storage.changed_since(version + 1), is_(['Sort.courses']))
+            assert_that(storage.changed_since(version), has_length(2))
+
+    def test_same_value_merges(self):
+        groups = self._concurrently(
+            lambda s: s.set_value('WebApp', 'useHighContrast', True),
+            lambda s: s.set_value('WebApp', 'useHighContrast', True))
+        assert_that(groups['WebApp'], is_({'useHighContrast': True}))
+
+    def test_same_field_conflicts(self):
+        assert_that(calling(self._concurrently).with_args(
+            lambda s: s.set_value('ChatPresence.Active', 'status', u'Away'),
+            lambda s: s.set_value('ChatPresence.Active', 'status', u'Busy')),
+                    raises(ConflictError))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods,arguments-differ
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_entries
+
+import time
+import unittest
+
+import fudge
+
+import transaction
+
+from ZODB.POSException import ConflictError
+
+from zope import component
+
+from zope.interface.verify import verifyObject
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.client_preferences.interfaces import IPreferenceWriteBuffer
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import query_preference_storage
+
+from nti.app.client_preferences.externalization import PreferenceGroupObjectIO
+
+from nti.app.client_preferences.writebehind import WriteBehindFlusher
+from nti.app.client_preferences.writebehind import _start_write_behind
+from nti.app.client_preferences.writebehind import flush_preference_writes
+from nti.app.client_preferences.writebehind import MemoryPreferenceWriteBuffer
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.app.client_preferences.tests.test_preferences_views import PrefApplicationTestLayer
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.dataserver.users.users import User
+
+ACTIVE = 'ChatPresence.Active'
+
+
+class TestMemoryPreferenceWriteBuffer(unittest.TestCase):
+
+    def test_interface(self):
+        verifyObject(IPreferenceWriteBuffer, MemoryPreferenceWriteBuffer())
+
+    def test_bounded(self):
+        buffer = MemoryPreferenceWriteBuffer(max_entries=1)
+        assert_that(buffer.reserve('alice', ACTIVE), is_(True))
+        buffer.put('alice', ACTIVE, {'status': u'Away'})
+        assert_that(buffer.reserve('alice', ACTIVE), is_(True))
+        buffer.put('alice', ACTIVE, {'show': u'away'})
+        assert_that(buffer.reserve('bob', ACTIVE), is_(False))
+        assert_that(buffer.get('alice', ACTIVE),
+                    is_({'status': u'Away', 'show': u'away'}))
+        assert_that(buffer.get('bob', ACTIVE), is_(none()))
+        assert_that(buffer.has_pending('alice'), is_(True))
+        assert_that(buffer.has_pending('bob'), is_(False))
+
+    def test_release(self):
+        buffer = MemoryPreferenceWriteBuffer(max_entries=1)
+        assert_that(buffer.reserve('alice', ACTIVE), is_(True))
+        # Nothing to write yet
+        assert_that(buffer.pending(), is_([]))
+        buffer.release('alice', ACTIVE)
+        assert_that(len(buffer), is_(0))
+        assert_that(buffer.has_pending('alice'), is_(False))
+        assert_that(buffer.reserve('bob', ACTIVE), is_(True))
+
+        # Values that were put stay
+        buffer.put('bob', ACTIVE, {'status': u'Away'})
+        buffer.release('bob', ACTIVE)
+        assert_that(buffer.get('bob', ACTIVE), is_({'status': u'Away'}))
+
+    def test_discard_keeps_newer_values(self):
+        buffer = MemoryPreferenceWriteBuffer()
+        buffer.put('alice', ACTIVE, {'status': u'Away', 'show': u'away'})
+        entries = buffer.pending()
+        buffer.put('alice', ACTIVE, {'status': u'Lunch'})
+        buffer.discard(entries)
+        assert_that(buffer.get('alice', ACTIVE), is_({'status': u'Lunch'}))
+
+        buffer.discard(buffer.pending())
+        assert_that(buffer.get('alice', ACTIVE), is_(none()))
+        assert_that(buffer.has_pending('alice'), is_(False))
+        assert_that(len(buffer), is_(0))
+
+
+class TestWriteBehind(ApplicationLayerTest):
+    layer = PrefApplicationTestLayer
+
+    def _stored(self, username='sjohnson@nextthought.COM'):
+        with mock_dataserver.mock_db_trans(self.ds):
+            principal = IPrincipal(User.get_user(username))
+            storage = query_preference_storage(component.getUtility(IPreferenceGroup),
+                                               principal)
+            return None if storage is None else storage.keys()
+
+    def test_volatile_plans(self):
+        plans = get_preference_group_plans()
+        assert_that(plans[ACTIVE].volatile, is_(True))
+        for group_id in ('ChatPresence', 'ChatPresence.Away', 'WebApp'):
+            assert_that(plans[group_id].volatile, is_(False))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_buffered_until_flushed(self):
+        buffer = MemoryPreferenceWriteBuffer()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(buffer, IPreferenceWriteBuffer)
+        try:
+            href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/ChatPresence'
+            res = self.testapp.get(href + '/Active')
+            etag = res.headers['ETag']
+
+            self.testapp.put_json(href + '/Active', {'status': u'Out to lunch'})
+            assert_that([(group_id, values) for _, group_id, values in buffer.pending()],
+                        is_([(ACTIVE, {'status': u'Out to lunch'})]))
+            assert_that(self._stored(), is_(none()))
+            # Other groups are written as usual
+            self.testapp.put_json(href + '/Away', {'status': u'Gone'})
+            assert_that(len(buffer), is_(1))
+
+            # Reads see the buffered values
+            res = self.testapp.get(href + '/Active',
+                                   headers={'If-None-Match': etag})
+            assert_that(res.json_body, has_entries('status', 'Out to lunch'))
+
+            with mock_dataserver.mock_db_trans(self.ds):
+                users = self.ds.dataserver_folder['users']
+                entries = flush_preference_writes(users, buffer)
+            buffer.discard(entries)
+            assert_that(len(buffer), is_(0))
+            assert_that(sorted(self._stored()),
+                        is_(['ChatPresence.Active', 'ChatPresence.Away']))
+
+            res = self.testapp.get(href)
+            assert_that(res.json_body,
+                        has_entries('Active', has_entries('status', 'Out to lunch'),
+                                    'Away', has_entries('status', 'Gone')))
+        finally:
+            gsm.unregisterUtility(buffer, IPreferenceWriteBuffer)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_buffered_only_on_commit(self):
+        buffer = MemoryPreferenceWriteBuffer()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(buffer, IPreferenceWriteBuffer)
+        try:
+            with mock_dataserver.mock_db_trans(self.ds):
+                user = User.get_user('sjohnson@nextthought.COM')
+                principal = IPrincipal(user)
+                group = component.getUtility(IPreferenceGroup, name=ACTIVE)
+                io = PreferenceGroupObjectIO(group.__bind__(user), principal)
+                io.updateFromExternalObject({'status': u'Never mind'})
+                # Visible in this transaction only
+                io = PreferenceGroupObjectIO(group.__bind__(user), principal)
+                assert_that(io.toExternalObject(),
+                            has_entries('status', 'Never mind'))
+                assert_that(buffer.has_pending(principal.id), is_(True))
+                transaction.abort()
+            # The reservation is gone too
+            assert_that(buffer.get(principal.id, ACTIVE), is_(none()))
+            assert_that(buffer.has_pending(principal.id), is_(False))
+            assert_that(len(buffer), is_(0))
+
+            with mock_dataserver.mock_db_trans(self.ds):
+                user = User.get_user('sjohnson@nextthought.COM')
+                io = PreferenceGroupObjectIO(group.__bind__(user), IPrincipal(user))
+                io.updateFromExternalObject({'status': u'For real'})
+            assert_that(buffer.get(principal.id, ACTIVE),
+                        is_({'status': u'For real'}))
+            assert_that(len(buffer), is_(1))
+        finally:
+            gsm.unregisterUtility(buffer, IPreferenceWriteBuffer)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_reservations_not_written(self):
+        buffer = MemoryPreferenceWriteBuffer()
+        with mock_dataserver.mock_db_trans(self.ds):
+            principal = IPrincipal(User.get_user('sjohnson@nextthought.COM'))
+        buffer.reserve(principal.id, ACTIVE)
+        with mock_dataserver.mock_db_trans(self.ds):
+            users = self.ds.dataserver_folder['users']
+            assert_that(flush_preference_writes(users, buffer), is_([]))
+        assert_that(self._stored(), is_(none()))
+
+    def _buffered(self, buffer):
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(buffer, IPreferenceWriteBuffer)
+        self.addCleanup(gsm.unregisterUtility, buffer, IPreferenceWriteBuffer)
+        href = '/dataserver2/users/sjohnson@nextthought.COM/++preferences++/ChatPresence/Active'
+        self.testapp.put_json(href, {'status': u'Out to lunch'})
+        assert_that(len(buffer), is_(1))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_flusher_thread(self):
+        buffer = MemoryPreferenceWriteBuffer(flush_interval=0.01)
+        self._buffered(buffer)
+        flusher = WriteBehindFlusher(self.ds.db, buffer)
+        flusher.start()
+        try:
+            for _ in range(500):
+                if not len(buffer):
+                    break
+                time.sleep(0.01)
+        finally:
+            flusher.stop()
+        assert_that(flusher._thread, is_(none()))
+        assert_that(len(buffer), is_(0))
+        assert_that(sorted(self._stored()), is_(['ChatPresence.Active']))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_flusher_writes_pending_on_stop(self):
+        buffer = MemoryPreferenceWriteBuffer(flush_interval=3600)
+        self._buffered(buffer)
+        flusher = WriteBehindFlusher(self.ds.db, buffer)
+        flusher.start()
+        flusher.stop()
+        assert_that(len(buffer), is_(0))
+        assert_that(sorted(self._stored()), is_(['ChatPresence.Active']))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.client_preferences.writebehind.flush_preference_writes')
+    def test_flusher_retries(self, fake_flush):
+        buffer = MemoryPreferenceWriteBuffer()
+        self._buffered(buffer)
+        calls = []
+
+        def flush(users, buffer):
+            calls.append(users)
+            if len(calls) == 1:
+                raise ConflictError()
+            return flush_preference_writes(users, buffer)
+        fake_flush.is_callable().calls(flush)
+        WriteBehindFlusher(self.ds.db, buffer).flush()
+        assert_that(len(calls), is_(2))
+        assert_that(len(buffer), is_(0))
+        assert_that(sorted(self._stored()), is_(['ChatPresence.Active']))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.client_preferences.writebehind.flush_preference_writes')
+    def test_flusher_keeps_failed_writes(self, fake_flush):
+        buffer = MemoryPreferenceWriteBuffer()
+        self._buffered(buffer)
+        fake_flush.is_callable().raises(ConflictError())
+        flusher = WriteBehindFlusher(self.ds.db, buffer)
+        flusher.flush()
+        # Still pending, for the next time
+        assert_that(len(buffer), is_(1))
+        assert_that(self._stored(), is_(none()))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.client_preferences.writebehind.atexit')
+    def test_started_when_database_opened(self, fake_atexit):
+        event = fudge.Fake().has_attr(database=self.ds.db)
+        # Without a buffer, nothing is started (or registered)
+        _start_write_behind(event)
+
+        buffer = MemoryPreferenceWriteBuffer(flush_interval=3600)
+        self._buffered(buffer)
+        stops = []
+        fake_atexit.expects('register').calls(stops.append)
+        _start_write_behind(event)
+        assert_that(stops, has_length(1))
+        flusher = stops[0].__self__
+        assert_that(flusher._thread.is_alive(), is_(True))
+        stops[0]()
+        assert_that(len(buffer), is_(0))
+        assert_that(sorted(self._stored()), is_(['ChatPresence.Active']))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Iterating all the users of the dataserver, for bulk jobs.
+
+Only the keys (the usernames) of the users folder are read up front;
+no entity is loaded until it is iterated, and then only once. The
+cache of the connection is minimized after every batch, so memory use
+doesn't grow with the number of users.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from nti.dataserver.interfaces import IUser
+
+#: The number of users loaded between minimizing the cache.
+BATCH_SIZE = 500
+
+
+def user_keys(ds_folder):
+    """
+    Return the sorted keys of the users folder of the dataserver
+    folder. These include other entities, like communities.
+    """
+    return sorted(ds_folder['users'].keys())
+
+
+def iter_users(ds_folder, batch_size=BATCH_SIZE, keys=None):
+    """
+    Iterate the users of the dataserver folder with the given *keys*
+    (by default, all of them), in that order, minimizing the cache of
+    its connection after every *batch_size* entities.
+    """
+    users = ds_folder['users']
+    connection = ds_folder._p_jar
+    keys = user_keys(ds_folder) if keys is None else keys
+    for i, key in enumerate(keys, 1):
+        user = users.get(key)
+        if IUser.providedBy(user):
+            yield user
+        if i % batch_size == 0:
+            connection.cacheMinimize()
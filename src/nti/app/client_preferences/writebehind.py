@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Optional write-behind of frequently updated preference groups.
+
+Some groups, like ``ChatPresence.Active``, are updated far more often
+than the rest, and each update is otherwise a commit of the user's
+preference storage. Groups whose schema is tagged with
+:const:`~.interfaces.TAG_VOLATILE_PREFERENCE_GROUP` can instead have
+their updates kept in an :class:`~.interfaces.IPreferenceWriteBuffer`
+and written to storage in the background, many updates (and users) to
+a commit.
+
+Nothing is buffered unless a buffer is registered as a global
+utility, for example::
+
+    <utility factory="nti.app.client_preferences.writebehind.MemoryPreferenceWriteBuffer" />
+
+When the database is opened, a :class:`WriteBehindFlusher` is started
+to write the buffered values every ``flush_interval`` seconds and once
+more when the process exits. While values are buffered, the
+externalized groups, ETags and cached documents of the user include
+them, and so does the value index. Other things that read the storage
+directly (the administrative views, changes since a sync token) see
+them only once they are written. Update events are sent when values are
+updated.
+
+Values are added to the buffer only when the transaction that updated
+them commits (room for them is reserved before, and released when the
+transaction ends), so updates that are aborted or retried are never
+written.
+
+Reading the attributes of a :mod:`zope.preference` group reads the
+storage directly, so it doesn't see buffered values until they are
+written.
+
+:class:`MemoryPreferenceWriteBuffer` keeps the values in this process
+only, so other processes don't see them until they are written; a
+buffer shared between processes can be plugged in instead.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import atexit
+import threading
+
+from collections import OrderedDict
+
+import transaction
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import site
+
+from zope.preference.interfaces import IPreferenceGroup
+
+from zope.processlifetime import IDatabaseOpenedWithRoot
+
+from zope.security.interfaces import IPrincipal
+
+from nti.app.client_preferences.index import index_user_group
+
+from nti.app.client_preferences.interfaces import IPreferenceValueIndex
+from nti.app.client_preferences.interfaces import IPreferenceWriteBuffer
+
+from nti.app.client_preferences.metrics import query_metrics_sink
+
+from nti.app.client_preferences.plan import get_preference_group_plans
+
+from nti.app.client_preferences.storage import get_preference_storage
+from nti.app.client_preferences.storage import store_preference_value
+
+#: The default number of groups (of any principals) a
+#: :class:`MemoryPreferenceWriteBuffer` holds.
+DEFAULT_MAX_ENTRIES = 10000
+
+#: The default number of seconds between writes.
+DEFAULT_FLUSH_INTERVAL = 5
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IPreferenceWriteBuffer)
+class MemoryPreferenceWriteBuffer(object):
+    """
+    A thread-safe buffer of (about) *max_entries* groups, in memory.
+    When it is full, updates of other groups are written through.
+    (Groups reserved before a flush may be added after it, so the
+    bound is briefly exceeded.)
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # (principal id, group id) -> {name: value}
+        self._entries = OrderedDict()
+        # principal id -> number of entries
+        self._principals = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, principal_id, group_id):
+        with self._lock:
+            values = self._entries.get((principal_id, group_id))
+            return dict(values) if values is not None else None
+
+    def has_pending(self, principal_id):
+        return principal_id in self._principals
+
+    def _add(self, key):
+        # Must hold the lock
+        self._principals[key[0]] = self._principals.get(key[0], 0) + 1
+        result = self._entries[key] = {}
+        return result
+
+    def reserve(self, principal_id, group_id):
+        key = (principal_id, group_id)
+        with self._lock:
+            if key not in self._entries:
+                if len(self._entries) >= self.max_entries:
+                    return False
+                self._add(key)
+            return True
+
+    def _remove(self, key):
+        # Must hold the lock
+        del self._entries[key]
+        count = self._principals.pop(key[0]) - 1
+        if count:
+            self._principals[key[0]] = count
+
+    def release(self, principal_id, group_id):
+        key = (principal_id, group_id)
+        with self._lock:
+            if key in self._entries and not self._entries[key]:
+                self._remove(key)
+
+    def put(self, principal_id, group_id, values):
+        key = (principal_id, group_id)
+        with self._lock:
+            pending = self._entries.get(key)
+            if pending is None:
+                # Reserved, but written meanwhile
+                pending = self._add(key)
+            pending.update(values)
+
+    def pending(self):
+        # Reservations have nothing to write yet
+        with self._lock:
+            return [(principal_id, group_id, dict(values))
+                    for (principal_id, group_id), values in self._entries.items()
+                    if values]
+
+    def discard(self, entries):
+        with self._lock:
+            for principal_id, group_id, values in entries:
+                key = (principal_id, group_id)
+                pending = self._entries.get(key)
+                if pending is None:
+                    continue
+                for name, value in values.items():
+                    if name in pending and pending[name] == value:
+                        del pending[name]
+                if not pending:
+                    self._remove(key)
+
+
+def flush_preference_writes(users, buffer):
+    """
+    Write everything pending in the *buffer* to the preference storage
+    of the users, found by principal id in the *users* folder, in the
+    current transaction, and return the entries written. Once the
+    transaction commits, pass them to the buffer's ``discard``.
+
+    This must be called in the site of the users.
+    """
+    entries = buffer.pending()
+    if not entries:
+        return entries
+    plans = get_preference_group_plans()
+    root = component.getUtility(IPreferenceGroup)
+    index = component.queryUtility(IPreferenceValueIndex)
+    for principal_id, group_id, values in entries:
+        if not values:
+            # Nothing to write, so don't touch the storage
+            continue
+        user = users.get(principal_id)
+        plan = plans.get(group_id)
+        if user is None or plan is None:
+            logger.warning("Dropping buffered preferences of %s in %s",
+                           principal_id, group_id)
+            continue
+        principal = IPrincipal(user)
+        storage = get_preference_storage(root, principal)
+        for name, value in values.items():
+            store_preference_value(plan, storage, name, value)
+        if index is not None:
+            index_user_group(index, user, plan, principal)
+    metrics = query_metrics_sink()
+    if metrics is not None:
+        metrics.incr('writes_flushed', len(entries))
+    return entries
+
+
+class WriteBehindFlusher(object):
+    """
+    Writes the values of the *buffer* to the database *db* every
+    ``flush_interval`` seconds (of the buffer), in a daemon thread.
+    """
+
+    #: The attempts made at committing each write.
+    attempts = 3
+
+    def __init__(self, db, buffer):
+        self.db = db
+        self.buffer = buffer
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='preference-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread, and write anything still pending.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.buffer.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if not self.buffer.pending():
+            return
+        transaction_manager = transaction.TransactionManager()
+        connection = self.db.open(transaction_manager)
+        try:
+            for attempt in transaction_manager.attempts(self.attempts):
+                with attempt:
+                    ds_folder = connection.root()['nti.dataserver']
+                    with site(ds_folder):
+                        entries = flush_preference_writes(ds_folder['users'],
+                                                          self.buffer)
+            self.buffer.discard(entries)
+        except Exception:  # pylint: disable=broad-except
+            # Still pending; we'll try again
+            logger.exception("Failed to write buffered preferences")
+        finally:
+            connection.close()
+
+
+@component.adapter(IDatabaseOpenedWithRoot)
+def _start_write_behind(event):
+    buffer = component.getGlobalSiteManager().queryUtility(IPreferenceWriteBuffer)
+    if buffer is None:
+        return
+    flusher = WriteBehindFlusher(event.database, buffer)
+    flusher.start()
+    atexit.register(flusher.stop)